@@ -1,9 +1,10 @@
-from tornado import httpclient, gen
+from tornado import gen
 from tornado.platform.asyncio import AsyncIOMainLoop
 from filters.tornado_source import TornadoSource
 from graph.filter_base import FilterBase, FilterState, FilterType
 from graph.input_pin import InputPin
 from graph.output_pin import OutputPin
+from services.http_client_service import HttpClientService
 
 
 class HttpClient(FilterBase):
@@ -12,6 +13,7 @@ class HttpClient(FilterBase):
 
     TODO: Remove this filter and use http_client_sink or http_client_source instead
     """
+    CONFIG_KEY_HTTP_CLIENT_SERVICE = 'http_client_service'
 
     filter_pad_templates = {}
     filter_meta = {}
@@ -26,6 +28,7 @@ class HttpClient(FilterBase):
         self._output_pin = OutputPin('output', True)
         self._add_output_pin(self._output_pin)
         self._request_uri = config_dict.get(TornadoSource.METADATA_KEY_REQUEST_URI)
+        self._http_client = HttpClientService.get_shared(graph_manager, config_dict.get(HttpClient.CONFIG_KEY_HTTP_CLIENT_SERVICE))
 
     def run(self):
         super().run()
@@ -57,8 +60,7 @@ class HttpClient(FilterBase):
         :return:
         """
         try:
-            client = httpclient.AsyncHTTPClient(defaults=dict(user_agent="Rosetta/1.0"))
-            resp = yield client.fetch(request_uri, validate_cert=False)
+            resp = yield self._http_client.fetch(request_uri, method=http_method)
             # TODO: Move this parser to an utility class
             content_type = resp.headers.get('Content-Type')
             mime_type = ''
@@ -1,8 +1,9 @@
-from tornado import httpclient, gen
+from tornado import gen
 from tornado.platform.asyncio import AsyncIOMainLoop
 from filters.tornado_source import TornadoSource
 from graph.filter_base import FilterBase, FilterState, FilterType
 from graph.input_pin import InputPin
+from services.http_client_service import HttpClientService
 
 
 class HttpClientSink(FilterBase):
@@ -11,7 +12,11 @@ class HttpClientSink(FilterBase):
 
     Input Pins:
     input - Accepts any mime type. Used to provide METADATA_KEY_REQUEST_URI and METADATA_KEY_REQUEST_METHOD in the metadata_dict.
+
+    Config:
+    http_client_service - Optional - The name of the HttpClientService to use, defaults to http_client
     """
+    CONFIG_KEY_HTTP_CLIENT_SERVICE = 'http_client_service'
 
     filter_pad_templates = {}
     filter_meta = {}
@@ -23,6 +28,7 @@ class HttpClientSink(FilterBase):
         mime_type_map['*'] = self.recv
         ipin = InputPin('input', mime_type_map, self)
         self._add_input_pin(ipin)
+        self._http_client = HttpClientService.get_shared(graph_manager, config_dict.get(HttpClientSink.CONFIG_KEY_HTTP_CLIENT_SERVICE))
 
     def run(self):
         super().run()
@@ -55,9 +61,8 @@ class HttpClientSink(FilterBase):
         :return:
         """
         try:
-            client = httpclient.AsyncHTTPClient(defaults=dict(user_agent="Rosetta/1.0"))
             headers = {'Content-Type': mime_type}
-            resp = yield client.fetch(request_uri, validate_cert=False, method=http_method, headers=headers, body=payload)
+            resp = yield self._http_client.fetch(request_uri, method=http_method, headers=headers, body=payload)
             # TODO: Move this parser to an utility class
             print('HTTP code: {0}'.format(resp.code))
             content_type = resp.headers.get('Content-Type')
@@ -85,7 +90,7 @@ class HttpClientSink(FilterBase):
             #     body_str = resp.body.decode(target_charset, 'ignore')
             #     self._output_pin.send(mime_type, body_str, meta_dict)
         except Exception as e:
-            print('Exception: %s %s' % (e, self._request_uri))
+            print('Exception: %s %s' % (e, request_uri))
 
     @staticmethod
     def get_filter_metadata():
@@ -1,9 +1,20 @@
-from tornado import httpclient, gen
+import asyncio
+import codecs
+import itertools
+import time
+from functools import partial
+from urllib.parse import urlsplit
+
+from tornado import gen, httputil
 from tornado.platform.asyncio import AsyncIOMainLoop
 from filters.tornado_source import TornadoSource
+from filters.validator_cache import ValidatorCache
 from graph.filter_base import FilterBase, FilterState, FilterType
 from graph.input_pin import InputPin
+from graph.json_payload import JsonPayload
+from graph.mime_types import MimeTypes
 from graph.output_pin import OutputPin
+from services.http_client_service import HttpClientService
 
 
 class HttpClientSource(FilterBase):
@@ -11,11 +22,67 @@ class HttpClientSource(FilterBase):
     An HTTP client source filter. Implements the http GET method.
 
     Input Pins:
-    input - Accepts any mime type. Used only to provide METADATA_KEY_REQUEST_URI in the metadata_dict.
+    input - Accepts any mime type. Used only to provide METADATA_KEY_REQUEST_URI in the metadata_dict, unless
+            request_uris_from_payload is set.
 
     Output Pins:
-    output - Required - Whatever is fetched will be sent downstream via this pin.
+    output - Required - Whatever is fetched will be sent downstream via this pin. The metadata of the input message is
+             passed along, so ex: a response can find its way back to the TornadoSource request that asked for it.
+             Note this is a change from earlier versions, which sent only the mime-type, web_request_uri,
+             web_request_method and web_response_charset keys. Those are still set, overriding the input's values,
+             but downstream filters now also see every other key of the input message.
+
+    Config:
+    web_request_uri - Optional - The URI to fetch once the graph is running, without waiting for input
+    http_client_service - Optional - The name of the HttpClientService to use, defaults to http_client
+    conditional_get - Optional - true, or a block configuring the ValidatorCache. GET requests then send the ETag and
+                      Last-Modified of the previous download, and a 304 response sends nothing downstream, or an empty
+                      text/plain event with web_response_not_modified set if emit_not_modified is true.
+    coalesce_requests - Optional - Defaults to true. Messages asking for a GET of a URI that is already being fetched
+                        wait for that fetch instead of starting their own, then each of them is sent the result.
+    coalesce_ttl_seconds - Optional - Defaults to 0. How long the result of a coalesced fetch is reused by later
+                           messages for the same URI.
+
+    Batch mode - one message fetches a list of URIs:
+    request_uris - Optional - The list of URIs fetched for each input message (and once the graph is running)
+    request_uris_from_payload - Optional - If true, the payload of each input message is the list of URIs, either a
+                                json array or text with one URI per line
+    max_concurrent_fetches - Optional - Upper bound on the fetches in flight for one batch, defaults to 10
+    max_fetches_per_host - Optional - Upper bound on the fetches in flight to one host for one batch, 0 for no limit
+    Each document is sent downstream as soon as it has been fetched, with web_batch_id, web_batch_index and
+    web_batch_size in the metadata. Once every URI of the batch is done, an application/json message with
+    web_batch_event set to end follows, its payload lists the URIs that failed.
+
+    Streaming - the body is sent downstream as it arrives, instead of being held in memory whole:
+    stream_response_body - Optional - If true, each document becomes a sequence of messages on the output pin, all with
+                           the document's mime type: start (empty payload), one chunk per block of the body, then end
+                           (empty payload), or abort if the fetch fails part way. stream_id, stream_event and
+                           stream_sequence in the metadata identify each message, as for TornadoSource.
+    stream_as_bytes - Optional - If true, chunks are sent as bytes. Otherwise they are decoded incrementally with the
+                      document's charset, except for application/octet-stream.
+    request_timeout_seconds - Optional - Overrides the request timeout of the HttpClientService, ex: for large downloads
+    Streamed fetches aren't coalesced.
     """
+    CONFIG_KEY_HTTP_CLIENT_SERVICE = 'http_client_service'
+    CONFIG_KEY_CONDITIONAL_GET = 'conditional_get'
+    CONFIG_KEY_COALESCE_REQUESTS = 'coalesce_requests'
+    CONFIG_KEY_COALESCE_TTL_SECONDS = 'coalesce_ttl_seconds'
+    # Only requests without side effects are coalesced
+    COALESCED_METHODS = ('GET', 'HEAD')
+    CONFIG_KEY_REQUEST_URIS = 'request_uris'
+    CONFIG_KEY_REQUEST_URIS_FROM_PAYLOAD = 'request_uris_from_payload'
+    CONFIG_KEY_MAX_CONCURRENT_FETCHES = 'max_concurrent_fetches'
+    CONFIG_KEY_MAX_FETCHES_PER_HOST = 'max_fetches_per_host'
+    CONFIG_KEY_STREAM_RESPONSE_BODY = 'stream_response_body'
+    CONFIG_KEY_STREAM_AS_BYTES = 'stream_as_bytes'
+    CONFIG_KEY_REQUEST_TIMEOUT_SECONDS = 'request_timeout_seconds'
+    DEFAULT_MAX_CONCURRENT_FETCHES = 10
+    METADATA_KEY_RESPONSE_NOT_MODIFIED = 'web_response_not_modified'
+    METADATA_KEY_BATCH_ID = 'web_batch_id'
+    METADATA_KEY_BATCH_INDEX = 'web_batch_index'
+    METADATA_KEY_BATCH_SIZE = 'web_batch_size'
+    METADATA_KEY_BATCH_EVENT = 'web_batch_event'
+    BATCH_EVENT_END = 'end'
 
     filter_pad_templates = {}
     filter_meta = {}
@@ -30,68 +97,300 @@ class HttpClientSource(FilterBase):
         self._output_pin = OutputPin('output', True)
         self._add_output_pin(self._output_pin)
         self._request_uri = config_dict.get(TornadoSource.METADATA_KEY_REQUEST_URI)
-        if self._request_uri is None:
+        self._http_client = HttpClientService.get_shared(graph_manager, config_dict.get(HttpClientSource.CONFIG_KEY_HTTP_CLIENT_SERVICE))
+        self._validator_cache = None
+        conditional_get = config_dict.get(HttpClientSource.CONFIG_KEY_CONDITIONAL_GET)
+        if conditional_get is True:
+            self._validator_cache = ValidatorCache()
+        elif isinstance(conditional_get, dict):
+            self._validator_cache = ValidatorCache.create_from_config(conditional_get)
+        self._coalesce_requests = config_dict.get(HttpClientSource.CONFIG_KEY_COALESCE_REQUESTS, True)
+        self._coalesce_ttl_seconds = float(config_dict.get(HttpClientSource.CONFIG_KEY_COALESCE_TTL_SECONDS, 0))
+        # Fetches in flight, keyed by (http method, uri)
+        self._pending_fetches = {}
+        # Results kept for coalesce_ttl_seconds: (http method, uri) -> (expires_at, result)
+        self._recent_results = {}
+        self._request_uris = config_dict.get(HttpClientSource.CONFIG_KEY_REQUEST_URIS)
+        self._request_uris_from_payload = config_dict.get(HttpClientSource.CONFIG_KEY_REQUEST_URIS_FROM_PAYLOAD, False)
+        self._max_concurrent_fetches = int(config_dict.get(HttpClientSource.CONFIG_KEY_MAX_CONCURRENT_FETCHES,
+                                                           HttpClientSource.DEFAULT_MAX_CONCURRENT_FETCHES))
+        self._max_fetches_per_host = int(config_dict.get(HttpClientSource.CONFIG_KEY_MAX_FETCHES_PER_HOST, 0))
+        self._batch_ids = itertools.count(1)
+        self._batch_tasks = set()
+        self._stream_response_body = config_dict.get(HttpClientSource.CONFIG_KEY_STREAM_RESPONSE_BODY, False)
+        self._stream_as_bytes = config_dict.get(HttpClientSource.CONFIG_KEY_STREAM_AS_BYTES, False)
+        self._stream_ids = itertools.count(1)
+        # Extra arguments of every fetch
+        self._fetch_options = {}
+        request_timeout = config_dict.get(HttpClientSource.CONFIG_KEY_REQUEST_TIMEOUT_SECONDS)
+        if request_timeout is not None:
+            self._fetch_options['request_timeout'] = float(request_timeout)
+        if self._request_uri is None and self._request_uris is None:
             self._filter_type = FilterType.transform
 
     def run(self):
         super().run()
         AsyncIOMainLoop().install()
+        if self._validator_cache is not None:
+            self._validator_cache.load()
         self._set_filter_state(FilterState.running)
 
     def graph_is_running(self):
         super().graph_is_running()
         if self._request_uri is not None:
             self._fetch_document(self._request_uri, 'GET')
+        if self._request_uris is not None:
+            self._start_batch(self._request_uris, None)
 
     def stop(self):
         super().stop()
+        for batch_task in self._batch_tasks:
+            batch_task.cancel()
+        self._batch_tasks = set()
+        for future in self._pending_fetches.values():
+            future.cancel()
+        self._pending_fetches = {}
+        if self._validator_cache is not None:
+            self._validator_cache.save()
+        self._recent_results = {}
         self._set_filter_state(FilterState.stopped)
 
     def recv(self, mime_type, payload, metadata_dict):
-        request_uri = metadata_dict.get(TornadoSource.METADATA_KEY_REQUEST_URI)
         if self.filter_state == FilterState.running:
-            self._fetch_document(request_uri, 'GET')
+            if self._request_uris is not None:
+                self._start_batch(self._request_uris, metadata_dict)
+            elif self._request_uris_from_payload:
+                self._start_batch(self._get_payload_uris(payload), metadata_dict)
+            else:
+                request_uri = metadata_dict.get(TornadoSource.METADATA_KEY_REQUEST_URI)
+                self._fetch_document(request_uri, 'GET', metadata_dict)
         else:
             raise RuntimeError('{0} tried to process input while filter state is {1}'.format(self.filter_name, self.filter_state))
 
     @gen.coroutine
-    def _fetch_document(self, request_uri, http_method):
+    def _fetch_document(self, request_uri, http_method, metadata_dict=None):
         """
-        Fetch a document from the http server
-        :param remote_uri: The URI to access on the remote server
+        Fetch a document from the http server and send it downstream
+        :param request_uri: The URI to access on the remote server
         :param http_method: The HTTP method to use - GET, POST, etc
-        :return:
+        :param metadata_dict: The metadata of the message that asked for the document, or None
+        :return: False if the fetch failed
         """
+        if self._stream_response_body:
+            ok = yield self._stream_document(request_uri, http_method, metadata_dict)
+            return ok
         try:
-            client = httpclient.AsyncHTTPClient(defaults=dict(user_agent="Rosetta/1.0"))
-            resp = yield client.fetch(request_uri, validate_cert=False)
-            # TODO: Move this parser to an utility class
-            content_type = resp.headers.get('Content-Type')
-            mime_type = ''
-            target_charset = 'utf-8'
-            ctype = content_type.split(';')
-            if len(ctype) > 0:
-                mime_type = ctype[0].strip().lower()
-            if len(ctype) > 1:
-                charset = ctype[1]
-                chars = charset.split('=')
-                if len(chars) > 1:
-                    charset_lit = chars[0].strip().lower()
-                    if charset_lit == 'charset':
-                        target_charset = chars[1].strip().lower()
-            #
-            meta_dict = {}
+            result = yield self._fetch_shared(request_uri, http_method)
+            if result is None:
+                if self._validator_cache.emit_not_modified:
+                    self._send_not_modified(request_uri, http_method, metadata_dict)
+                return True
+            mime_type, target_charset, body = result
+            meta_dict = metadata_dict.copy() if metadata_dict is not None else {}
             meta_dict[TornadoSource.METADATA_KEY_MIME_TYPE] = mime_type
             meta_dict[TornadoSource.METADATA_KEY_REQUEST_URI] = request_uri
             meta_dict[TornadoSource.METADATA_KEY_REQUEST_METHOD] = http_method
             meta_dict[TornadoSource.METADATA_KEY_RESPONSE_CHARSET] = target_charset
-            if mime_type == 'application/octet-stream':
-                self._output_pin.send(mime_type, resp.body, meta_dict)
-            else:
-                body_str = resp.body.decode(target_charset, 'ignore')
-                self._output_pin.send(mime_type, body_str, meta_dict)
+            self._output_pin.send(mime_type, body, meta_dict)
+            return True
+        except asyncio.CancelledError:
+            # The filter was stopped while the fetch was in flight
+            return False
         except Exception as e:
-            print('Exception: %s %s' % (e, self._request_uri))
+            print('Exception: %s %s' % (e, request_uri))
+            return False
+
+    async def _stream_document(self, request_uri, http_method, metadata_dict=None):
+        """
+        Fetch a document from the http server, sending its body downstream in chunks as it arrives. See ResponseStream.
+        :param request_uri: The URI to access on the remote server
+        :param http_method: The HTTP method to use
+        :param metadata_dict: The metadata of the message that asked for the document, or None
+        :return: False if the fetch failed
+        """
+        stream_id = '{0}-{1}'.format(self.filter_name, next(self._stream_ids))
+        stream = ResponseStream(self._output_pin, stream_id, request_uri, http_method, metadata_dict, self._stream_as_bytes)
+        try:
+            use_validators = self._validator_cache is not None and http_method == 'GET'
+            headers = self._validator_cache.get_request_headers(request_uri) if use_validators else {}
+            resp = await self._http_client.fetch(request_uri, method=http_method, headers=headers, raise_error=False,
+                                                 header_callback=stream.on_header_line,
+                                                 streaming_callback=stream.on_chunk, **self._fetch_options)
+            if use_validators and resp.code == 304:
+                self._validator_cache.touch(request_uri)
+                if self._validator_cache.emit_not_modified:
+                    self._send_not_modified(request_uri, http_method, metadata_dict)
+                return True
+            resp.rethrow()
+            if use_validators:
+                self._validator_cache.update(request_uri, resp.headers, stream.mime_type)
+            stream.end()
+            return True
+        except Exception as e:
+            print('Exception: %s %s' % (e, request_uri))
+            stream.abort()
+            return False
+
+    def _start_batch(self, request_uris, metadata_dict):
+        batch_task = asyncio.ensure_future(self._fetch_batch(request_uris, metadata_dict))
+        self._batch_tasks.add(batch_task)
+        batch_task.add_done_callback(self._batch_tasks.discard)
+
+    async def _fetch_batch(self, request_uris, metadata_dict):
+        """
+        Fetch a list of documents concurrently, sending each downstream as it arrives, then send the end of batch message
+        :param request_uris: The URIs to fetch
+        :param metadata_dict: The metadata of the message that asked for the batch, or None
+        :return: None
+        """
+        batch_id = next(self._batch_ids)
+        batch_size = len(request_uris)
+        batch_slots = asyncio.Semaphore(self._max_concurrent_fetches)
+        # host -> semaphore, only used if max_fetches_per_host is set
+        host_slots = {}
+        failed_uris = []
+
+        async def fetch_one(batch_index, request_uri):
+            meta_dict = metadata_dict.copy() if metadata_dict is not None else {}
+            meta_dict[HttpClientSource.METADATA_KEY_BATCH_ID] = batch_id
+            meta_dict[HttpClientSource.METADATA_KEY_BATCH_INDEX] = batch_index
+            meta_dict[HttpClientSource.METADATA_KEY_BATCH_SIZE] = batch_size
+            if self._max_fetches_per_host > 0:
+                host = urlsplit(request_uri).netloc.lower()
+                if host not in host_slots:
+                    host_slots[host] = asyncio.Semaphore(self._max_fetches_per_host)
+                # The host slot is taken first, so fetches queued behind a busy host don't hold batch slots
+                # that fetches to other hosts could use
+                async with host_slots[host]:
+                    async with batch_slots:
+                        ok = await self._fetch_document(request_uri, 'GET', meta_dict)
+            else:
+                async with batch_slots:
+                    ok = await self._fetch_document(request_uri, 'GET', meta_dict)
+            if not ok:
+                failed_uris.append(request_uri)
+
+        await asyncio.gather(*[fetch_one(batch_index, request_uri) for batch_index, request_uri in enumerate(request_uris)])
+        meta_dict = metadata_dict.copy() if metadata_dict is not None else {}
+        meta_dict[TornadoSource.METADATA_KEY_MIME_TYPE] = MimeTypes.JSON
+        meta_dict[HttpClientSource.METADATA_KEY_BATCH_ID] = batch_id
+        meta_dict[HttpClientSource.METADATA_KEY_BATCH_SIZE] = batch_size
+        meta_dict[HttpClientSource.METADATA_KEY_BATCH_EVENT] = HttpClientSource.BATCH_EVENT_END
+        summary = {'batch_id': batch_id, 'batch_size': batch_size, 'failed_uris': failed_uris}
+        self._output_pin.send(MimeTypes.JSON, JsonPayload.from_value(summary), meta_dict)
+
+    @staticmethod
+    def parse_content_type(content_type):
+        """
+        Split a Content-Type header into the mime type and the charset
+        :param content_type: The header value, ex: text/plain; charset=iso-8859-1
+        :return: A tuple of (mime_type, charset), the charset defaults to utf-8
+        """
+        mime_type = ''
+        target_charset = 'utf-8'
+        if content_type is None:
+            return mime_type, target_charset
+        ctype = content_type.split(';')
+        if len(ctype) > 0:
+            mime_type = ctype[0].strip().lower()
+        if len(ctype) > 1:
+            charset = ctype[1]
+            chars = charset.split('=')
+            if len(chars) > 1:
+                charset_lit = chars[0].strip().lower()
+                if charset_lit == 'charset':
+                    target_charset = chars[1].strip().lower()
+        return mime_type, target_charset
+
+    @staticmethod
+    def _get_payload_uris(payload):
+        """
+        Get the list of URIs of a batch from the payload of the input message
+        :param payload: A json array, or text with one URI per line
+        :return: The list of URIs
+        """
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode('utf-8')
+        text = payload.strip()
+        if text.startswith('['):
+            # Uses the value of a JsonPayload, rather than parsing it again
+            return list(JsonPayload.decode(payload))
+        return [line.strip() for line in text.splitlines() if line.strip() != '']
+
+    async def _fetch_shared(self, request_uri, http_method):
+        """
+        Get the result of a fetch, joining an identical fetch in flight or reusing a recent result where possible
+        :param request_uri: The URI to access on the remote server
+        :param http_method: The HTTP method to use
+        :return: See _fetch_result
+        """
+        if not self._coalesce_requests or http_method not in HttpClientSource.COALESCED_METHODS:
+            return await self._fetch_result(request_uri, http_method)
+        key = (http_method, request_uri)
+        recent = self._recent_results.get(key)
+        if recent is not None:
+            if recent[0] > time.monotonic():
+                return recent[1]
+            del self._recent_results[key]
+        future = self._pending_fetches.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch_result(request_uri, http_method))
+            future.add_done_callback(partial(self._fetch_shared_done, key))
+            self._pending_fetches[key] = future
+        # Shielded, so one waiter going away doesn't cancel the fetch for the others
+        return await asyncio.shield(future)
+
+    def _fetch_shared_done(self, key, future):
+        # Already gone if the filter was stopped
+        if self._pending_fetches.get(key) is future:
+            del self._pending_fetches[key]
+        if self._coalesce_ttl_seconds <= 0 or future.cancelled() or future.exception() is not None or \
+                self.filter_state != FilterState.running:
+            return
+        now = time.monotonic()
+        # Drop the expired results here, rather than on a timer
+        self._recent_results = {k: v for k, v in self._recent_results.items() if v[0] > now}
+        self._recent_results[key] = (now + self._coalesce_ttl_seconds, future.result())
+
+    async def _fetch_result(self, request_uri, http_method):
+        """
+        Fetch a document from the http server
+        :param request_uri: The URI to access on the remote server
+        :param http_method: The HTTP method to use
+        :return: A tuple of (mime_type, charset, body), or None if the document hasn't changed since the last fetch.
+        The body is decoded to str, unless the document is application/octet-stream.
+        """
+        use_validators = self._validator_cache is not None and http_method == 'GET'
+        headers = self._validator_cache.get_request_headers(request_uri) if use_validators else {}
+        resp = await self._http_client.fetch(request_uri, method=http_method, headers=headers, raise_error=False,
+                                             **self._fetch_options)
+        if use_validators and resp.code == 304:
+            self._validator_cache.touch(request_uri)
+            return None
+        resp.rethrow()
+        mime_type, target_charset = HttpClientSource.parse_content_type(resp.headers.get('Content-Type'))
+        if use_validators:
+            self._validator_cache.update(request_uri, resp.headers, mime_type)
+        if mime_type == 'application/octet-stream':
+            return mime_type, target_charset, resp.body
+        return mime_type, target_charset, resp.body.decode(target_charset, 'ignore')
+
+    def _send_not_modified(self, request_uri, http_method, metadata_dict=None):
+        """
+        Tell the downstream filters that the document hasn't changed since it was last downloaded.
+        Only web_response_not_modified marks the event. web_response_status is left alone, since the 304 answered our
+        conditional request, not one made by the client of a TornadoSource downstream.
+        :param request_uri: The URI that was fetched
+        :param http_method: The HTTP method that was used
+        :param metadata_dict: The metadata of the message that asked for the document, or None
+        :return: None
+        """
+        meta_dict = metadata_dict.copy() if metadata_dict is not None else {}
+        meta_dict[TornadoSource.METADATA_KEY_MIME_TYPE] = self._validator_cache.get_mime_type(request_uri)
+        meta_dict[TornadoSource.METADATA_KEY_REQUEST_URI] = request_uri
+        meta_dict[TornadoSource.METADATA_KEY_REQUEST_METHOD] = http_method
+        meta_dict[HttpClientSource.METADATA_KEY_RESPONSE_NOT_MODIFIED] = True
+        self._output_pin.send(MimeTypes.TEXT, '', meta_dict)
 
     @staticmethod
     def get_filter_metadata():
@@ -101,3 +400,107 @@ class HttpClientSource(FilterBase):
     def get_filter_pad_templates():
         return FilterBase.filter_pad_templates
 
+
+class ResponseStream:
+    """
+    Sends the body of one streamed HttpClientSource response downstream, as ordered chunk messages between a start and
+    an end message. Bodies of error responses aren't streamed.
+    """
+    def __init__(self, output_pin, stream_id, request_uri, http_method, metadata_dict, as_bytes):
+        """
+        c'tor
+        :param output_pin: The pin the messages are sent on
+        :param stream_id: Identifies the messages of this stream, unique within the graph
+        :param request_uri: The URI being fetched
+        :param http_method: The HTTP method being used
+        :param metadata_dict: The metadata of the message that asked for the document, or None
+        :param as_bytes: True to send the chunks as bytes instead of decoded text
+        """
+        self._output_pin = output_pin
+        self._stream_id = stream_id
+        self._request_uri = request_uri
+        self._http_method = http_method
+        self._metadata_dict = metadata_dict
+        self._as_bytes = as_bytes
+        self._status_code = None
+        self._headers = httputil.HTTPHeaders()
+        self._mime_type = ''
+        self._charset = 'utf-8'
+        self._decoder = None
+        self._sequence = 0
+        self._started = False
+
+    @property
+    def mime_type(self):
+        return self._mime_type
+
+    def on_header_line(self, line):
+        """
+        The header_callback of the fetch, called with the status line, each header line, then a blank line
+        """
+        if line.startswith('HTTP/'):
+            # A new response, ex: the client followed a redirect
+            self._status_code = httputil.parse_response_start_line(line.strip()).code
+            self._headers = httputil.HTTPHeaders()
+        elif line.strip() != '':
+            self._headers.parse_line(line)
+        else:
+            self._mime_type, self._charset = HttpClientSource.parse_content_type(self._headers.get('Content-Type'))
+
+    def on_chunk(self, chunk):
+        """
+        The streaming_callback of the fetch, called with each block of the body as it arrives
+        """
+        if self._status_code is None or self._status_code < 200 or self._status_code >= 300:
+            return
+        if not self._started:
+            self._start()
+        if self._decoder is not None:
+            chunk = self._decoder.decode(chunk)
+            if len(chunk) == 0:
+                # Only part of a multi-byte character so far
+                return
+        self._send(TornadoSource.STREAM_EVENT_CHUNK, chunk)
+
+    def end(self):
+        """
+        Send the end message once the whole body has been received
+        :return: None
+        """
+        if not self._started:
+            # Empty body
+            self._start()
+        if self._decoder is not None:
+            tail = self._decoder.decode(b'', True)
+            if len(tail) > 0:
+                self._send(TornadoSource.STREAM_EVENT_CHUNK, tail)
+        self._send(TornadoSource.STREAM_EVENT_END, self._empty_payload())
+
+    def abort(self):
+        """
+        Send the abort message if the fetch failed after the stream was started
+        :return: None
+        """
+        if self._started:
+            self._send(TornadoSource.STREAM_EVENT_ABORT, self._empty_payload())
+
+    def _start(self):
+        self._started = True
+        if not self._as_bytes and self._mime_type != MimeTypes.BINARY:
+            self._decoder = codecs.getincrementaldecoder(self._charset)('ignore')
+        self._send(TornadoSource.STREAM_EVENT_START, self._empty_payload())
+
+    def _empty_payload(self):
+        return '' if self._decoder is not None else b''
+
+    def _send(self, stream_event, payload):
+        meta_dict = self._metadata_dict.copy() if self._metadata_dict is not None else {}
+        meta_dict[TornadoSource.METADATA_KEY_MIME_TYPE] = self._mime_type
+        meta_dict[TornadoSource.METADATA_KEY_REQUEST_URI] = self._request_uri
+        meta_dict[TornadoSource.METADATA_KEY_REQUEST_METHOD] = self._http_method
+        meta_dict[TornadoSource.METADATA_KEY_RESPONSE_CHARSET] = self._charset
+        meta_dict[TornadoSource.METADATA_KEY_STREAM_ID] = self._stream_id
+        meta_dict[TornadoSource.METADATA_KEY_STREAM_EVENT] = stream_event
+        meta_dict[TornadoSource.METADATA_KEY_STREAM_SEQUENCE] = self._sequence
+        self._sequence += 1
+        self._output_pin.send(self._mime_type, payload, meta_dict)
@@ -0,0 +1,134 @@
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    An in-memory cache of GET responses for TornadoSource, bounded by a TTL and by the total size of the cached bodies.
+    The least recently used responses are evicted first once max_bytes is reached.
+
+    Config - the response_cache block of TornadoSource, all keys optional:
+    ttl_seconds - How long a response is served from the cache
+    max_bytes - Upper bound on the total size of the cached bodies
+    vary_headers - Request headers that are part of the cache key, ex: ["Accept", "Accept-Language"]
+    cache_by_default - If false, only responses that a filter opts in with a max-age are cached
+
+    Filters control caching per response by setting web_response_cache_control in the metadata, using Cache-Control
+    syntax: no-store, no-cache or private opt out, max-age=N opts in for N seconds.
+    """
+    CONFIG_KEY_TTL_SECONDS = 'ttl_seconds'
+    CONFIG_KEY_MAX_BYTES = 'max_bytes'
+    CONFIG_KEY_VARY_HEADERS = 'vary_headers'
+    CONFIG_KEY_CACHE_BY_DEFAULT = 'cache_by_default'
+    DEFAULT_TTL_SECONDS = 1.0
+    DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+    OPT_OUT_DIRECTIVES = ('no-store', 'no-cache', 'private')
+    MAX_AGE_DIRECTIVE = 'max-age='
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES, vary_headers=None, cache_by_default=True):
+        """
+        c'tor
+        :param ttl_seconds: The default time to live of a cached response
+        :param max_bytes: Upper bound on the total size of the cached bodies
+        :param vary_headers: A list of request header names that are part of the cache key
+        :param cache_by_default: True to cache every response that isn't opted out
+        """
+        self._ttl_seconds = float(ttl_seconds)
+        self._max_bytes = int(max_bytes)
+        self._vary_headers = vary_headers if vary_headers is not None else []
+        self._cache_by_default = cache_by_default
+        # Most recently used last. Value is a tuple of (expires_at, status_code, mime_type, body, cache_control)
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+
+    @staticmethod
+    def create_from_config(cache_config):
+        """
+        Create a cache from the response_cache block of TornadoSource
+        :param cache_config: A dictionary, see the class docstring
+        :return: A ResponseCache instance
+        """
+        return ResponseCache(cache_config.get(ResponseCache.CONFIG_KEY_TTL_SECONDS, ResponseCache.DEFAULT_TTL_SECONDS),
+                             cache_config.get(ResponseCache.CONFIG_KEY_MAX_BYTES, ResponseCache.DEFAULT_MAX_BYTES),
+                             cache_config.get(ResponseCache.CONFIG_KEY_VARY_HEADERS),
+                             cache_config.get(ResponseCache.CONFIG_KEY_CACHE_BY_DEFAULT, True))
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def make_key(self, path, arguments, headers):
+        """
+        Build the cache key of a request
+        :param path: The request path
+        :param arguments: The query arguments, a dictionary mapping names to lists of values
+        :param headers: The request headers
+        :return: A hashable key
+        """
+        sorted_args = tuple((name, tuple(arguments[name])) for name in sorted(arguments.keys()))
+        vary_values = tuple(headers.get(name) for name in self._vary_headers)
+        return path, sorted_args, vary_values
+
+    def get(self, key):
+        """
+        Look up a response
+        :param key: The cache key from make_key
+        :return: A tuple of (status_code, mime_type, body, cache_control), or None if it isn't cached or has expired
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1:]
+
+    def put(self, key, status_code, mime_type, payload, cache_control=None):
+        """
+        Cache a response, unless cache_control opts it out
+        :param key: The cache key from make_key
+        :param status_code: The http status code of the response
+        :param mime_type: The mime type of the response
+        :param payload: The body of the response. Only str and bytes bodies are cached, any other payload (ex: a dict
+                        that tornado encodes as json) is skipped.
+        :param cache_control: The web_response_cache_control value set by the filters, or None
+        :return: True if the response was cached
+        """
+        if not isinstance(payload, (str, bytes, bytearray)):
+            return False
+        ttl_seconds = self._ttl_seconds if self._cache_by_default else None
+        if cache_control is not None:
+            for directive in cache_control.lower().split(','):
+                directive = directive.strip()
+                if directive in ResponseCache.OPT_OUT_DIRECTIVES:
+                    return False
+                if directive.startswith(ResponseCache.MAX_AGE_DIRECTIVE):
+                    try:
+                        ttl_seconds = float(directive[len(ResponseCache.MAX_AGE_DIRECTIVE):])
+                    except ValueError:
+                        # A malformed max-age isn't trusted
+                        return False
+        if ttl_seconds is None or ttl_seconds <= 0:
+            return False
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        body = bytes(payload)
+        if len(body) > self._max_bytes:
+            return False
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl_seconds, status_code, mime_type, body, cache_control)
+        self._total_bytes += len(body)
+        while self._total_bytes > self._max_bytes:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        self._total_bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._total_bytes -= len(entry[3])
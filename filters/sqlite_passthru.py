@@ -1,18 +1,72 @@
+import asyncio
 import json
 import re
 import datetime
+import threading
 
 import sqlite3
 
 from filters.tornado_source import TornadoSource
 from graph.filter_base import FilterBase, FilterState, FilterType
 from graph.input_pin import InputPin
+from graph.json_payload import JsonPayload
+from graph.mime_types import MimeTypes
 from graph.output_pin import OutputPin
+from storage.sqlite_database import SqliteDatabase
 
 
 class SqlitePassthru(FilterBase):
     """
     A filter that writes the payload to a sqlite database
+
+    The payload may be a single json object, a json array of objects, or newline delimited json
+    (application/x-ndjson). All of the records in a payload are written in a single transaction, and the table schema
+    is extended once with the union of their columns.
+
+    Batching mode:
+    When batch_max_rows is greater than 1, rows are buffered per table and column set and written with executemany
+    inside a single transaction. The buffers are flushed when batch_max_rows rows are pending, when the oldest pending
+    row is batch_max_latency_ms old, or when the filter is stopped.
+
+    Upsert mode:
+    When upsert is true, rows that collide on a unique column are updated in place with
+    INSERT ... ON CONFLICT(col) DO UPDATE, instead of being deleted and re-inserted by INSERT OR REPLACE.
+    Only the columns present in the payload are updated, and rows whose values are unchanged are not written at all.
+    A row can only name one conflict target, so when a row has more than one unique column it falls back to
+    INSERT OR REPLACE, which resolves a collision on any of them.
+
+    Secondary indexes:
+    secondary_indexes maps a table name (or * for every table) to a list of column lists. Each index is created
+    as soon as the table has all of its columns.
+
+    Tuning:
+    The sqlite_tuning block (journal_mode, synchronous, cache_size, mmap_size, temp_store, busy_timeout) is applied
+    to the writer connection when the filter runs. See SqliteDatabase.
+
+    Retention:
+    retention maps a table name (or * for every table this filter writes to) to a rule with max_age_seconds
+    (based on rosetta_timestamp, so insert_timestamp must be on) and / or max_rows. Every retention_interval_seconds
+    a background task on the event loop deletes expired rows in batches of retention_batch_size, committing and
+    yielding to the loop between batches so ingest is never blocked for long. An index on rosetta_timestamp
+    (see secondary_indexes) keeps the age based deletes cheap.
+    If the tuning block sets auto_vacuum to INCREMENTAL, the freed pages are then returned to the file system
+    vacuum_pages_per_step pages at a time.
+
+    Document mode:
+    Normally only top level int, float and str values are stored, one column each. When json_document_column is set,
+    each record is instead stored whole, as json text, in that column. json_paths maps column names to json paths
+    (ex: "patient": "$.subject.reference"); each becomes a virtual generated column extracted from the document, with
+    an index on it (a unique index if the column is listed in unique_columns). Lookups on nested fields then use the
+    index instead of decoding every document.
+
+    Streamed payloads:
+    Payloads streamed by TornadoSource or HttpClientSource (stream_event in the metadata) are buffered per stream_id.
+    Newline delimited json is written as each chunk completes a line, so a stream is never held in memory whole; other
+    payloads are written when the stream ends. An aborted stream discards what is buffered.
+
+    Threading:
+    The filter may be run on a thread executor ("executor": "thread" in the graph config) to keep its blocking db
+    writes off the event loop. All use of the writer connection is serialized by a lock, so one worker is enough.
     """
     filter_pad_templates = {}
     filter_meta = {}
@@ -20,37 +74,127 @@ class SqlitePassthru(FilterBase):
     CONFIG_KEY_INSERT_TIMESTAMP_FLAG = 'insert_timestamp'
     CONFIG_KEY_UNIQUE_COLUMNS = 'unique_columns'
     CONFIG_KEY_DB_FILENAME = 'db_filename'
+    CONFIG_KEY_BATCH_MAX_ROWS = 'batch_max_rows'
+    CONFIG_KEY_BATCH_MAX_LATENCY_MS = 'batch_max_latency_ms'
+    CONFIG_KEY_UPSERT = 'upsert'
+    CONFIG_KEY_SECONDARY_INDEXES = 'secondary_indexes'
+    CONFIG_KEY_RETENTION = 'retention'
+    CONFIG_KEY_RETENTION_INTERVAL_SECONDS = 'retention_interval_seconds'
+    CONFIG_KEY_RETENTION_BATCH_SIZE = 'retention_batch_size'
+    CONFIG_KEY_VACUUM_PAGES_PER_STEP = 'vacuum_pages_per_step'
+    CONFIG_KEY_JSON_DOCUMENT_COLUMN = 'json_document_column'
+    CONFIG_KEY_JSON_PATHS = 'json_paths'
+    GENERATED_COLUMN_TYPE = 'GENERATED'
+    RETENTION_KEY_MAX_AGE_SECONDS = 'max_age_seconds'
+    RETENTION_KEY_MAX_ROWS = 'max_rows'
+    TIMESTAMP_COLUMN = 'rosetta_timestamp'
+    ID_COLUMN = '_id'
+    DEFAULT_BATCH_MAX_LATENCY_MS = 100
+    DEFAULT_RETENTION_INTERVAL_SECONDS = 60.0
+    DEFAULT_RETENTION_BATCH_SIZE = 1000
+    DEFAULT_VACUUM_PAGES_PER_STEP = 100
+    # Upper bound on the number of distinct insert statements kept in the statement cache
+    MAX_CACHED_STATEMENTS = 256
 
     def __init__(self, name, config_dict, graph_manager):
         super().__init__(name, config_dict, graph_manager, FilterType.sink)
         self._table_name_re = config_dict.get(SqlitePassthru.CONFIG_KEY_TABLE_NAME_REGULAR_EXPRESSION)
         self._table_name = config_dict.get(TornadoSource.METADATA_KEY_DB_TABLE_NAME)
+        self._table_name_literal = self._table_name
         self._insert_timestamp_flag = config_dict[SqlitePassthru.CONFIG_KEY_INSERT_TIMESTAMP_FLAG]
         self._unique_columns = config_dict.get(SqlitePassthru.CONFIG_KEY_UNIQUE_COLUMNS)
+        if self._unique_columns is None:
+            self._unique_columns = []
         self._db_filename = config_dict.get(SqlitePassthru.CONFIG_KEY_DB_FILENAME)
+        self._database = SqliteDatabase(self._db_filename, config_dict.get(SqliteDatabase.CONFIG_KEY_TUNING))
+        self._upsert_flag = config_dict.get(SqlitePassthru.CONFIG_KEY_UPSERT, False)
+        self._secondary_indexes = config_dict.get(SqlitePassthru.CONFIG_KEY_SECONDARY_INDEXES)
+        if self._secondary_indexes is None:
+            self._secondary_indexes = {}
         mime_type_map = {}
-        mime_type_map['application/json'] = self.recv
+        mime_type_map[MimeTypes.JSON] = self.recv
+        mime_type_map[MimeTypes.NDJSON] = self.recv
         ipin = InputPin('input', mime_type_map, self)
         self._add_input_pin(ipin)
         self._output_pin = OutputPin('output', False)
         self._add_output_pin(self._output_pin)
-        # The names of valid columns go here
-        self._valid_cols = []
+        # Schema cache, keyed by table name. Value maps each known column name to its sqlite type.
+        self._table_schemas = {}
+        # Insert statement cache, keyed by (table_name, column tuple)
+        self._insert_stmts = {}
+        # Names of the secondary indexes that are known to exist
+        self._created_indexes = set()
+        # Batching - disabled unless batch_max_rows is greater than 1
+        self._batch_max_rows = config_dict.get(SqlitePassthru.CONFIG_KEY_BATCH_MAX_ROWS)
+        if self._batch_max_rows is None:
+            self._batch_max_rows = 1
+        self._batch_max_rows = int(self._batch_max_rows)
+        batch_max_latency_ms = config_dict.get(SqlitePassthru.CONFIG_KEY_BATCH_MAX_LATENCY_MS)
+        if batch_max_latency_ms is None:
+            batch_max_latency_ms = SqlitePassthru.DEFAULT_BATCH_MAX_LATENCY_MS
+        self._batch_max_latency_seconds = float(batch_max_latency_ms) / 1000.0
+        # Pending rows, keyed by (table_name, column tuple). Value is a list of value lists.
+        self._batch_buffers = {}
+        self._batch_row_count = 0
+        self._batch_flush_handle = None
+        # Retention
+        self._retention_rules = config_dict.get(SqlitePassthru.CONFIG_KEY_RETENTION)
+        if self._retention_rules is None:
+            self._retention_rules = {}
+        self._retention_interval_seconds = float(config_dict.get(SqlitePassthru.CONFIG_KEY_RETENTION_INTERVAL_SECONDS,
+                                                                 SqlitePassthru.DEFAULT_RETENTION_INTERVAL_SECONDS))
+        self._retention_batch_size = int(config_dict.get(SqlitePassthru.CONFIG_KEY_RETENTION_BATCH_SIZE,
+                                                         SqlitePassthru.DEFAULT_RETENTION_BATCH_SIZE))
+        self._vacuum_pages_per_step = int(config_dict.get(SqlitePassthru.CONFIG_KEY_VACUUM_PAGES_PER_STEP,
+                                                          SqlitePassthru.DEFAULT_VACUUM_PAGES_PER_STEP))
+        self._retention_task = None
+        # Document mode
+        self._json_document_column = config_dict.get(SqlitePassthru.CONFIG_KEY_JSON_DOCUMENT_COLUMN)
+        self._json_paths = config_dict.get(SqlitePassthru.CONFIG_KEY_JSON_PATHS)
+        if self._json_paths is None:
+            self._json_paths = {}
+        # Partial bodies of streamed payloads, keyed by handler id
+        self._streams = {}
+        # Guards the writer connection, and the table name, caches and buffers that go with it
+        self._db_lock = threading.RLock()
+        self._loop = None
 
     def run(self):
         super().run()
-        self._db_conn = sqlite3.connect(self._db_filename)
+        self._loop = asyncio.get_event_loop()
+        # May be used from executor threads as well as the loop, access is serialized by _db_lock
+        self._db_conn = self._database.open_writer(cached_statements=SqlitePassthru.MAX_CACHED_STATEMENTS,
+                                                   check_same_thread=False)
+        # The schema may have been changed by someone else while we were stopped
+        self._table_schemas = {}
+        self._insert_stmts = {}
+        self._created_indexes = set()
         self._set_filter_state(FilterState.running)
 
+    def graph_is_running(self):
+        super().graph_is_running()
+        if len(self._retention_rules) > 0 or self._database.is_incremental_vacuum:
+            self._retention_task = asyncio.ensure_future(self._run_retention())
+
     def stop(self):
         super().stop()
-        self._db_conn.close()
-        self._db_conn = None
+        if self._retention_task is not None:
+            self._retention_task.cancel()
+            self._retention_task = None
+        with self._db_lock:
+            self._flush_batches()
+            self._db_conn.close()
+            self._db_conn = None
         self._set_filter_state(FilterState.stopped)
 
     def recv(self, mime_type, payload, metadata_dict):
-        if self._should_process_payload(metadata_dict):
-            self._process_payload(payload, metadata_dict)
+        stream_event = metadata_dict.get(TornadoSource.METADATA_KEY_STREAM_EVENT)
+        with self._db_lock:
+            if self._should_process_payload(metadata_dict):
+                if stream_event is None:
+                    self._process_payload(mime_type, payload, metadata_dict)
+                else:
+                    self._process_stream_event(stream_event, mime_type, payload, metadata_dict)
         # This is a passthru filter so we need to pass the payload through
         if self.filter_state == FilterState.running:
             self._output_pin.send(mime_type, payload, metadata_dict)
@@ -79,97 +223,475 @@ class SqlitePassthru(FilterBase):
                 return True
         return False
 
-    def _process_payload(self, payload, metadata_dict):
+    def _process_payload(self, mime_type, payload, metadata_dict):
         """
-        Save a row to the database, creating the table first if necessary
-        :param payload: The json payload to insert
+        Save the records in the payload to the database, creating or extending the table first if necessary
+        :param mime_type: The mime_type of the payload
+        :param payload: The json or ndjson payload to insert
         :param metadata_dict: The metadata dictionary passed from the upstream filter
-        :return: True if the row was saved, false if not
+        :return: True if the rows were saved, false if not
         """
-        pay_dict = json.loads(payload)
-        self._create_table(pay_dict, self._table_name)
-        ok = self._save_row(pay_dict, self._table_name)
+        records = SqlitePassthru._parse_records(mime_type, payload)
+        if len(records) == 0:
+            return False
+        if self._json_document_column is not None:
+            records = [{self._json_document_column: json.dumps(record)} for record in records]
+        # Unify the schema across the batch, the first typed value seen for each key decides its column type
+        union_dict = {}
+        for record in records:
+            for key, value in record.items():
+                if key not in union_dict and SqlitePassthru._sql_type(value) is not None:
+                    union_dict[key] = value
+        self._create_table(union_dict, self._table_name)
+        ok = self._save_rows(records, self._table_name)
         return ok
 
+    def _process_stream_event(self, stream_event, mime_type, payload, metadata_dict):
+        """
+        Buffer a message of a streamed payload, saving whatever records are complete
+        :param stream_event: start, chunk, end or abort
+        :param mime_type: The mime_type of the payload
+        :param payload: The chunk of the payload, empty except for chunk events
+        :param metadata_dict: The metadata dictionary passed from the upstream filter
+        :return: None
+        """
+        stream_id = metadata_dict.get(TornadoSource.METADATA_KEY_STREAM_ID)
+        if stream_event == TornadoSource.STREAM_EVENT_START:
+            self._streams[stream_id] = bytearray()
+            return
+        buffered = self._streams.get(stream_id)
+        if buffered is None:
+            # The start of the stream was missed, ex: it began before this filter was running
+            return
+        if stream_event == TornadoSource.STREAM_EVENT_CHUNK:
+            if isinstance(payload, str):
+                payload = payload.encode('utf-8')
+            buffered += payload
+            if mime_type == MimeTypes.NDJSON:
+                cut = buffered.rfind(b'\n')
+                if cut >= 0:
+                    complete_lines = bytes(buffered[:cut + 1])
+                    del buffered[:cut + 1]
+                    self._process_payload(mime_type, complete_lines, metadata_dict)
+        elif stream_event == TornadoSource.STREAM_EVENT_END:
+            del self._streams[stream_id]
+            if len(buffered.strip()) > 0:
+                self._process_payload(mime_type, bytes(buffered), metadata_dict)
+        else:
+            del self._streams[stream_id]
+
+    @staticmethod
+    def _parse_records(mime_type, payload):
+        """
+        Parse a payload into a list of records
+        :param mime_type: The mime_type of the payload
+        :param payload: A json object, a json array of objects or newline delimited json objects
+        :return: A list of dictionaries
+        """
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode('utf-8')
+        if isinstance(payload, JsonPayload):
+            parsed = payload.value
+        elif mime_type == MimeTypes.NDJSON:
+            parsed = [json.loads(line) for line in payload.splitlines() if len(line.strip()) > 0]
+        else:
+            parsed = json.loads(payload)
+        if isinstance(parsed, dict):
+            return [parsed]
+        for record in parsed:
+            if not isinstance(record, dict):
+                raise ValueError('Expected a json object but found {0}'.format(type(record).__name__))
+        return parsed
+
     def _create_table(self, payload_dict, table_name):
         """
-        Create a table in the sqlite db if necessary, with the appropriate columns
+        Create a table in the sqlite db if necessary, with the appropriate columns.
+        The schema of each table is cached, so DDL is only issued the first time a table or a column is seen.
         :param payload_dict: The payload dictionary to use for column names
         :param table_name: The name of the table to create
         :return: None
         """
+        schema_changed = False
+        schema = self._table_schemas.get(table_name)
+        if schema is None:
+            schema = self._load_table_schema(payload_dict, table_name)
+            self._table_schemas[table_name] = schema
+            schema_changed = True
+        for key, value in payload_dict.items():
+            if key not in schema:
+                typestr = SqlitePassthru._sql_type(value)
+                if typestr is not None:
+                    self._add_column(table_name, key, typestr)
+                    schema[key] = typestr
+                    schema_changed = True
+        if schema_changed:
+            self._create_json_path_columns(table_name, schema)
+            self._create_secondary_indexes(table_name, schema)
+
+    def _load_table_schema(self, payload_dict, table_name):
+        """
+        Create the table if it doesn't exist and read back its columns
+        :param payload_dict: The payload dictionary to use for the initial column names
+        :param table_name: The name of the table to create
+        :return: A dictionary mapping column names to sqlite types
+        """
         sql_stmt = "CREATE TABLE IF NOT EXISTS {0} (_id INTEGER PRIMARY KEY".format(table_name)
         if self._insert_timestamp_flag:
-            sql_stmt += ", {0} {1}".format('rosetta_timestamp', 'TEXT')
+            sql_stmt += ", {0} {1}".format(SqlitePassthru.TIMESTAMP_COLUMN, 'TEXT')
         for key, value in payload_dict.items():
-            typestr = None
-            if type(value) is int:
-                typestr = 'INTEGER'
-            elif type(value) is float:
-                typestr = 'REAL'
-            elif type(value) is str:
-                typestr = 'TEXT'
+            if key == SqlitePassthru.ID_COLUMN or (self._insert_timestamp_flag and key == SqlitePassthru.TIMESTAMP_COLUMN):
+                # Already declared above, ex: when replicating rows read by SqliteSource
+                continue
+            typestr = SqlitePassthru._sql_type(value)
             if typestr is not None:
                 sql_stmt += ", {0} {1}".format(key, typestr)
-                self._valid_cols.append(key)
-            if key in self._unique_columns:
-                sql_stmt += " UNIQUE"
+                if key in self._unique_columns:
+                    sql_stmt += " UNIQUE"
         sql_stmt += ")"
         #
         cur = self._db_conn.cursor()
         cur.execute(sql_stmt)
         self._db_conn.commit()
+        schema = {}
+        for row in cur.execute("PRAGMA table_xinfo({0})".format(table_name)):
+            # row is (cid, name, type, notnull, dflt_value, pk, hidden) - hidden is 2 or 3 for generated columns
+            if row[6] in (2, 3):
+                schema[row[1]] = SqlitePassthru.GENERATED_COLUMN_TYPE
+            else:
+                schema[row[1]] = row[2]
+        return schema
 
-    def _save_row(self, payload_dict, table_name):
+    def _add_column(self, table_name, col_name, typestr):
         """
-        Save row in the database, by doing an upsert.
-        :param payload_dict: The payload dictionary to use for column names and values
+        Add a new column to an existing table.
+        sqlite can't add a UNIQUE column with ALTER TABLE, so unique columns get a unique index instead.
+        :param table_name: The name of the table to alter
+        :param col_name: The name of the new column
+        :param typestr: The sqlite type of the new column
+        :return: None
+        """
+        cur = self._db_conn.cursor()
+        cur.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(table_name, col_name, typestr))
+        if col_name in self._unique_columns:
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS {0}_{1}_unique ON {0} ({1})".format(table_name, col_name))
+        self._db_conn.commit()
+
+    def _create_json_path_columns(self, table_name, schema):
+        """
+        In document mode, add a generated column and an index for each configured json path
+        :param table_name: The name of the table
+        :param schema: The cached schema of the table
+        :return: None
+        """
+        if self._json_document_column is None:
+            return
+        cur = self._db_conn.cursor()
+        for col_name, json_path in self._json_paths.items():
+            if col_name not in schema:
+                cur.execute("ALTER TABLE {0} ADD COLUMN {1} GENERATED ALWAYS AS (json_extract({2}, '{3}')) VIRTUAL".format(
+                    table_name, col_name, self._json_document_column, json_path.replace("'", "''")))
+                schema[col_name] = SqlitePassthru.GENERATED_COLUMN_TYPE
+            if col_name in self._unique_columns:
+                index_name = "{0}_{1}_unique".format(table_name, col_name)
+                index_stmt = "CREATE UNIQUE INDEX IF NOT EXISTS {0} ON {1} ({2})"
+            else:
+                index_name = "{0}_{1}_idx".format(table_name, col_name)
+                index_stmt = "CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})"
+            if index_name not in self._created_indexes:
+                cur.execute(index_stmt.format(index_name, table_name, col_name))
+                self._created_indexes.add(index_name)
+        self._db_conn.commit()
+
+    def _create_secondary_indexes(self, table_name, schema):
+        """
+        Create the configured secondary indexes for a table, once all of the indexed columns exist
+        :param table_name: The name of the table to index
+        :param schema: The cached schema of the table
+        :return: None
+        """
+        index_list = self._secondary_indexes.get(table_name, []) + self._secondary_indexes.get('*', [])
+        cur = self._db_conn.cursor()
+        for index_cols in index_list:
+            if isinstance(index_cols, str):
+                index_cols = [index_cols]
+            index_name = "{0}_{1}_idx".format(table_name, "_".join(index_cols))
+            if index_name in self._created_indexes:
+                continue
+            if all(col in schema for col in index_cols):
+                cur.execute("CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(index_name, table_name, ", ".join(index_cols)))
+                self._created_indexes.add(index_name)
+        self._db_conn.commit()
+
+    def _save_rows(self, records, table_name):
+        """
+        Save rows in the database, in a single transaction.
+        In batching mode the rows are buffered and written by the next flush.
+        :param records: A list of payload dictionaries to use for column names and values
         :param table_name: The name of the table to insert to
-        :return: True if saved, false if not
+        :return: True if saved (or queued), false if not
         """
-        cols = []
+        # Group the rows by column signature, so each group can be written with a single executemany
+        grouped_rows = {}
+        timestamp = None
         if self._insert_timestamp_flag:
-            cols.append('rosetta_timestamp')
-        for key in self._valid_cols:
-            cols.append(key)
-        #
-        sql_stmt = "INSERT OR REPLACE INTO {0} (".format(table_name)
-        ix = 0
-        for col in cols:
-            if ix > 0:
-                sql_stmt += ", "
-            sql_stmt += col
-            ix += 1
-        sql_stmt += ") VALUES ("
-        val_array = []
-        ix = 0
-        if self._insert_timestamp_flag:
-            now = datetime.datetime.utcnow()
-            iso = now.isoformat()
-            val_array.append(iso)
-            sql_stmt += "?"
-            ix += 1
-        for key in self._valid_cols:
-            value = payload_dict[key]
-            typestr = None
-            if type(value) is int:
-                typestr = 'INTEGER'
-            elif type(value) is float:
-                typestr = 'REAL'
-            elif type(value) is str:
-                typestr = 'TEXT'
-            if typestr is not None:
-                val_array.append(value)
-                if ix > 0:
-                    sql_stmt += ", "
-                sql_stmt += "?"
-                ix += 1
-        sql_stmt += ")"
+            timestamp = datetime.datetime.utcnow().isoformat()
+        for payload_dict in records:
+            cols = []
+            val_array = []
+            if timestamp is not None:
+                cols.append(SqlitePassthru.TIMESTAMP_COLUMN)
+                val_array.append(timestamp)
+            for key, value in payload_dict.items():
+                if timestamp is not None and key == SqlitePassthru.TIMESTAMP_COLUMN:
+                    continue
+                if SqlitePassthru._sql_type(value) is not None:
+                    cols.append(key)
+                    val_array.append(value)
+            cols = tuple(cols)
+            rows = grouped_rows.get(cols)
+            if rows is None:
+                rows = []
+                grouped_rows[cols] = rows
+            rows.append(val_array)
         #
+        if self._batch_max_rows > 1:
+            self._queue_rows(table_name, grouped_rows)
+        else:
+            cur = self._db_conn.cursor()
+            try:
+                for cols, rows in grouped_rows.items():
+                    cur.executemany(self._get_insert_stmt(table_name, cols), rows)
+                self._db_conn.commit()
+            except sqlite3.Error:
+                self._db_conn.rollback()
+                raise
+        return True
+
+    def _queue_rows(self, table_name, grouped_rows):
+        """
+        Add rows to the batch buffers, flushing if the buffers are full or scheduling a latency flush otherwise
+        :param table_name: The name of the table to insert to
+        :param grouped_rows: A dictionary mapping a tuple of column names to a list of value lists
+        :return: None
+        """
+        for cols, new_rows in grouped_rows.items():
+            batch_key = (table_name, cols)
+            rows = self._batch_buffers.get(batch_key)
+            if rows is None:
+                rows = []
+                self._batch_buffers[batch_key] = rows
+            rows.extend(new_rows)
+            self._batch_row_count += len(new_rows)
+        if self._batch_row_count >= self._batch_max_rows:
+            self._flush_batches()
+        elif self._batch_flush_handle is None:
+            # This may be running on an executor thread, so the timer is armed from the loop
+            self._batch_flush_handle = self._loop.call_soon_threadsafe(self._arm_batch_flush)
+
+    def _arm_batch_flush(self):
+        """
+        Start the latency timer for the pending rows, unless they were flushed in the meantime
+        :return: None
+        """
+        with self._db_lock:
+            if self._batch_flush_handle is not None:
+                self._batch_flush_handle = self._loop.call_later(self._batch_max_latency_seconds, self._locked_flush_batches)
+
+    def _locked_flush_batches(self):
+        """
+        Flush the batch buffers from the latency timer
+        :return: None
+        """
+        with self._db_lock:
+            self._flush_batches()
+
+    def _flush_batches(self):
+        """
+        Write all pending rows with executemany, inside a single transaction
+        :return: None
+        """
+        if self._batch_flush_handle is not None:
+            self._batch_flush_handle.cancel()
+            self._batch_flush_handle = None
+        if self._batch_row_count == 0:
+            return
+        batches = self._batch_buffers
+        self._batch_buffers = {}
+        self._batch_row_count = 0
         cur = self._db_conn.cursor()
-        cur.execute(sql_stmt, val_array)
+        try:
+            for (table_name, cols), rows in batches.items():
+                cur.executemany(self._get_insert_stmt(table_name, cols), rows)
+            self._db_conn.commit()
+        except sqlite3.Error as e:
+            self._db_conn.rollback()
+            print('{0} could not flush batch, writing it row by row: {1}'.format(self.filter_name, e))
+            self._write_rows_individually(batches)
+
+    def _write_rows_individually(self, batches):
+        """
+        Write the rows of a batch that failed one at a time, so a bad row only loses itself
+        :param batches: A dictionary mapping (table_name, column tuple) to a list of value lists
+        :return: The number of rows that could not be written
+        """
+        failed_count = 0
+        cur = self._db_conn.cursor()
+        for (table_name, cols), rows in batches.items():
+            sql_stmt = self._get_insert_stmt(table_name, cols)
+            for row in rows:
+                try:
+                    cur.execute(sql_stmt, row)
+                except sqlite3.Error as e:
+                    # A failed statement is undone on its own, the rest of the transaction is kept
+                    failed_count += 1
+                    print('{0} could not write row {1} to {2}: {3}'.format(self.filter_name, row, table_name, e))
         self._db_conn.commit()
-        return True
+        return failed_count
+
+    def _get_insert_stmt(self, table_name, cols):
+        """
+        Get the insert statement for the given table and column signature, building and caching it if necessary.
+        Reusing the same sql string also lets the sqlite3 module reuse its prepared statement.
+        :param table_name: The name of the table to insert to
+        :param cols: A tuple of the column names to insert
+        :return: The sql statement, with ? placeholders for the values
+        """
+        stmt_key = (table_name, cols)
+        sql_stmt = self._insert_stmts.get(stmt_key)
+        if sql_stmt is None:
+            if len(self._insert_stmts) >= SqlitePassthru.MAX_CACHED_STATEMENTS:
+                self._insert_stmts.clear()
+            if self._upsert_flag:
+                sql_stmt = self._build_upsert_stmt(table_name, cols)
+            else:
+                sql_stmt = "INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})".format(table_name, ", ".join(cols), ", ".join("?" * len(cols)))
+            self._insert_stmts[stmt_key] = sql_stmt
+        return sql_stmt
+
+    def _build_upsert_stmt(self, table_name, cols):
+        """
+        Build an INSERT ... ON CONFLICT DO UPDATE statement.
+        The update only sets the columns that were supplied, and is skipped entirely when none of the data columns
+        changed, so unchanged rows and their indexes aren't rewritten.
+        :param table_name: The name of the table to insert to
+        :param cols: A tuple of the column names to insert
+        :return: The sql statement, with ? placeholders for the values
+        """
+        # In document mode the unique columns are usually generated from the document
+        conflict_cols = [col for col in list(cols) + list(self._json_paths.keys()) if col in self._unique_columns]
+        if len(conflict_cols) > 1:
+            # ON CONFLICT(col) only resolves a collision on that column, any other one would raise IntegrityError
+            return "INSERT OR REPLACE INTO {0} ({1}) VALUES ({2})".format(table_name, ", ".join(cols), ", ".join("?" * len(cols)))
+        sql_stmt = "INSERT INTO {0} ({1}) VALUES ({2})".format(table_name, ", ".join(cols), ", ".join("?" * len(cols)))
+        if len(conflict_cols) == 0:
+            return sql_stmt
+        conflict_col = conflict_cols[0]
+        update_cols = [col for col in cols if col != conflict_col]
+        data_cols = [col for col in update_cols if col != SqlitePassthru.TIMESTAMP_COLUMN]
+        if len(data_cols) == 0:
+            sql_stmt += " ON CONFLICT({0}) DO NOTHING".format(conflict_col)
+        else:
+            set_clause = ", ".join("{0} = excluded.{0}".format(col) for col in update_cols)
+            where_clause = " OR ".join("{0}.{1} IS NOT excluded.{1}".format(table_name, col) for col in data_cols)
+            sql_stmt += " ON CONFLICT({0}) DO UPDATE SET {1} WHERE {2}".format(conflict_col, set_clause, where_clause)
+        return sql_stmt
+
+    async def _run_retention(self):
+        """
+        Background task that periodically applies the retention rules and reclaims the freed pages
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(self._retention_interval_seconds)
+            try:
+                await self._apply_retention()
+                if self._database.is_incremental_vacuum:
+                    await self._incremental_vacuum()
+            except sqlite3.Error as e:
+                print('{0} retention failed: {1}'.format(self.filter_name, e))
+
+    async def _apply_retention(self):
+        """
+        Delete the rows that have expired according to the retention rules
+        :return: None
+        """
+        with self._db_lock:
+            cur = self._db_conn.cursor()
+            table_names = [row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table_name in table_names:
+            rule = self._retention_rules.get(table_name)
+            if rule is None and self._is_own_table(table_name):
+                rule = self._retention_rules.get('*')
+            if rule is None:
+                continue
+            max_age_seconds = rule.get(SqlitePassthru.RETENTION_KEY_MAX_AGE_SECONDS)
+            if max_age_seconds is not None:
+                cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age_seconds)
+                where = "{0} < ?".format(SqlitePassthru.TIMESTAMP_COLUMN)
+                await self._delete_in_batches(table_name, where, cutoff.isoformat())
+            max_rows = rule.get(SqlitePassthru.RETENTION_KEY_MAX_ROWS)
+            if max_rows is not None:
+                with self._db_lock:
+                    row = cur.execute("SELECT _id FROM {0} ORDER BY _id DESC LIMIT 1 OFFSET ?".format(table_name), (int(max_rows),)).fetchone()
+                if row is not None:
+                    await self._delete_in_batches(table_name, "_id <= ?", row[0])
+
+    async def _delete_in_batches(self, table_name, where, param):
+        """
+        Delete the matching rows, oldest first, committing and yielding to the event loop after each batch
+        :param table_name: The table to delete from
+        :param where: The where clause selecting the rows to delete, with a single ? placeholder
+        :param param: The value for the placeholder
+        :return: None
+        """
+        sql_stmt = "DELETE FROM {0} WHERE _id IN (SELECT _id FROM {0} WHERE {1} ORDER BY _id LIMIT ?)".format(table_name, where)
+        while self.filter_state == FilterState.running:
+            with self._db_lock:
+                cur = self._db_conn.execute(sql_stmt, (param, self._retention_batch_size))
+                self._db_conn.commit()
+            if cur.rowcount < self._retention_batch_size:
+                break
+            await asyncio.sleep(0)
+
+    async def _incremental_vacuum(self):
+        """
+        Return the free pages to the file system, a few pages at a time
+        :return: None
+        """
+        while self.filter_state == FilterState.running:
+            with self._db_lock:
+                free_pages = self._db_conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if free_pages == 0:
+                    break
+                # The pragma frees one page per result row, so the rows must be fetched for it to complete
+                self._db_conn.execute("PRAGMA incremental_vacuum({0})".format(self._vacuum_pages_per_step)).fetchall()
+            await asyncio.sleep(0)
+
+    def _is_own_table(self, table_name):
+        """
+        Check if this filter writes to the given table
+        :param table_name: The name of the table
+        :return: True if the table is the configured literal or matches the table_name regular expression
+        """
+        if table_name == self._table_name_literal:
+            return True
+        return self._table_name_re is not None and re.match(self._table_name_re, table_name) is not None
+
+    @staticmethod
+    def _sql_type(value):
+        """
+        Map a json value to a sqlite column type
+        :param value: The value to map
+        :return: The sqlite type name or None if the value cannot be stored in a column
+        """
+        typestr = None
+        if type(value) is int:
+            typestr = 'INTEGER'
+        elif type(value) is float:
+            typestr = 'REAL'
+        elif type(value) is str:
+            typestr = 'TEXT'
+        return typestr
 
     @staticmethod
     def get_filter_metadata():
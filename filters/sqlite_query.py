@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+import re
+import sqlite3
+
+from filters.tornado_source import TornadoSource
+from graph.filter_base import FilterBase, FilterState, FilterType
+from graph.input_pin import InputPin
+from graph.json_payload import JsonPayload
+from graph.output_pin import OutputPin
+from storage.sqlite_database import SqliteDatabase
+
+
+class SqliteQuery(FilterBase):
+    """
+    A filter that answers a GET on /db/table_name with rows from a sqlite table, typically one written by SqlitePassthru.
+
+    The payload is the json object of query arguments produced by TornadoSource for a GET:
+    col=val - Only return rows where col equals val. Columns are checked against the table schema.
+    limit - The maximum number of rows to return, capped by max_limit
+    after - Keyset pagination cursor, only rows with an _id greater than this are returned
+
+    Rows are read in _id order, so pagination never re-scans earlier pages. Declaring secondary_indexes on the
+    filtered columns in SqlitePassthru lets sqlite satisfy col = ? AND _id > ? ORDER BY _id from the index alone.
+
+    The response is a json object: { "rows": [...], "next_after": <_id of the last row, or null on the last page> }
+    The query runs on executor threads, and the response is sent in chunks of rows with web_response_partial set,
+    followed by a final message that closes the object. A bad query argument, a sqlite error or a table without an
+    _id column is answered 400, a missing db file or table 404. If the filter stops part way through, the object is
+    closed with next_after set to the last row sent, so the client can carry on from there; if no rows were sent yet,
+    the request is answered 503.
+
+    The table name in the path must match table_name_re as a whole, and be a plain sql identifier, since it is
+    formatted into the query.
+
+    Input Pins:
+    input - Accepts application/json, usually from a TornadoSource GET output pin.
+
+    Output Pins:
+    output - Required - The json response, usually connected back to a TornadoSource input pin.
+    """
+    filter_pad_templates = {}
+    filter_meta = {}
+    CONFIG_KEY_TABLE_NAME_REGULAR_EXPRESSION = 'table_name_re'
+    CONFIG_KEY_DEFAULT_LIMIT = 'default_limit'
+    CONFIG_KEY_MAX_LIMIT = 'max_limit'
+    QUERY_ARG_LIMIT = 'limit'
+    QUERY_ARG_AFTER = 'after'
+    ID_COLUMN = '_id'
+    # Table names are formatted into the sql, so only plain identifiers are accepted
+    TABLE_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+    DEFAULT_LIMIT = 100
+    DEFAULT_MAX_LIMIT = 1000
+    FETCH_CHUNK_SIZE = 256
+
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager, FilterType.transform)
+        self._table_name_re = config_dict.get(SqliteQuery.CONFIG_KEY_TABLE_NAME_REGULAR_EXPRESSION)
+        self._table_name = config_dict.get(TornadoSource.METADATA_KEY_DB_TABLE_NAME)
+        if self._table_name is not None and not SqliteQuery.TABLE_NAME_PATTERN.match(self._table_name):
+            raise ValueError('{0} is not a valid table name'.format(self._table_name))
+        self._default_limit = int(config_dict.get(SqliteQuery.CONFIG_KEY_DEFAULT_LIMIT, SqliteQuery.DEFAULT_LIMIT))
+        self._max_limit = int(config_dict.get(SqliteQuery.CONFIG_KEY_MAX_LIMIT, SqliteQuery.DEFAULT_MAX_LIMIT))
+        reader_pool_size = config_dict.get(SqliteDatabase.CONFIG_KEY_READER_POOL_SIZE)
+        if reader_pool_size is None:
+            # Reads always go through the pool, so this filter needs at least one connection
+            reader_pool_size = 1
+        self._database = SqliteDatabase(config_dict[SqliteDatabase.CONFIG_KEY_DB_FILENAME],
+                                        config_dict.get(SqliteDatabase.CONFIG_KEY_TUNING), reader_pool_size)
+        # Column names, keyed by table name
+        self._table_columns = {}
+        mime_type_map = {}
+        mime_type_map['application/json'] = self.recv
+        ipin = InputPin('input', mime_type_map, self)
+        self._add_input_pin(ipin)
+        self._output_pin = OutputPin('output', True)
+        self._add_output_pin(self._output_pin)
+
+    def run(self):
+        super().run()
+        self._table_columns = {}
+        self._set_filter_state(FilterState.running)
+
+    def stop(self):
+        super().stop()
+        self._database.close_readers()
+        self._set_filter_state(FilterState.stopped)
+
+    def recv(self, mime_type, payload, metadata_dict):
+        if self.filter_state != FilterState.running:
+            raise RuntimeError('{0} tried to process input while filter state is {1}'.format(self.filter_name, self.filter_state))
+        table_name = self._get_table_name(metadata_dict)
+        if table_name is None:
+            self._send_error(404, metadata_dict)
+            return
+        if payload is None or len(payload) == 0:
+            query_args = {}
+        else:
+            query_args = JsonPayload.decode(payload)
+        # The reads run on executor threads, so a slow query or a busy reader pool doesn't hold up the event loop
+        asyncio.ensure_future(self._answer_query(table_name, query_args, metadata_dict))
+
+    def _get_table_name(self, metadata_dict):
+        """
+        Find the table to query from the uri path, which should be of the form /db/table_name
+        :param metadata_dict: A metadata dictionary passed from the upstream filters
+        :return: The table name, or None if the path doesn't name a table this filter serves
+        """
+        uri_path = metadata_dict.get(TornadoSource.METADATA_KEY_REQUEST_PATH)
+        if uri_path is not None:
+            path_components = uri_path.split('/')
+            if len(path_components) > 2:
+                table_name = path_components[2]
+                if self._table_name_re is not None and re.fullmatch(self._table_name_re, table_name) and \
+                        SqliteQuery.TABLE_NAME_PATTERN.match(table_name):
+                    return table_name
+            return None
+        return self._table_name
+
+    async def _answer_query(self, table_name, query_args, metadata_dict):
+        """
+        Run a keyset paginated query and send the json response downstream, one chunk of rows at a time
+        :param table_name: The table to query
+        :param query_args: A dictionary of query arguments, see the class docstring
+        :param metadata_dict: The metadata dictionary passed from the upstream filter
+        :return: None
+        """
+        if not os.path.exists(self._database.db_filename):
+            # Nothing has been written yet
+            self._send_error(404, metadata_dict)
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            conn = await loop.run_in_executor(None, self._database.acquire_reader)
+        except (sqlite3.Error, RuntimeError) as e:
+            print('{0} could not open a reader for {1}: {2}'.format(self.filter_name, table_name, e))
+            self._send_error(503, metadata_dict)
+            return
+        try:
+            try:
+                cur, limit = await loop.run_in_executor(None, self._execute_query, conn, table_name, query_args)
+            except (ValueError, sqlite3.Error) as e:
+                print('{0} rejected query on {1}: {2}'.format(self.filter_name, table_name, e))
+                self._send_error(400, metadata_dict)
+                return
+            if cur is None:
+                self._send_error(404, metadata_dict)
+                return
+            try:
+                await self._send_rows(loop, cur, limit, metadata_dict)
+            except sqlite3.Error as e:
+                # Part of the response may have gone out already, the error ends the request
+                print('{0} failed reading {1}: {2}'.format(self.filter_name, table_name, e))
+                self._send_error(500, metadata_dict)
+            finally:
+                cur.close()
+        finally:
+            self._database.release_reader(conn)
+
+    def _execute_query(self, conn, table_name, query_args):
+        """
+        Validate the query arguments and execute the query. Runs on an executor thread.
+        :param conn: A read connection
+        :param table_name: The table to query
+        :param query_args: A dictionary of query arguments, see the class docstring
+        :return: A tuple of the cursor and the row limit, the cursor is None if the table doesn't exist
+        """
+        limit = self._default_limit
+        after = None
+        filters = []
+        for key, value in query_args.items():
+            if key == SqliteQuery.QUERY_ARG_LIMIT:
+                limit = min(int(value), self._max_limit)
+                if limit < 1:
+                    raise ValueError('limit must be at least 1')
+            elif key == SqliteQuery.QUERY_ARG_AFTER:
+                after = int(value)
+            else:
+                filters.append((key, value))
+        columns = self._get_columns(conn, table_name)
+        if columns is None:
+            return None, limit
+        if SqliteQuery.ID_COLUMN not in columns:
+            # Ex: a table created outside of SqlitePassthru, which can't be paginated
+            raise ValueError('Table {0} has no {1} column'.format(table_name, SqliteQuery.ID_COLUMN))
+        for key, value in filters:
+            if key not in columns:
+                # The column may have been added since the schema was cached
+                columns = self._get_columns(conn, table_name, True)
+                if key not in columns:
+                    raise ValueError('Unknown column {0}'.format(key))
+        where = []
+        params = []
+        for key, value in filters:
+            where.append('{0} = ?'.format(key))
+            params.append(value)
+        if after is not None:
+            where.append('{0} > ?'.format(SqliteQuery.ID_COLUMN))
+            params.append(after)
+        sql_stmt = 'SELECT * FROM {0}'.format(table_name)
+        if len(where) > 0:
+            sql_stmt += ' WHERE ' + ' AND '.join(where)
+        sql_stmt += ' ORDER BY {0} LIMIT ?'.format(SqliteQuery.ID_COLUMN)
+        params.append(limit)
+        return conn.execute(sql_stmt, params), limit
+
+    async def _send_rows(self, loop, cur, limit, metadata_dict):
+        """
+        Send the rows of an executed query downstream. Each chunk of rows is fetched and encoded on an executor
+        thread, then sent as a partial response, so the whole result set is never held in memory.
+        :param loop: The event loop
+        :param cur: The cursor of the executed query
+        :param limit: The row limit of the query
+        :param metadata_dict: The metadata dictionary passed from the upstream filter
+        :return: None
+        """
+        col_names = [desc[0] for desc in cur.description]
+        id_index = col_names.index(SqliteQuery.ID_COLUMN)
+        partial_meta = metadata_dict.copy()
+        partial_meta[TornadoSource.METADATA_KEY_RESPONSE_PARTIAL] = True
+        separator = '{"rows": ['
+        row_count = 0
+        last_id = None
+        while self.filter_state == FilterState.running:
+            chunk_count, chunk_last_id, encoded_rows = await loop.run_in_executor(None, SqliteQuery._fetch_chunk,
+                                                                                  cur, col_names, id_index)
+            if chunk_count == 0:
+                break
+            row_count += chunk_count
+            last_id = chunk_last_id
+            self._output_pin.send(TornadoSource.CONTENT_TYPE_APPLICATION_JSON, separator + encoded_rows, partial_meta)
+            separator = ', '
+        stopped = self.filter_state != FilterState.running
+        if stopped and row_count == 0:
+            self._send_error(503, metadata_dict)
+            return
+        # If the filter stopped part way through, the client can carry on after the last row it got
+        next_after = last_id if row_count == limit or stopped else None
+        if row_count == 0:
+            # Nothing was sent yet, so the response goes out in one piece
+            resp_str = '{{"rows": [], "next_after": {0}}}'.format(json.dumps(next_after))
+        else:
+            resp_str = '], "next_after": {0}}}'.format(json.dumps(next_after))
+        self._output_pin.send(TornadoSource.CONTENT_TYPE_APPLICATION_JSON, resp_str, metadata_dict)
+
+    @staticmethod
+    def _fetch_chunk(cur, col_names, id_index):
+        """
+        Fetch and encode the next chunk of rows. Runs on an executor thread.
+        :param cur: The cursor of the executed query
+        :param col_names: The column names of the result
+        :param id_index: The index of the _id column in a row
+        :return: A tuple of (number of rows, _id of the last row, the rows encoded as comma separated json objects)
+        """
+        rows = cur.fetchmany(SqliteQuery.FETCH_CHUNK_SIZE)
+        if len(rows) == 0:
+            return 0, None, ''
+        encoded_rows = ', '.join(json.dumps(dict(zip(col_names, row))) for row in rows)
+        return len(rows), rows[-1][id_index], encoded_rows
+
+    def _get_columns(self, conn, table_name, refresh=False):
+        """
+        Get the set of column names of a table, using the cache unless refresh is set
+        :param conn: A read connection
+        :param table_name: The name of the table
+        :param refresh: True to re-read the schema from the db
+        :return: A set of column names, or None if the table doesn't exist
+        """
+        columns = self._table_columns.get(table_name)
+        if columns is None or refresh:
+            # table_xinfo also lists generated columns, ex: the json path columns of SqlitePassthru's document mode
+            columns = set(row[1] for row in conn.execute('PRAGMA table_xinfo({0})'.format(table_name)))
+            if len(columns) == 0:
+                return None
+            self._table_columns[table_name] = columns
+        return columns
+
+    def _send_error(self, status, metadata_dict):
+        """
+        Send an error response downstream
+        :param status: The http status code
+        :param metadata_dict: The metadata dictionary passed from the upstream filter
+        :return: None
+        """
+        metadata_dict[TornadoSource.METADATA_KEY_RESPONSE_STATUS] = status
+        self._output_pin.send(TornadoSource.CONTENT_TYPE_APPLICATION_JSON, '', metadata_dict)
+
+    @staticmethod
+    def get_filter_metadata():
+        return FilterBase.filter_meta
+
+    @staticmethod
+    def get_filter_pad_templates():
+        return FilterBase.filter_pad_templates
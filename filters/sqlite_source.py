@@ -0,0 +1,226 @@
+import asyncio
+import json
+import os
+import sqlite3
+
+from filters.tornado_source import TornadoSource
+from graph.filter_base import FilterBase, FilterState, FilterType
+from graph.input_pin import InputPin
+from graph.mime_types import MimeTypes
+from graph.output_pin import OutputPin
+from storage.sqlite_database import SqliteDatabase
+
+
+class SqliteSource(FilterBase):
+    """
+    A filter that incrementally reads new rows from a sqlite table. Each message on the input pin (usually from a
+    Timer) triggers a poll for rows past the watermark, and the watermark advances as the rows are sent downstream.
+
+    The watermark column defaults to _id. Any other column (ex: rosetta_timestamp) must be non-decreasing as rows are
+    inserted; _id is used as a tie breaker so rows sharing a watermark value aren't skipped.
+    If watermark_filename is set, the watermark is saved there after each poll and restored when the filter runs.
+
+    Rows are fetched in chunks of fetch_chunk_size. In record mode each row is sent as a json object, in batch mode
+    each chunk is sent as a json array of objects (which SqlitePassthru accepts as a single transaction).
+
+    Input Pins:
+    input - Accepts any mime type. Each message triggers a poll.
+
+    Output Pins:
+    output - Required - The new rows, as application/json.
+    """
+    filter_pad_templates = {}
+    filter_meta = {}
+    CONFIG_KEY_WATERMARK_COLUMN = 'watermark_column'
+    CONFIG_KEY_WATERMARK_FILENAME = 'watermark_filename'
+    CONFIG_KEY_FETCH_CHUNK_SIZE = 'fetch_chunk_size'
+    CONFIG_KEY_MAX_ROWS_PER_POLL = 'max_rows_per_poll'
+    CONFIG_KEY_EMIT_MODE = 'emit_mode'
+    METADATA_KEY_WATERMARK = 'sqlite_watermark'
+    EMIT_MODE_RECORD = 'record'
+    EMIT_MODE_BATCH = 'batch'
+    ID_COLUMN = '_id'
+    DEFAULT_FETCH_CHUNK_SIZE = 500
+    DEFAULT_MAX_ROWS_PER_POLL = 10000
+
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager, FilterType.transform)
+        self._table_name = config_dict[TornadoSource.METADATA_KEY_DB_TABLE_NAME]
+        self._watermark_column = config_dict.get(SqliteSource.CONFIG_KEY_WATERMARK_COLUMN, SqliteSource.ID_COLUMN)
+        self._watermark_filename = config_dict.get(SqliteSource.CONFIG_KEY_WATERMARK_FILENAME)
+        self._fetch_chunk_size = int(config_dict.get(SqliteSource.CONFIG_KEY_FETCH_CHUNK_SIZE, SqliteSource.DEFAULT_FETCH_CHUNK_SIZE))
+        self._max_rows_per_poll = int(config_dict.get(SqliteSource.CONFIG_KEY_MAX_ROWS_PER_POLL, SqliteSource.DEFAULT_MAX_ROWS_PER_POLL))
+        self._emit_mode = config_dict.get(SqliteSource.CONFIG_KEY_EMIT_MODE, SqliteSource.EMIT_MODE_RECORD)
+        if self._emit_mode not in (SqliteSource.EMIT_MODE_RECORD, SqliteSource.EMIT_MODE_BATCH):
+            raise ValueError('{0} must be {1} or {2}'.format(SqliteSource.CONFIG_KEY_EMIT_MODE, SqliteSource.EMIT_MODE_RECORD, SqliteSource.EMIT_MODE_BATCH))
+        reader_pool_size = config_dict.get(SqliteDatabase.CONFIG_KEY_READER_POOL_SIZE)
+        if reader_pool_size is None:
+            reader_pool_size = 1
+        self._database = SqliteDatabase(config_dict[SqliteDatabase.CONFIG_KEY_DB_FILENAME],
+                                        config_dict.get(SqliteDatabase.CONFIG_KEY_TUNING), reader_pool_size)
+        # The watermark is [watermark value, _id] of the last row sent, or None to start from the beginning
+        self._watermark = None
+        self._poll_task = None
+        mime_type_map = {}
+        mime_type_map['*'] = self.recv
+        ipin = InputPin('input', mime_type_map, self)
+        self._add_input_pin(ipin)
+        self._output_pin = OutputPin('output', True)
+        self._add_output_pin(self._output_pin)
+
+    def run(self):
+        super().run()
+        self._watermark = self._load_watermark()
+        self._set_filter_state(FilterState.running)
+
+    def stop(self):
+        super().stop()
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+        self._save_watermark()
+        self._database.close_readers()
+        self._set_filter_state(FilterState.stopped)
+
+    def recv(self, mime_type, payload, metadata_dict):
+        if self.filter_state == FilterState.running:
+            if self._poll_task is not None and not self._poll_task.done():
+                # The previous poll is still streaming rows, it will pick up anything new
+                return
+            self._poll_task = asyncio.ensure_future(self._poll(metadata_dict))
+        else:
+            raise RuntimeError('{0} tried to process input while filter state is {1}'.format(self.filter_name, self.filter_state))
+
+    async def _poll(self, metadata_dict):
+        """
+        Send the rows past the watermark downstream. The query and the fetch of each chunk run on the default executor,
+        so a large catch-up poll doesn't hold up the event loop.
+        :param metadata_dict: The metadata dictionary of the message that triggered the poll
+        :return: None
+        """
+        sql_stmt, params = self._build_query()
+        start_watermark = self._watermark
+        loop = asyncio.get_event_loop()
+        try:
+            conn = await loop.run_in_executor(None, self._database.acquire_reader)
+        except (sqlite3.Error, RuntimeError) as e:
+            print('{0} could not poll {1}: {2}'.format(self.filter_name, self._table_name, e))
+            return
+        try:
+            try:
+                cur = await loop.run_in_executor(None, conn.execute, sql_stmt, params)
+            except sqlite3.Error as e:
+                print('{0} could not poll {1}: {2}'.format(self.filter_name, self._table_name, e))
+                return
+            col_names = [desc[0] for desc in cur.description]
+            wm_index = col_names.index(self._watermark_column)
+            id_index = col_names.index(SqliteSource.ID_COLUMN)
+            while self.filter_state == FilterState.running:
+                try:
+                    rows = await loop.run_in_executor(None, cur.fetchmany, self._fetch_chunk_size)
+                except sqlite3.Error as e:
+                    print('{0} could not poll {1}: {2}'.format(self.filter_name, self._table_name, e))
+                    break
+                if len(rows) == 0:
+                    break
+                records = [dict(zip(col_names, row)) for row in rows]
+                watermarks = [[row[wm_index], row[id_index]] for row in rows]
+                try:
+                    self._emit(records, watermarks, metadata_dict)
+                except Exception as e:
+                    # The watermark stays on the last row sent, so the rest are sent again by the next poll
+                    print('{0} could not send rows of {1}: {2}'.format(self.filter_name, self._table_name, e))
+                    break
+            cur.close()
+        finally:
+            self._database.release_reader(conn)
+            if self._watermark != start_watermark:
+                self._save_watermark()
+
+    def _build_query(self):
+        """
+        Build the query for the rows past the watermark
+        :return: A tuple of the sql statement and its parameters
+        """
+        sql_stmt = 'SELECT * FROM {0}'.format(self._table_name)
+        params = []
+        if self._watermark is not None:
+            if self._watermark_column == SqliteSource.ID_COLUMN:
+                sql_stmt += ' WHERE _id > ?'
+                params.append(self._watermark[1])
+            else:
+                sql_stmt += ' WHERE {0} > ? OR ({0} = ? AND _id > ?)'.format(self._watermark_column)
+                params.extend([self._watermark[0], self._watermark[0], self._watermark[1]])
+        if self._watermark_column == SqliteSource.ID_COLUMN:
+            sql_stmt += ' ORDER BY _id'
+        else:
+            sql_stmt += ' ORDER BY {0}, _id'.format(self._watermark_column)
+        sql_stmt += ' LIMIT ?'
+        params.append(self._max_rows_per_poll)
+        return sql_stmt, params
+
+    def _emit(self, records, watermarks, metadata_dict):
+        """
+        Send a chunk of rows downstream. The watermark only moves past a row once the send of that row has returned.
+        :param records: A list of row dictionaries
+        :param watermarks: The watermark of each row
+        :param metadata_dict: The metadata dictionary of the message that triggered the poll
+        :return: None
+        """
+        if self._emit_mode == SqliteSource.EMIT_MODE_BATCH:
+            self._output_pin.send(MimeTypes.JSON, json.dumps(records), self._build_metadata(metadata_dict, watermarks[-1]))
+            self._watermark = watermarks[-1]
+        else:
+            for record, watermark in zip(records, watermarks):
+                self._output_pin.send(MimeTypes.JSON, json.dumps(record), self._build_metadata(metadata_dict, watermark))
+                self._watermark = watermark
+
+    def _build_metadata(self, metadata_dict, watermark):
+        """
+        Build the metadata dictionary for an outgoing message
+        :param metadata_dict: The metadata dictionary of the message that triggered the poll, may be None
+        :param watermark: The watermark of the last row in the message
+        :return: A new metadata dictionary
+        """
+        meta_dict = {}
+        if metadata_dict is not None:
+            meta_dict.update(metadata_dict)
+        meta_dict[TornadoSource.METADATA_KEY_MIME_TYPE] = MimeTypes.JSON
+        meta_dict[TornadoSource.METADATA_KEY_DB_TABLE_NAME] = self._table_name
+        meta_dict[SqliteSource.METADATA_KEY_WATERMARK] = watermark
+        return meta_dict
+
+    def _load_watermark(self):
+        """
+        Read the persisted watermark, if there is one
+        :return: The watermark or None
+        """
+        if self._watermark_filename is None or not os.path.exists(self._watermark_filename):
+            return self._watermark
+        with open(self._watermark_filename, 'r') as wm_file:
+            wm_dict = json.load(wm_file)
+        if wm_dict.get('table') != self._table_name or wm_dict.get('column') != self._watermark_column:
+            print('{0} ignoring watermark file {1} since it is for a different table or column'.format(self.filter_name, self._watermark_filename))
+            return None
+        return wm_dict.get('watermark')
+
+    def _save_watermark(self):
+        """
+        Persist the watermark, replacing the file atomically so a crash can't leave a partial file behind
+        :return: None
+        """
+        if self._watermark_filename is None or self._watermark is None:
+            return
+        wm_dict = {'table': self._table_name, 'column': self._watermark_column, 'watermark': self._watermark}
+        tmp_filename = self._watermark_filename + '.tmp'
+        with open(tmp_filename, 'w') as wm_file:
+            json.dump(wm_dict, wm_file)
+        os.replace(tmp_filename, self._watermark_filename)
+
+    @staticmethod
+    def get_filter_metadata():
+        return FilterBase.filter_meta
+
+    @staticmethod
+    def get_filter_pad_templates():
+        return FilterBase.filter_pad_templates
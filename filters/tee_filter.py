@@ -33,6 +33,8 @@ class TeeFilter(FilterBase):
             output_pin_name = 'output{0}'.format(i+1)
             output_pin = OutputPin(output_pin_name, True)
             self._add_output_pin(output_pin)
+        # Fan-out tuple of the output pin send functions, built by compile_dispatch
+        self._fanout = None
 
     def run(self):
         super().run()
@@ -42,10 +44,18 @@ class TeeFilter(FilterBase):
         super().stop()
         self._set_filter_state(FilterState.stopped)
 
+    def compile_dispatch(self):
+        super().compile_dispatch()
+        self._fanout = tuple(output_pin.send for output_pin in self._output_pins.values())
+
     def recv(self, mime_type, payload, metadata_dict):
         if self.filter_state == FilterState.running:
-            for output_pin in self._output_pins.values():
-                output_pin.send(mime_type, payload, metadata_dict)
+            if self._fanout is not None:
+                for send in self._fanout:
+                    send(mime_type, payload, metadata_dict)
+            else:
+                for output_pin in self._output_pins.values():
+                    output_pin.send(mime_type, payload, metadata_dict)
         else:
             raise RuntimeError('{0} tried to process input while filter state is {1}'.format(self.filter_name, self.filter_state))
 
@@ -1,86 +1,264 @@
-import json
+import asyncio
+import itertools
+import os
+from collections.abc import MutableMapping
 import tornado.ioloop
 import tornado.web
 import tornado.httpserver
+import tornado.netutil
 from tornado.platform.asyncio import AsyncIOMainLoop
+from filters.response_cache import ResponseCache
 from graph.filter_base import FilterBase, FilterState, FilterType
 from graph.input_pin import InputPin
+from graph.json_payload import JsonPayload
 from graph.output_pin import OutputPin
+from graph.pin_queue import QueueFullError
 
 
 class MainHandler(tornado.web.RequestHandler):
-    def initialize(self, filter, opin_get, opin_post, opin_put, opin_delete):
+    def initialize(self, filter, opin_get, opin_post, opin_put, opin_delete, response_timeout=None):
         self._filter = filter
+        self._response_timeout = response_timeout
+        # Set when the deadline started before the request was sent downstream, see StreamingHandler
+        self._response_deadline = None
         self._output_pin_get = opin_get
         self._output_pin_post = opin_post
         self._output_pin_put = opin_put
         self._output_pin_delete = opin_delete
-        self._filter.register_active_handler(id(self), self)
-        #
-        self._meta_dict = {}
-        self._meta_dict[TornadoSource.METADATA_KEY_HANDLER_ID] = id(self)
-        self._meta_dict[TornadoSource.METADATA_KEY_REQUEST_URI] = self.request.uri
-        self._meta_dict[TornadoSource.METADATA_KEY_REQUEST_PATH] = self.request.path
-        self._meta_dict[TornadoSource.METADATA_KEY_REQUEST_METHOD] = self.request.method
-        self._meta_dict[TornadoSource.METADATA_KEY_REQUEST_PROTOCOL] = self.request.protocol
-        self._meta_dict[TornadoSource.METADATA_KEY_REQUEST_REMOTE_IP] = self.request.remote_ip
-        self._meta_dict[TornadoSource.METADATA_KEY_REQUEST_HOST] = self.request.host
-        headers_copy = {}
-        for key in self.request.headers:
-            headers_copy[key] = self.request.headers[key]
-        self._meta_dict[TornadoSource.METADATA_KEY_REQUEST_HEADERS] = headers_copy
+        # Resolved by write_response once the graph has answered the request
+        self._response_future = None
+        # Set while a cacheable GET is waiting on the graph
+        self._cache_key = None
+        self._partial_written = False
+        self._request_id = self._filter.next_request_id()
+        self._filter.register_active_handler(self._request_id, self)
+        # The request fields are only read if a filter asks for them
+        self._meta_dict = RequestMetadata(self.request, self._request_id)
         self._content_type = self.request.headers.get('Content-Type')
         if self._content_type is None:
             self._content_type = ''
 
     def compute_etag(self):
-        return None
+        # Tornado answers 304 from finish() when the etag matches If-None-Match
+        if self._filter.response_cache is None:
+            return None
+        return super().compute_etag()
 
-    @tornado.web.asynchronous
-    def get(self):
-        # Since GET shouldn't contain a body, we parse the arguments into json format and pass that instead
-        js = json.dumps({k: self.get_argument(k) for k in self.request.arguments})
-        try:
-            self._output_pin_get.send(TornadoSource.CONTENT_TYPE_APPLICATION_JSON, js, self._meta_dict)
-        except ValueError:
-            raise tornado.web.HTTPError(405)
+    def prepare(self):
+        # Shed load while too many requests are waiting on the graph, or the queues downstream are full
+        if self._filter.is_over_capacity() or self._filter.is_under_pressure():
+            raise tornado.web.HTTPError(503)
 
-    @tornado.web.asynchronous
-    def post(self):
-        try:
-            self._output_pin_post.send(self._content_type, self.request.body, self._meta_dict)
-        except ValueError:
-            raise tornado.web.HTTPError(405)
+    async def get(self):
+        response_cache = self._filter.response_cache
+        if response_cache is not None:
+            self._cache_key = response_cache.make_key(self.request.path, self.request.arguments, self.request.headers)
+            cached = response_cache.get(self._cache_key)
+            if cached is not None:
+                status_code, mime_type, body, cache_control = cached
+                self._write_headers(status_code, mime_type, cache_control)
+                self.write(body)
+                return
+        # Since GET shouldn't contain a body, we pass the arguments instead, json encoded with the decoded dict kept
+        query_args = JsonPayload.from_value({k: self.get_argument(k) for k in self.request.arguments})
+        await self._send_downstream(self._output_pin_get, TornadoSource.CONTENT_TYPE_APPLICATION_JSON, query_args)
+
+    async def post(self):
+        await self._send_downstream(self._output_pin_post, self._content_type, self.request.body)
+
+    async def put(self):
+        await self._send_downstream(self._output_pin_put, self._content_type, self.request.body)
 
-    @tornado.web.asynchronous
-    def put(self):
+    async def delete(self):
+        await self._send_downstream(self._output_pin_delete, self._content_type, self.request.body)
+
+    async def _send_downstream(self, output_pin, mime_type, payload):
+        """
+        Send the request down the graph and wait for the response. Tornado finishes the request once this returns.
+        """
+        self._start_response()
+        self._send(output_pin, mime_type, payload, self._meta_dict)
+        await self._await_response()
+
+    def _start_response(self):
+        # Created before sending, since the graph may answer before send returns
+        self._response_future = asyncio.get_event_loop().create_future()
+
+    def _send(self, output_pin, mime_type, payload, metadata_dict):
         try:
-            self._output_pin_put.send(self._content_type, self.request.body, self._meta_dict)
+            output_pin.send(mime_type, payload, metadata_dict)
         except ValueError:
             raise tornado.web.HTTPError(405)
+        except QueueFullError:
+            raise tornado.web.HTTPError(503)
 
-    @tornado.web.asynchronous
-    def delete(self):
+    async def _await_response(self):
+        response_timeout = self._get_remaining_timeout()
         try:
-            self._output_pin_delete.send(self._content_type, self.request.body, self._meta_dict)
-        except ValueError:
-            raise tornado.web.HTTPError(405)
+            if response_timeout is None:
+                await self._response_future
+            else:
+                await asyncio.wait_for(self._response_future, response_timeout)
+        except asyncio.TimeoutError:
+            # Nothing downstream answered in time, a late response is dropped since the handler is no longer registered
+            self._filter.unregister_active_handler(self._request_id)
+            raise tornado.web.HTTPError(504)
+
+    def _get_remaining_timeout(self):
+        """
+        :return: The seconds left to wait for the response, or None for no deadline
+        """
+        if self._response_deadline is None:
+            return self._response_timeout
+        return max(self._response_deadline - asyncio.get_event_loop().time(), 0)
 
     def on_finish(self):
-        self._filter.unregister_active_handler(id(self))
+        self._filter.unregister_active_handler(self._request_id)
         super().on_finish()
 
+    def on_connection_close(self):
+        # The client went away, stop waiting on the graph. A late response is dropped.
+        self._filter.unregister_active_handler(self._request_id)
+        if self._response_future is not None and not self._response_future.done():
+            self._response_future.set_result(None)
+        super().on_connection_close()
+
     def write_response(self, mime_type, payload, metadata_dict):
+        """
+        Write a response from the graph. If the partial flag is set in the metadata, the payload is written and
+        flushed to the client and the request stays open for further responses; otherwise the request is completed.
+        """
+        if self._response_future is None or self._response_future.done():
+            return
         resp_code = metadata_dict.get(TornadoSource.METADATA_KEY_RESPONSE_STATUS)
+        if resp_code is not None and resp_code >= 400:
+            self._response_future.set_exception(tornado.web.HTTPError(resp_code))
+            return
+        cache_control = metadata_dict.get(TornadoSource.METADATA_KEY_RESPONSE_CACHE_CONTROL)
+        self._write_headers(resp_code, mime_type, cache_control)
+        self.write(payload)
+        if metadata_dict.get(TornadoSource.METADATA_KEY_RESPONSE_PARTIAL):
+            self._partial_written = True
+            self.flush()
+        else:
+            try:
+                if self._cache_key is not None and not self._partial_written:
+                    self._filter.response_cache.put(self._cache_key, resp_code, mime_type, payload, cache_control)
+            except Exception as e:
+                print('Exception caching the response to {0}: {1}'.format(self.request.path, e))
+            finally:
+                # The request completes whether or not the response could be cached
+                self._response_future.set_result(None)
+
+    def _write_headers(self, resp_code, mime_type, cache_control):
         if resp_code is not None:
-            if resp_code >= 400:
-                raise tornado.web.HTTPError(resp_code)
-            else:
-                self.set_status(resp_code)
+            self.set_status(resp_code)
         self.set_header("Content-Type", mime_type)
         self.set_header("Server", TornadoSource.SERVER_HEADER_FULL)
-        self.write(payload)
-        self.finish()
+        if cache_control is not None:
+            self.set_header("Cache-Control", cache_control)
+
+
+@tornado.web.stream_request_body
+class StreamingHandler(MainHandler):
+    """
+    Sends the body of a POST, PUT or DELETE downstream as it arrives, instead of buffering it whole.
+    Each request becomes a sequence of messages on the verb's output pin, all with the request's content type:
+    start (empty payload), one chunk per block of body bytes, then end (empty payload), or abort if the client goes
+    away or the body can't be sent on. stream_id, stream_event and stream_sequence in the metadata identify each
+    message.
+    The response is only accepted once end has been sent, a response to an earlier message is dropped. The response
+    deadline starts when the request arrives, so it covers the upload as well.
+    """
+    STREAMED_METHODS = ('POST', 'PUT', 'DELETE')
+    PRESSURE_POLL_SECONDS = 0.01
+
+    def prepare(self):
+        self._stream_pin = None
+        self._stream_sequence = 0
+        self._stream_error = None
+        self._stream_ended = False
+        super().prepare()
+        if self._response_timeout is not None:
+            self._response_deadline = asyncio.get_event_loop().time() + self._response_timeout
+        if self.request.method in StreamingHandler.STREAMED_METHODS:
+            if self.request.method == 'POST':
+                stream_pin = self._output_pin_post
+            elif self.request.method == 'PUT':
+                stream_pin = self._output_pin_put
+            else:
+                stream_pin = self._output_pin_delete
+            self._send(stream_pin, self._content_type, b'', self._stream_metadata(TornadoSource.STREAM_EVENT_START))
+            # Set once the stream has started, so only a started stream is ever aborted
+            self._stream_pin = stream_pin
+
+    async def data_received(self, chunk):
+        if self._stream_pin is None or self._stream_error is not None:
+            return
+        if self._get_remaining_timeout() == 0:
+            # The upload has used up the response deadline
+            self._stream_error = tornado.web.HTTPError(504)
+            return
+        try:
+            self._send(self._stream_pin, self._content_type, chunk, self._stream_metadata(TornadoSource.STREAM_EVENT_CHUNK))
+        except tornado.web.HTTPError as e:
+            # Reported once the body has been read, the rest of it is dropped
+            self._stream_error = e
+            return
+        # Stop reading from the client while the queues downstream are full
+        while self._filter.is_under_pressure() and not self._stream_ended:
+            if self._get_remaining_timeout() == 0:
+                self._stream_error = tornado.web.HTTPError(504)
+                return
+            await asyncio.sleep(StreamingHandler.PRESSURE_POLL_SECONDS)
+
+    async def post(self):
+        await self._end_stream()
+
+    async def put(self):
+        await self._end_stream()
+
+    async def delete(self):
+        await self._end_stream()
+
+    async def _end_stream(self):
+        self._stream_ended = True
+        if self._stream_error is None and self._get_remaining_timeout() == 0:
+            self._stream_error = tornado.web.HTTPError(504)
+        if self._stream_error is not None:
+            self._abort_stream()
+            raise self._stream_error
+        self._start_response()
+        try:
+            self._send(self._stream_pin, self._content_type, b'', self._stream_metadata(TornadoSource.STREAM_EVENT_END))
+        except tornado.web.HTTPError:
+            self._abort_stream()
+            raise
+        await self._await_response()
+
+    def on_connection_close(self):
+        if self._stream_pin is not None and not self._stream_ended:
+            self._stream_ended = True
+            self._abort_stream()
+        super().on_connection_close()
+
+    def _abort_stream(self):
+        """
+        Let the sinks discard whatever they buffered for this request
+        :return: None
+        """
+        try:
+            self._stream_pin.send(self._content_type, b'', self._stream_metadata(TornadoSource.STREAM_EVENT_ABORT))
+        except Exception as e:
+            print('Exception aborting request stream: {0}'.format(e))
+
+    def _stream_metadata(self, stream_event):
+        meta_dict = self._meta_dict.copy()
+        meta_dict[TornadoSource.METADATA_KEY_STREAM_ID] = self._request_id
+        meta_dict[TornadoSource.METADATA_KEY_STREAM_EVENT] = stream_event
+        meta_dict[TornadoSource.METADATA_KEY_STREAM_SEQUENCE] = self._stream_sequence
+        self._stream_sequence += 1
+        return meta_dict
 
 
 class TornadoSource(FilterBase):
@@ -96,10 +274,69 @@ class TornadoSource(FilterBase):
     output1_post - outputn_post - issues a POST downstream
     output1_put - outputn_put - issues a PUT downstream
     output1_delete - outputn_delete - issues a PUT downstream
+
+    Listeners and server settings:
+    address, port - The address and port to listen on, defaults to every address and port 8888.
+    listeners - Replaces address and port with a list of listeners, each either { "address": ..., "port": ... } or
+    { "unix_socket": "/path/to/socket", "mode": 384 } for local clients such as sidecars (mode defaults to 0600).
+    idle_connection_timeout - Seconds before an idle keep-alive connection is closed.
+    max_buffer_size, max_body_size - Byte limits on buffered data and on request bodies.
+    compress_response - Gzip responses when the client accepts it, defaults to false.
+
+    Streaming request bodies:
+    stream_request_body - true for every uri path, or a list of uri paths. The body of a POST, PUT or DELETE on those
+    paths is sent downstream in chunks as it arrives, see StreamingHandler. max_body_size still applies.
+
+    Multi-process mode:
+    When processes is greater than 1, the graph is forked into that many worker processes after it is built (see
+    ProcessSupervisor), each running its own copy of the graph. Every worker binds port with SO_REUSEPORT, so the
+    kernel spreads connections across them. Unix socket listeners can't be shared, so they aren't allowed in this
+    mode. Sinks that write to a shared resource must tolerate concurrent writers,
+    ex: a busy_timeout in the sqlite_tuning block of SqlitePassthru.
+
+    Admission control:
+    max_in_flight - Requests beyond this many waiting on the graph are answered 503 straight away.
+    response_timeout_seconds - Either a number of seconds for every uri path, or an object mapping uri paths (as
+    listed in uri_paths) to seconds. A request that gets no response from the graph within its deadline is answered
+    504 and its handler is unregistered.
+
+    Response cache:
+    response_cache - If set, GET responses are cached, keyed by path, sorted query arguments and any vary_headers,
+    and served without running the graph again. Filters opt responses in or out with web_response_cache_control.
+    GET responses also get an ETag, and a matching If-None-Match is answered 304. See ResponseCache.
+
+    Request metadata:
+    The metadata of a request is a RequestMetadata mapping, which reads the request fields and headers from tornado
+    only when a filter looks them up. The payload of a GET is the query arguments encoded as json text when the
+    request arrives, a JsonPayload that also keeps the dictionary, so filters reading the value don't parse it again.
+
+    Responses:
+    Each request gets a request id (web_handler_id in the metadata) and a future that the handler awaits. A filter
+    answers by sending to the matching input pin with the request's metadata. A response with web_response_status
+    of 400 or more is answered with that error. A response with web_response_partial set is written and flushed
+    immediately, and the request stays open until a response without the flag arrives.
     """
     filter_pad_templates = {}
     filter_meta = {}
     CONFIG_KEY_URI_PATHS = 'uri_paths'
+    CONFIG_KEY_PORT = 'port'
+    CONFIG_KEY_PROCESSES = 'processes'
+    CONFIG_KEY_REUSE_PORT = 'reuse_port'
+    CONFIG_KEY_MAX_IN_FLIGHT = 'max_in_flight'
+    CONFIG_KEY_RESPONSE_TIMEOUT_SECONDS = 'response_timeout_seconds'
+    CONFIG_KEY_ADDRESS = 'address'
+    CONFIG_KEY_LISTENERS = 'listeners'
+    CONFIG_KEY_COMPRESS_RESPONSE = 'compress_response'
+    CONFIG_KEY_STREAM_REQUEST_BODY = 'stream_request_body'
+    CONFIG_KEY_RESPONSE_CACHE = 'response_cache'
+    LISTENER_KEY_ADDRESS = 'address'
+    LISTENER_KEY_PORT = 'port'
+    LISTENER_KEY_UNIX_SOCKET = 'unix_socket'
+    LISTENER_KEY_MODE = 'mode'
+    # Config keys passed straight through to tornado.httpserver.HTTPServer
+    SERVER_SETTING_KEYS = ('idle_connection_timeout', 'max_buffer_size', 'max_body_size')
+    DEFAULT_PORT = 8888
+    DEFAULT_UNIX_SOCKET_MODE = 0o600
     METADATA_KEY_HANDLER_ID = 'web_handler_id'
     METADATA_KEY_REQUEST_URI = 'web_request_uri'
     METADATA_KEY_REQUEST_PATH = 'web_request_path'
@@ -110,7 +347,16 @@ class TornadoSource(FilterBase):
     METADATA_KEY_REQUEST_HEADERS = 'web_request_headers'
     METADATA_KEY_RESPONSE_STATUS = 'web_response_status'
     METADATA_KEY_RESPONSE_CHARSET = 'web_response_charset'
+    METADATA_KEY_RESPONSE_PARTIAL = 'web_response_partial'
+    METADATA_KEY_RESPONSE_CACHE_CONTROL = 'web_response_cache_control'
+    METADATA_KEY_STREAM_ID = 'stream_id'
+    METADATA_KEY_STREAM_EVENT = 'stream_event'
+    METADATA_KEY_STREAM_SEQUENCE = 'stream_sequence'
     METADATA_KEY_MIME_TYPE = 'mime-type'
+    STREAM_EVENT_START = 'start'
+    STREAM_EVENT_CHUNK = 'chunk'
+    STREAM_EVENT_END = 'end'
+    STREAM_EVENT_ABORT = 'abort'
     METADATA_KEY_DB_TABLE_NAME = 'table_name_literal'
     #
     CONTENT_TYPE_APPLICATION_JSON = 'application/json'
@@ -124,8 +370,34 @@ class TornadoSource(FilterBase):
         #
         self._application = None
         self._server = None
+        # Handlers waiting on the graph, keyed by request id
         self._active_handlers = {}
+        # Request ids are never reused, unlike id() of a handler that has been garbage collected
+        self._request_ids = itertools.count(1)
         self._uri_paths = self._config_dict.get(TornadoSource.CONFIG_KEY_URI_PATHS)
+        self._port = int(self._config_dict.get(TornadoSource.CONFIG_KEY_PORT, TornadoSource.DEFAULT_PORT))
+        self._processes = int(self._config_dict.get(TornadoSource.CONFIG_KEY_PROCESSES, 1))
+        # Several workers can only share the port with SO_REUSEPORT
+        self._reuse_port = self._processes > 1 or self._config_dict.get(TornadoSource.CONFIG_KEY_REUSE_PORT, False)
+        self._max_in_flight = self._config_dict.get(TornadoSource.CONFIG_KEY_MAX_IN_FLIGHT)
+        self._response_timeouts = self._config_dict.get(TornadoSource.CONFIG_KEY_RESPONSE_TIMEOUT_SECONDS)
+        self._listeners = self._config_dict.get(TornadoSource.CONFIG_KEY_LISTENERS)
+        if self._listeners is None:
+            address = self._config_dict.get(TornadoSource.CONFIG_KEY_ADDRESS, '')
+            self._listeners = [{TornadoSource.LISTENER_KEY_ADDRESS: address, TornadoSource.LISTENER_KEY_PORT: self._port}]
+        for listener in self._listeners:
+            if TornadoSource.LISTENER_KEY_UNIX_SOCKET in listener and self._processes > 1:
+                raise ValueError('{0} can not share a unix socket listener between processes'.format(self.filter_name))
+        self._server_settings = {}
+        for key in TornadoSource.SERVER_SETTING_KEYS:
+            if key in self._config_dict:
+                self._server_settings[key] = self._config_dict[key]
+        self._compress_response = self._config_dict.get(TornadoSource.CONFIG_KEY_COMPRESS_RESPONSE, False)
+        self._stream_request_body = self._config_dict.get(TornadoSource.CONFIG_KEY_STREAM_REQUEST_BODY, False)
+        self._response_cache = None
+        cache_config = self._config_dict.get(TornadoSource.CONFIG_KEY_RESPONSE_CACHE)
+        if cache_config is not None:
+            self._response_cache = ResponseCache.create_from_config(cache_config)
         for i in range(len(self._uri_paths)):
             mime_type_map = {}
             mime_type_map['*'] = self.recv
@@ -159,23 +431,46 @@ class TornadoSource(FilterBase):
             opin_put = self.get_output_pin(output_pin_name)
             output_pin_name = 'output{0}_delete'.format(i+1)
             opin_delete = self.get_output_pin(output_pin_name)
-            t = (self._uri_paths[i], MainHandler, dict(filter=self, opin_get=opin_get, opin_post=opin_post, opin_put=opin_put, opin_delete=opin_delete))
+            response_timeout = self._get_response_timeout(self._uri_paths[i])
+            if self._stream_request_body is True or (isinstance(self._stream_request_body, list) and self._uri_paths[i] in self._stream_request_body):
+                handler_class = StreamingHandler
+            else:
+                handler_class = MainHandler
+            t = (self._uri_paths[i], handler_class, dict(filter=self, opin_get=opin_get, opin_post=opin_post, opin_put=opin_put, opin_delete=opin_delete,
+                                                         response_timeout=response_timeout))
             uri_list.append(t)
-        self._application = tornado.web.Application(uri_list)
-        self._server = tornado.httpserver.HTTPServer(self._application)
+        self._application = tornado.web.Application(uri_list, compress_response=self._compress_response)
+        self._server = tornado.httpserver.HTTPServer(self._application, **self._server_settings)
         self._set_filter_state(FilterState.running)
 
     def graph_is_running(self):
         super().graph_is_running()
-        self._server.listen(8888)
+        for listener in self._listeners:
+            unix_socket = listener.get(TornadoSource.LISTENER_KEY_UNIX_SOCKET)
+            if unix_socket is not None:
+                mode = int(listener.get(TornadoSource.LISTENER_KEY_MODE, TornadoSource.DEFAULT_UNIX_SOCKET_MODE))
+                self._server.add_socket(tornado.netutil.bind_unix_socket(unix_socket, mode=mode))
+            else:
+                address = listener.get(TornadoSource.LISTENER_KEY_ADDRESS, '')
+                port = int(listener.get(TornadoSource.LISTENER_KEY_PORT, TornadoSource.DEFAULT_PORT))
+                sockets = tornado.netutil.bind_sockets(port, address=address, reuse_port=self._reuse_port)
+                self._server.add_sockets(sockets)
 
     def stop(self):
         super().stop()
         if self._server is not None:
             self._server.stop()
             self._server = None
+            for listener in self._listeners:
+                unix_socket = listener.get(TornadoSource.LISTENER_KEY_UNIX_SOCKET)
+                if unix_socket is not None and os.path.exists(unix_socket):
+                    os.remove(unix_socket)
         self._set_filter_state(FilterState.stopped)
 
+    @property
+    def process_count(self):
+        return self._processes
+
     def recv(self, mime_type, payload, metadata_dict):
         handler_id = metadata_dict.get(TornadoSource.METADATA_KEY_HANDLER_ID)
         if handler_id is not None:
@@ -183,11 +478,45 @@ class TornadoSource(FilterBase):
             if handler is not None:
                 handler.write_response(mime_type, payload, metadata_dict)
 
+    def is_under_pressure(self):
+        return self._graph_manager.is_under_pressure()
+
+    def is_over_capacity(self):
+        """
+        Check if there are more requests waiting on the graph than max_in_flight allows.
+        The request being admitted is already registered, so it is included in the count.
+        :return: True if the request should be turned away
+        """
+        return self._max_in_flight is not None and len(self._active_handlers) > self._max_in_flight
+
+    def _get_response_timeout(self, uri_path):
+        """
+        Find the response deadline for a uri path
+        :param uri_path: The uri path, as listed in uri_paths
+        :return: The deadline in seconds, or None for no deadline
+        """
+        if self._response_timeouts is None:
+            return None
+        if isinstance(self._response_timeouts, dict):
+            timeout = self._response_timeouts.get(uri_path)
+            if timeout is None:
+                return None
+            return float(timeout)
+        return float(self._response_timeouts)
+
+    @property
+    def response_cache(self):
+        return self._response_cache
+
+    def next_request_id(self):
+        return next(self._request_ids)
+
     def register_active_handler(self, handler_id, handler):
         self._active_handlers[handler_id] = handler
 
     def unregister_active_handler(self, handler_id):
-        del self._active_handlers[handler_id]
+        # May already be gone, ex: the handler timed out before it finished
+        self._active_handlers.pop(handler_id, None)
 
     def _get_active_handler(self, handler_id):
         return self._active_handlers.get(handler_id)
@@ -199,3 +528,90 @@ class TornadoSource(FilterBase):
     @staticmethod
     def get_filter_pad_templates():
         return FilterBase.filter_pad_templates
+
+
+class RequestMetadata(MutableMapping):
+    """
+    The metadata dictionary of a request. The web_request_* entries are read from the tornado request the first time
+    they are looked up, so a request that is rejected, or whose filters never look at its headers, doesn't pay for
+    building them. Anything set by the filters is stored as in a normal dictionary.
+    Pickles as a plain dictionary, ex: when sent to a process executor. The lazy fields that haven't been deleted are
+    all read from the request first, so a filter on a process executor sees the same entries as one on the event loop.
+    """
+    # Maps the lazy keys to functions reading them from the request
+    LAZY_FIELDS = {
+        TornadoSource.METADATA_KEY_REQUEST_URI: lambda request: request.uri,
+        TornadoSource.METADATA_KEY_REQUEST_PATH: lambda request: request.path,
+        TornadoSource.METADATA_KEY_REQUEST_METHOD: lambda request: request.method,
+        TornadoSource.METADATA_KEY_REQUEST_PROTOCOL: lambda request: request.protocol,
+        TornadoSource.METADATA_KEY_REQUEST_REMOTE_IP: lambda request: request.remote_ip,
+        TornadoSource.METADATA_KEY_REQUEST_HOST: lambda request: request.host,
+        TornadoSource.METADATA_KEY_REQUEST_HEADERS: lambda request: {key: request.headers[key] for key in request.headers},
+    }
+
+    def __init__(self, request, handler_id, values=None, deleted=None):
+        """
+        c'tor
+        :param request: The tornado request
+        :param handler_id: The request id, stored as web_handler_id
+        :param values: The values that are already known, used by copy
+        :param deleted: The lazy keys that have been deleted, used by copy
+        """
+        self._request = request
+        if values is None:
+            values = {TornadoSource.METADATA_KEY_HANDLER_ID: handler_id}
+        self._values = values
+        self._deleted = deleted if deleted is not None else set()
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            getter = RequestMetadata.LAZY_FIELDS.get(key)
+            if getter is None or key in self._deleted:
+                raise
+        value = getter(self._request)
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if key in RequestMetadata.LAZY_FIELDS and key not in self._deleted:
+            self._deleted.add(key)
+            self._values.pop(key, None)
+        else:
+            del self._values[key]
+
+    def __iter__(self):
+        for key in self._values:
+            yield key
+        for key in RequestMetadata.LAZY_FIELDS:
+            if key not in self._values and key not in self._deleted:
+                yield key
+
+    def __len__(self):
+        count = len(self._values)
+        for key in RequestMetadata.LAZY_FIELDS:
+            if key not in self._values and key not in self._deleted:
+                count += 1
+        return count
+
+    def __contains__(self, key):
+        if key in self._values:
+            return True
+        return key in RequestMetadata.LAZY_FIELDS and key not in self._deleted
+
+    def copy(self):
+        """
+        A shallow copy that still reads the remaining lazy fields on demand
+        :return: A RequestMetadata instance
+        """
+        return RequestMetadata(self._request, None, dict(self._values), set(self._deleted))
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def __repr__(self):
+        return repr(dict(self))
@@ -0,0 +1,122 @@
+import json
+import os
+from collections import OrderedDict
+
+
+class ValidatorCache:
+    """
+    A bounded cache of the ETag and Last-Modified validators of the documents fetched by HttpClientSource, so a poll
+    can ask the server for the document only if it has changed. The least recently fetched URIs are evicted first
+    once max_entries is reached.
+
+    Config - the conditional_get block of HttpClientSource, all keys optional:
+    max_entries - Upper bound on the number of URIs whose validators are kept
+    cache_filename - If set, the validators are restored from this file when the filter runs, and saved to it when
+                     the filter stops
+    emit_not_modified - If true, a 304 response sends an empty "not modified" event downstream instead of nothing
+    """
+    CONFIG_KEY_MAX_ENTRIES = 'max_entries'
+    CONFIG_KEY_CACHE_FILENAME = 'cache_filename'
+    CONFIG_KEY_EMIT_NOT_MODIFIED = 'emit_not_modified'
+    DEFAULT_MAX_ENTRIES = 1000
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, cache_filename=None, emit_not_modified=False):
+        """
+        c'tor
+        :param max_entries: Upper bound on the number of URIs whose validators are kept
+        :param cache_filename: The file the validators are persisted to, or None to keep them in memory only
+        :param emit_not_modified: True to send a "not modified" event downstream on a 304 response
+        """
+        self._max_entries = int(max_entries)
+        self._cache_filename = cache_filename
+        self._emit_not_modified = emit_not_modified
+        # Most recently fetched last. Value is a tuple of (etag, last_modified, mime_type)
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def create_from_config(cache_config):
+        """
+        Create a cache from the conditional_get block of HttpClientSource
+        :param cache_config: A dictionary, see the class docstring
+        :return: A ValidatorCache instance
+        """
+        return ValidatorCache(cache_config.get(ValidatorCache.CONFIG_KEY_MAX_ENTRIES, ValidatorCache.DEFAULT_MAX_ENTRIES),
+                              cache_config.get(ValidatorCache.CONFIG_KEY_CACHE_FILENAME),
+                              cache_config.get(ValidatorCache.CONFIG_KEY_EMIT_NOT_MODIFIED, False))
+
+    @property
+    def emit_not_modified(self):
+        return self._emit_not_modified
+
+    def get_request_headers(self, request_uri):
+        """
+        Build the conditional request headers of a URI
+        :param request_uri: The URI about to be fetched
+        :return: A dictionary with If-None-Match and / or If-Modified-Since, empty if the URI isn't cached
+        """
+        headers = {}
+        entry = self._entries.get(request_uri)
+        if entry is not None:
+            if entry[0] is not None:
+                headers['If-None-Match'] = entry[0]
+            if entry[1] is not None:
+                headers['If-Modified-Since'] = entry[1]
+        return headers
+
+    def get_mime_type(self, request_uri):
+        """
+        :param request_uri: A cached URI
+        :return: The mime type of the document when it was last downloaded, or None if the URI isn't cached
+        """
+        entry = self._entries.get(request_uri)
+        return entry[2] if entry is not None else None
+
+    def update(self, request_uri, response_headers, mime_type):
+        """
+        Remember the validators of a document that was just downloaded
+        :param request_uri: The URI that was fetched
+        :param response_headers: The headers of the 200 response
+        :param mime_type: The mime type of the document
+        :return: None
+        """
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        self._entries.pop(request_uri, None)
+        if etag is None and last_modified is None:
+            return
+        self._entries[request_uri] = (etag, last_modified, mime_type)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def touch(self, request_uri):
+        """
+        Mark a URI as recently fetched, after a 304 response
+        :param request_uri: The URI that was fetched
+        :return: None
+        """
+        if request_uri in self._entries:
+            self._entries.move_to_end(request_uri)
+
+    def load(self):
+        """
+        Restore the persisted validators, if there are any
+        :return: None
+        """
+        if self._cache_filename is None or not os.path.exists(self._cache_filename):
+            return
+        with open(self._cache_filename, 'r') as cache_file:
+            entry_list = json.load(cache_file)
+        self._entries = OrderedDict((entry[0], tuple(entry[1:])) for entry in entry_list[-self._max_entries:])
+
+    def save(self):
+        """
+        Persist the validators, replacing the file atomically so a crash can't leave a partial file behind
+        :return: None
+        """
+        if self._cache_filename is None:
+            return
+        entry_list = [[request_uri] + list(entry) for request_uri, entry in self._entries.items()]
+        tmp_filename = self._cache_filename + '.tmp'
+        with open(tmp_filename, 'w') as cache_file:
+            json.dump(entry_list, cache_file)
+        os.replace(tmp_filename, self._cache_filename)
@@ -117,6 +117,17 @@ class FilterBase:
     def filter_state(self):
         return self._filter_state
 
+    @property
+    def config_dict(self):
+        return self._config_dict
+
+    @property
+    def process_count(self):
+        """
+        The number of processes this filter would like the graph to be run in, see ProcessSupervisor
+        """
+        return 1
+
     # TODO: Deprecated
     @property
     def filter_type(self):
@@ -187,6 +198,14 @@ class FilterBase:
         if self._filter_state != FilterState.stopped and self._filter_state != FilterState.stop_pending:
             raise RuntimeError("Attempt to run a filter that is not in the stopped state")
 
+    def compile_dispatch(self):
+        """
+        Called by the graph manager (only) after the output pins have compiled their dispatch plan.
+        Filters can override this to precompute anything derived from their pins.
+        :return:
+        """
+        pass
+
     def graph_is_running(self):
         """
         Called by the graph manager (only) when the graph has transitioned to running
@@ -0,0 +1,390 @@
+import abc
+import asyncio
+import importlib
+import multiprocessing
+import multiprocessing.util
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+
+class FilterExecutor(abc.ABC):
+    """
+    Runs a filter's input handlers off the event loop, configured per filter in the graph config:
+        "executor": "thread" or "process", "executor_workers": 1
+
+    The handlers on the filter's input pins are replaced with wrappers that tag each message with a sequence number
+    and hand it to a pool. Whatever the filter sends on its output pins while handling a message is captured, and
+    released on the event loop thread in sequence number order, so downstream filters see the same ordering as they
+    would if the filter ran on the loop.
+
+    With the default of one worker the handlers also run one at a time, in the order the messages arrived, so side
+    effects such as database writes happen in arrival order too. With more than one worker the handlers run
+    concurrently and only the output is put back in order: an older message may be written after a newer one, ex: an
+    upsert overwriting newer data. So executor_workers > 1 is only safe for filters without side effects, ex: a CPU
+    bound transform.
+
+    If a handler raises on a message that belongs to a request (it has a web_handler_id), an empty message with
+    web_response_status 500 is sent on each of the filter's output pins in its place, so the request is answered
+    with an error rather than waiting for its deadline. A message sent to a stopped executor raises RuntimeError.
+
+    Subclasses decide where the handlers actually run.
+    """
+    CONFIG_KEY_EXECUTOR = 'executor'
+    CONFIG_KEY_EXECUTOR_WORKERS = 'executor_workers'
+    EXECUTOR_THREAD = 'thread'
+    EXECUTOR_PROCESS = 'process'
+    DEFAULT_WORKERS = 1
+    # The request keys of TornadoSource, which the graph package doesn't import
+    METADATA_KEY_HANDLER_ID = 'web_handler_id'
+    METADATA_KEY_RESPONSE_STATUS = 'web_response_status'
+    ERROR_RESPONSE_STATUS = 500
+
+    def __init__(self, filter, workers=DEFAULT_WORKERS):
+        """
+        c'tor
+        :param filter: The filter whose handlers should be run by this executor
+        :param workers: The number of workers in the pool
+        """
+        self._filter = filter
+        self._workers = workers
+        self._loop = None
+        self._next_seq = 0
+        self._next_release = 0
+        # Finished messages waiting for their turn to be released, keyed by sequence number.
+        # Value is a tuple of (list of captured sends, exception or None)
+        self._completed = {}
+        self._completed_lock = threading.Lock()
+        # The original send of each of the filter's output pins, keyed by pin name
+        self._output_sends = {}
+
+    @staticmethod
+    def create(filter, executor_type, workers):
+        """
+        Create the executor named in the graph config
+        :param filter: The filter whose handlers should be run by the executor
+        :param executor_type: The executor name, ex: thread
+        :param workers: The number of workers, or None for the default
+        :return: A FilterExecutor instance
+        """
+        if workers is None:
+            workers = FilterExecutor.DEFAULT_WORKERS
+        if executor_type == FilterExecutor.EXECUTOR_THREAD:
+            return ThreadFilterExecutor(filter, int(workers))
+        elif executor_type == FilterExecutor.EXECUTOR_PROCESS:
+            return ProcessFilterExecutor(filter, int(workers))
+        raise ValueError('Unknown executor {0} for filter {1}'.format(executor_type, filter.filter_name))
+
+    def install(self):
+        """
+        Wrap the filter's input handlers and output pins. Must be called before the dispatch plan is compiled.
+        :return: None
+        """
+        for pin_name, input_pin in self._filter.get_all_input_pins():
+            input_pin.wrap_dispatchers(partial(self._wrap_dispatcher, pin_name))
+        for pin_name, output_pin in self._filter.get_all_output_pins():
+            self._output_sends[pin_name] = output_pin.send
+            # Shadow the bound send method on this pin instance only, other pins keep the direct path
+            output_pin.send = self._wrap_send(pin_name, output_pin.send)
+
+    def start(self):
+        """
+        Start the pool. Must be called on the event loop thread.
+        :return: None
+        """
+        self._loop = asyncio.get_event_loop()
+
+    def stop(self):
+        """
+        Wait for the messages in flight and release their output
+        :return: None
+        """
+        self._release_completed()
+        self._loop = None
+
+    def _wrap_dispatcher(self, pin_name, disp_fun):
+        """
+        Wrap an input handler so the message is submitted to the pool
+        :param pin_name: The name of the input pin the handler belongs to
+        :param disp_fun: The handler to wrap
+        :return: The wrapper
+        """
+        def submit(mime_type, payload, metadata_dict):
+            if self._loop is None:
+                raise RuntimeError('{0} received a message while its executor is stopped'.format(self._filter.filter_name))
+            seq = self._next_seq
+            self._next_seq += 1
+            try:
+                self._submit(seq, pin_name, disp_fun, mime_type, payload, metadata_dict)
+            except Exception as e:
+                # Complete the sequence number anyway, or every later message would wait on it forever
+                self._complete(seq, self._error_sends(mime_type, metadata_dict), e)
+        return submit
+
+    @abc.abstractmethod
+    def _wrap_send(self, pin_name, send):
+        """
+        Wrap an output pin's send so that sends made while handling a message in the pool are captured
+        :param pin_name: The name of the output pin
+        :param send: The original send function
+        :return: The wrapper
+        """
+
+    @abc.abstractmethod
+    def _submit(self, seq, pin_name, disp_fun, mime_type, payload, metadata_dict):
+        """
+        Run the handler in the pool, and call _complete once it is done
+        """
+
+    def _error_sends(self, mime_type, metadata_dict):
+        """
+        Build the sends that report a failed handler downstream, in place of the output it didn't produce
+        :param mime_type: The mime_type of the message that failed
+        :param metadata_dict: The metadata dictionary of the message that failed
+        :return: A list of sends, empty if the message doesn't belong to a request
+        """
+        if metadata_dict is None or metadata_dict.get(FilterExecutor.METADATA_KEY_HANDLER_ID) is None:
+            return []
+        error_meta = metadata_dict.copy()
+        error_meta[FilterExecutor.METADATA_KEY_RESPONSE_STATUS] = FilterExecutor.ERROR_RESPONSE_STATUS
+        return [(send, mime_type, '', error_meta) for send in self._output_sends.values()]
+
+    def _complete(self, seq, sends, exc):
+        """
+        Record a finished message and schedule the release of everything that is now in order. Thread safe.
+        :param seq: The sequence number of the message
+        :param sends: The list of captured sends, each a tuple of (send function, mime_type, payload, metadata_dict)
+        :param exc: The exception raised by the handler, or None
+        :return: None
+        """
+        with self._completed_lock:
+            self._completed[seq] = (sends, exc)
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._release_completed)
+
+    def _release_completed(self):
+        """
+        Release the captured output of finished messages, in sequence number order. Runs on the event loop thread.
+        :return: None
+        """
+        while True:
+            with self._completed_lock:
+                entry = self._completed.pop(self._next_release, None)
+            if entry is None:
+                break
+            self._next_release += 1
+            sends, exc = entry
+            if exc is not None:
+                print('Exception in {0} while running on its executor: {1}'.format(self._filter.filter_name, exc))
+            for send, mime_type, payload, metadata_dict in sends:
+                try:
+                    send(mime_type, payload, metadata_dict)
+                except Exception as e:
+                    print('Exception sending output of {0}: {1}'.format(self._filter.filter_name, e))
+
+
+class ThreadFilterExecutor(FilterExecutor):
+    """
+    Runs a filter's input handlers on a dedicated thread pool. The filter must be safe to call from several threads.
+    """
+    def __init__(self, filter, workers=FilterExecutor.DEFAULT_WORKERS):
+        super().__init__(filter, workers)
+        self._pool = None
+        # The sends captured while a worker thread handles a message, None outside of a handler
+        self._local = threading.local()
+
+    def start(self):
+        super().start()
+        self._pool = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix=self._filter.filter_name)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        super().stop()
+
+    def _wrap_send(self, pin_name, send):
+        def captured_send(mime_type, payload, metadata_dict):
+            sends = getattr(self._local, 'sends', None)
+            if sends is None:
+                # Not inside a handler, ex: a timer callback on the event loop
+                send(mime_type, payload, metadata_dict)
+            else:
+                sends.append((send, mime_type, payload, metadata_dict))
+        return captured_send
+
+    def _submit(self, seq, pin_name, disp_fun, mime_type, payload, metadata_dict):
+        self._pool.submit(self._run_handler, seq, disp_fun, mime_type, payload, metadata_dict)
+
+    def _run_handler(self, seq, disp_fun, mime_type, payload, metadata_dict):
+        """
+        Run a handler on a worker thread, capturing its output
+        """
+        self._local.sends = []
+        exc = None
+        try:
+            disp_fun(mime_type, payload, metadata_dict)
+        except Exception as e:
+            exc = e
+        sends = self._local.sends
+        self._local.sends = None
+        if exc is not None:
+            sends += self._error_sends(mime_type, metadata_dict)
+        self._complete(seq, sends, exc)
+
+
+class ProcessFilterExecutor(FilterExecutor):
+    """
+    Runs a filter's input handlers in a pool of worker processes, so CPU bound filters can use more than one core.
+
+    Each worker process builds its own replica of the filter from the filter's module, class and config, and runs it.
+    Messages are pickled to the workers, and the replica's output sends are pickled back and released by the filter
+    in this process. So the payload and metadata must be picklable, and the filter shouldn't rely on state shared
+    between messages (each replica only sees the messages sent to its process).
+    The workers are started with forkserver (spawn where it isn't available), so the filter's module must be
+    importable from a fresh interpreter.
+    When the pool is shut down, each worker stops its replica (stop, then graph_has_stopped) before it exits, so
+    the replica can flush and close what it holds, ex: the pending batches and connection of SqlitePassthru. Anything
+    the replica sends while stopping is dropped, since the filter in this process has already stopped.
+    """
+    def __init__(self, filter, workers=FilterExecutor.DEFAULT_WORKERS):
+        super().__init__(filter, workers)
+        self._pool = None
+
+    def start(self):
+        super().start()
+        filter_class = type(self._filter)
+        self._pool = ProcessPoolExecutor(max_workers=self._workers, mp_context=ProcessFilterExecutor._get_mp_context(),
+                                         initializer=_init_worker_filter,
+                                         initargs=(filter_class.__module__, filter_class.__name__,
+                                                   self._filter.filter_name, self._filter.config_dict))
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        super().stop()
+
+    @staticmethod
+    def _get_mp_context():
+        """
+        Workers are started from a clean process rather than forked from this one, which holds the event loop,
+        open sockets and other threads' locks
+        :return: A forkserver context, or spawn where forkserver isn't available
+        """
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context('forkserver')
+        return multiprocessing.get_context('spawn')
+
+    def _wrap_send(self, pin_name, send):
+        # Sends made in this process, ex: from a timer, go straight out. Replica output is released by pin name.
+        return send
+
+    def _submit(self, seq, pin_name, disp_fun, mime_type, payload, metadata_dict):
+        future = self._pool.submit(_run_worker_filter, pin_name, mime_type, payload, metadata_dict)
+        future.add_done_callback(partial(self._worker_done, seq, mime_type, metadata_dict))
+
+    def _worker_done(self, seq, mime_type, metadata_dict, future):
+        """
+        Map the output of a worker back to the filter's output pins. Called on a thread owned by the pool.
+        :param seq: The sequence number of the message
+        :param mime_type: The mime_type of the message
+        :param metadata_dict: The metadata dictionary of the message
+        :param future: The future returned by the pool
+        :return: None
+        """
+        try:
+            worker_sends, exc = future.result()
+        except Exception as e:
+            # Ex: the payload couldn't be pickled, or the worker process died
+            worker_sends, exc = [], e
+        sends = []
+        for output_pin_name, send_mime_type, payload, send_metadata_dict in worker_sends:
+            sends.append((self._output_sends[output_pin_name], send_mime_type, payload, send_metadata_dict))
+        if exc is not None:
+            sends += self._error_sends(mime_type, metadata_dict)
+        self._complete(seq, sends, exc)
+
+
+class _WorkerGraphManager:
+    """
+    Stands in for the graph manager of a filter replica in a worker process
+    """
+    def __init__(self):
+        self._services = {}
+
+    def filter_changed_state(self, filter):
+        pass
+
+    def cycle_started(self, filter):
+        pass
+
+    def cycle_ended(self, filter):
+        pass
+
+    def is_under_pressure(self):
+        return False
+
+    def register_service(self, service):
+        # The replica gets its own services, they aren't shared with the graph in the parent process
+        self._services[service.service_name] = service
+
+    def get_service(self, service_name):
+        return self._services.get(service_name)
+
+
+# The filter replica of a worker process, and the sends it made while handling the current message
+_worker_filter = None
+_worker_sends = None
+
+
+def _init_worker_filter(module_path, class_name, instance_name, config_dict):
+    """
+    Build and run the filter replica, in a newly started worker process
+    """
+    global _worker_filter
+    mod = importlib.import_module(module_path)
+    klass = getattr(mod, class_name)
+    _worker_filter = klass(instance_name, config_dict, _WorkerGraphManager())
+    for pin_name, output_pin in _worker_filter.get_all_output_pins():
+        output_pin.send = partial(_capture_worker_send, pin_name)
+    _worker_filter.run()
+    # Runs as the worker process exits, once the pool has been shut down
+    multiprocessing.util.Finalize(None, _stop_worker_filter, exitpriority=10)
+
+
+def _stop_worker_filter():
+    """
+    Stop the filter replica, in a worker process that is exiting
+    """
+    global _worker_sends
+    # Nowhere to release the output to any more
+    _worker_sends = []
+    try:
+        _worker_filter.stop()
+        _worker_filter.graph_has_stopped()
+    except Exception as e:
+        print('Exception stopping {0} in worker process: {1}'.format(_worker_filter.filter_name, e))
+    _worker_sends = None
+
+
+def _capture_worker_send(pin_name, mime_type, payload, metadata_dict):
+    _worker_sends.append((pin_name, mime_type, payload, metadata_dict))
+
+
+def _run_worker_filter(pin_name, mime_type, payload, metadata_dict):
+    """
+    Handle a message with the filter replica
+    :return: A tuple of (list of (output pin name, mime_type, payload, metadata_dict), exception or None)
+    """
+    global _worker_sends
+    _worker_sends = []
+    exc = None
+    try:
+        _worker_filter.get_input_pin(pin_name).recv(mime_type, payload, metadata_dict)
+    except Exception as e:
+        exc = e
+    sends = _worker_sends
+    _worker_sends = None
+    return sends, exc
@@ -1,5 +1,7 @@
 import json
 
+from graph.filter_executor import FilterExecutor
+
 
 class GraphBuilder:
     """
@@ -15,6 +17,15 @@ class GraphBuilder:
         :return:
         """
         js_obj = json.loads(self._config_text)
+        # Services first, so the filters can look them up while they are created
+        service_array = js_obj.get('services', [])
+        for serv in service_array:
+            module_path = serv['module_path']
+            class_name = serv['class_name']
+            instance_name = serv['instance_name']
+            config = serv.get('config', {})
+            service_instance = self._graph_mgr.service_factory(module_path, class_name, instance_name, config)
+            self._graph_mgr.register_service(service_instance)
         filter_array = js_obj.get('filters')
         for filt in filter_array:
             module_path = filt['module_path']
@@ -23,10 +34,15 @@ class GraphBuilder:
             config = filt['config']
             filter_instance = self._graph_mgr.filter_factory(module_path, class_name, instance_name, config)
             self._graph_mgr.add_filter(filter_instance)
+            executor_type = filt.get(FilterExecutor.CONFIG_KEY_EXECUTOR)
+            if executor_type is not None:
+                workers = filt.get(FilterExecutor.CONFIG_KEY_EXECUTOR_WORKERS)
+                self._graph_mgr.set_filter_executor(instance_name, executor_type, workers)
         conn_array = js_obj.get('pin_connections')
         for conn in conn_array:
             source_filter = conn['source_filter']
             source_pin = conn['source_pin']
             target_filter = conn['target_filter']
             target_pin = conn['target_pin']
-            self._graph_mgr.connect_pins(source_filter, source_pin, target_filter, target_pin)
+            queue_config = conn.get('queue')
+            self._graph_mgr.connect_pins(source_filter, source_pin, target_filter, target_pin, queue_config)
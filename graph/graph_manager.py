@@ -1,6 +1,8 @@
 import importlib
 
 from graph.filter_base import FilterState, FilterType
+from graph.filter_executor import FilterExecutor
+from graph.pin_queue import PinQueue
 
 
 class GraphManager:
@@ -16,6 +18,12 @@ class GraphManager:
         self._sink_filters = {}
         # Set true if the graph is continuous - in other words, at least one filter is continuous
         self._is_continuous = False
+        # Bounded queues placed on pin connections
+        self._pin_queues = []
+        # Executors that run filters off the event loop, keyed by filter name
+        self._filter_executors = {}
+        # Services shared by the filters, keyed by service name
+        self._services = {}
 
     def filter_factory(self, module_path, class_name, instance_name, config_dict):
         """
@@ -31,6 +39,20 @@ class GraphManager:
         inst = klass(instance_name, config_dict, self)
         return inst
 
+    def service_factory(self, module_path, class_name, instance_name, config_dict):
+        """
+        Create an instance of the specified service
+        :param module_path: The path to the module, for example services.http_client_service
+        :param class_name: The name of the class
+        :param instance_name: The name of the service to be created
+        :param config_dict: A dictionary used to configure the service
+        :return: Returns an instance of the class
+        """
+        mod = importlib.import_module(module_path)
+        klass = getattr(mod, class_name)
+        inst = klass(instance_name, config_dict, self)
+        return inst
+
     def get_filter_metadata(self, module_path, class_name):
         """
         Get's metadata about the filter
@@ -49,20 +71,59 @@ class GraphManager:
             raise KeyError('A filter named {0} already exists in the graph'.format(filter.filter_name))
         self._filters[filter.filter_name] = filter
 
-    def connect_pins(self, source_filter, source_pin, target_filter, target_pin):
+    def register_service(self, service):
+        """
+        Make a service available to every filter of the graph. See ServiceBase.
+        :param service: The service
+        :return: None
+        """
+        if service.service_name in self._services:
+            raise KeyError('A service named {0} already exists in the graph'.format(service.service_name))
+        self._services[service.service_name] = service
+
+    def get_service(self, service_name):
+        """
+        Find a service by name
+        :param service_name: The name of the service
+        :return: The service, or None if there's no service with that name
+        """
+        return self._services.get(service_name)
+
+    def set_filter_executor(self, filter_name, executor_type, workers=None):
+        """
+        Run a filter's input handlers on an executor instead of the event loop. See FilterExecutor.
+        Must be called before the graph is validated, since that compiles the dispatch plan.
+        :param filter_name: The name of the filter
+        :param executor_type: The executor name, ex: thread
+        :param workers: The number of workers, or None for the default
+        :return: None
+        """
+        if filter_name in self._filter_executors:
+            raise KeyError('Filter {0} already has an executor'.format(filter_name))
+        filter_executor = FilterExecutor.create(self._filters[filter_name], executor_type, workers)
+        filter_executor.install()
+        self._filter_executors[filter_name] = filter_executor
+
+    def connect_pins(self, source_filter, source_pin, target_filter, target_pin, queue_config=None):
         """
         Connnect an output pin (source_filter, source_pin) to an input pin (target_filter, target_pin)
         :param source_filter: The source filter to connect
         :param source_pin: The source (output) pin
         :param target_filter: The target filter to connect to
         :param target_pin: The target (input) pin
+        :param queue_config: If not None, a bounded queue is placed on the connection. See PinQueue.
         :return:
         """
         sfilt = self._filters.get(source_filter)
         spin = sfilt.get_output_pin(source_pin)
         tfilt = self._filters.get(target_filter)
         tpin = tfilt.get_input_pin(target_pin)
-        spin.connect_to_pin(tpin)
+        if queue_config is not None:
+            pin_queue = PinQueue.create_from_config(tpin, queue_config)
+            self._pin_queues.append(pin_queue)
+            spin.connect_to_pin(pin_queue)
+        else:
+            spin.connect_to_pin(tpin)
 
     def validate_graph(self):
         """
@@ -116,19 +177,71 @@ class GraphManager:
         if len(self._sink_filters) < 1:
             print('Graph has no sink filters')
             validate_flag = False
+        if validate_flag:
+            self.compile_dispatch_plan()
         return validate_flag
 
+    def compile_dispatch_plan(self):
+        """
+        Resolve every connected output pin to the handlers of the input pin it feeds, so messages go straight from
+        OutputPin.send to the downstream filter without the InputPin.recv lookup on each hop.
+        Then let each filter precompute anything derived from its pins, ex: the fan-out tuple of a TeeFilter.
+        Must be called again if pins are connected afterwards (connect_pins discards the stale plan).
+        :return: None
+        """
+        for key, val in self._filters.items():
+            for opin_key, opin_val in val.get_all_output_pins():
+                opin_val.compile_dispatch()
+        for key, val in self._filters.items():
+            val.compile_dispatch()
+        print('Dispatch plan compiled')
+
     def run(self):
         """
         Run the graph by asking each filter to transition to run mode
         :return:
         """
+        for key, val in self._services.items():
+            val.start()
+        for pin_queue in self._pin_queues:
+            pin_queue.start()
+        for key, val in self._filter_executors.items():
+            val.start()
         for key, val in self._filters.items():
             val.run()
 
     def stop(self):
+        # Flush the queues first, while the downstream filters can still accept input
+        for pin_queue in self._pin_queues:
+            pin_queue.stop()
+        # Then let the executors finish what they have in flight
+        for key, val in self._filter_executors.items():
+            val.stop()
         for key, val in self._filters.items():
             val.stop()
+        for key, val in self._services.items():
+            val.stop()
+
+    def get_worker_process_count(self):
+        """
+        Find how many worker processes the graph should be forked into, the largest count any filter asks for
+        :return: The number of processes, 1 if the graph should run in this process
+        """
+        process_count = 1
+        for key, val in self._filters.items():
+            process_count = max(process_count, val.process_count)
+        return process_count
+
+    def is_under_pressure(self):
+        """
+        Check if any of the queues in the graph is full. Sources such as TornadoSource use this to turn work away
+        instead of queuing it without limit.
+        :return: True if at least one queue is at capacity
+        """
+        for pin_queue in self._pin_queues:
+            if pin_queue.is_full:
+                return True
+        return False
 
     def filter_changed_state(self, filter):
         """
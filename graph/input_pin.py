@@ -18,6 +18,31 @@ class InputPin:
     def pin_name(self):
         return self._pin_name
 
+    @property
+    def filter(self):
+        return self._filter
+
+    def get_dispatch_map(self):
+        """
+        Return a copy of the mime type to handler map, used by the graph manager to compile the dispatch plan
+        :return: A dictionary mapping mime types to handlers. * maps everything.
+        """
+        return dict(self._mime_type_map)
+
+    def wrap_dispatchers(self, wrapper):
+        """
+        Replace each handler with wrapper(handler), ex: to run the filter on a FilterExecutor.
+        Must be called before the dispatch plan is compiled.
+        :param wrapper: A function taking a handler and returning its replacement
+        :return: None
+        """
+        wrapped = {}
+        for mime_type, disp_fun in self._mime_type_map.items():
+            # A filter often maps several mime types to the same handler, keep them sharing one wrapper
+            if disp_fun not in wrapped:
+                wrapped[disp_fun] = wrapper(disp_fun)
+            self._mime_type_map[mime_type] = wrapped[disp_fun]
+
     def recv(self, mime_type, payload, metadata_dict):
         """
         Receive a payload. Payload must be in either str or a binary sequence convertible to bytes format.
@@ -27,9 +52,18 @@ class InputPin:
         :param metadata_dict: A dictionary of metadata values to be passed down the filter chain
         :return: None
         """
+        disp_fun = self.get_dispatcher(mime_type)
+        disp_fun(mime_type, payload, metadata_dict)
+
+    def get_dispatcher(self, mime_type):
+        """
+        Find the handler for a mime type
+        :param mime_type: The mime_type of the payload
+        :return: The handler, raises ValueError if there isn't one
+        """
         disp_fun = self._mime_type_map.get(mime_type)
         if disp_fun is None:
             disp_fun = self._mime_type_map.get('*')
             if disp_fun is None:
                 raise ValueError("Pin {0} could not find a dispatcher for {1}".format(self._pin_name, mime_type))
-        disp_fun(mime_type, payload, metadata_dict)
+        return disp_fun
@@ -0,0 +1,55 @@
+import json
+
+
+class JsonPayload(str):
+    """
+    An application/json payload. It is the json text, so any filter that expects a str payload can use it as is, and
+    it also carries the decoded value, so a filter that wants the value doesn't parse the text again.
+
+    Create one with from_value when the value is at hand, ex: the query arguments of a GET in TornadoSource.
+    A JsonPayload created from text parses it the first time value is read.
+
+    Only the decoding is saved. Being a str, the text has to exist as soon as the payload does, so from_value encodes
+    the value straight away, once per payload, even if no filter ever reads the text.
+    """
+    # Replaced by the decoded value on the instance
+    _value = None
+    _has_value = False
+
+    @staticmethod
+    def from_value(value):
+        """
+        Encode a value now, keeping the value for the filters that read it
+        :param value: The json compatible value, ex: a dictionary
+        :return: A JsonPayload instance
+        """
+        payload = JsonPayload(json.dumps(value))
+        payload._value = value
+        payload._has_value = True
+        return payload
+
+    @property
+    def value(self):
+        """
+        The decoded value, parsed once
+        """
+        if not self._has_value:
+            self._value = json.loads(self)
+            self._has_value = True
+        return self._value
+
+    def __repr__(self):
+        return 'JsonPayload({0})'.format(str.__repr__(self))
+
+    @staticmethod
+    def decode(payload):
+        """
+        Get the value of a json payload, using the cached value of a JsonPayload
+        :param payload: A JsonPayload, or json text as str or bytes
+        :return: The decoded value
+        """
+        if isinstance(payload, JsonPayload):
+            return payload.value
+        if isinstance(payload, (bytes, bytearray)):
+            payload = payload.decode('utf-8')
+        return json.loads(payload)
@@ -2,6 +2,7 @@ class MimeTypes:
     ALL = '*/*'
     TEXT = 'text/plain'
     JSON = 'application/json'
+    NDJSON = 'application/x-ndjson'
     BINARY = 'application/octet-stream'
     CSV = 'text/csv'
     HTML = 'text/html'
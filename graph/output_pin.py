@@ -12,6 +12,10 @@ class OutputPin:
         self._required = required
         self._mime_types = []
         self._input_pin = None
+        # Compiled dispatch plan - see compile_dispatch
+        self._dispatch_map = None
+        self._dispatch_default = None
+        self._dispatch_pin_name = None
 
     @property
     def pin_name(self):
@@ -27,6 +31,21 @@ class OutputPin:
 
     def connect_to_pin(self, input_pin):
         self._input_pin = input_pin
+        # The graph has changed, so any compiled plan is stale
+        self._dispatch_map = None
+
+    def compile_dispatch(self):
+        """
+        Resolve the handlers of the connected input pin, so send can call them directly instead of going through
+        InputPin.recv. Called by the graph manager once the graph has been validated.
+        :return: None
+        """
+        if self._input_pin is None:
+            self._dispatch_map = None
+            return
+        self._dispatch_map = self._input_pin.get_dispatch_map()
+        self._dispatch_default = self._dispatch_map.get('*')
+        self._dispatch_pin_name = self._input_pin.pin_name
 
     def send(self, mime_type, payload, metadata_dict):
         """
@@ -37,6 +56,13 @@ class OutputPin:
         :param metadata_dict: A dictionary of metadata values to be passed down the filter chain
         :return: None
         """
+        dispatch_map = self._dispatch_map
+        if dispatch_map is not None:
+            disp_fun = dispatch_map.get(mime_type, self._dispatch_default)
+            if disp_fun is None:
+                raise ValueError("Pin {0} could not find a dispatcher for {1}".format(self._dispatch_pin_name, mime_type))
+            disp_fun(mime_type, payload, metadata_dict)
+            return
         if self._required and (self._input_pin is None):
             raise ValueError("Output pin {0} is required, but not connected".format(self._pin_name))
         if self._input_pin is not None:
@@ -0,0 +1,173 @@
+import asyncio
+from collections import deque
+
+from graph.filter_executor import FilterExecutor
+
+
+class QueueFullError(RuntimeError):
+    """
+    Raised by a PinQueue with the reject overflow policy when it is full
+    """
+    pass
+
+
+class PinQueue:
+    """
+    A bounded queue placed between an output pin and an input pin, configured per connection in pin_connections.
+    The output pin sends to the queue as if it were the input pin, and an asyncio consumer task delivers the messages
+    to the real input pin, so a slow downstream filter no longer stalls the sender.
+
+    Overflow policies, applied when a message arrives and the queue is at capacity:
+    block - The sender delivers the oldest queued message itself before queuing the new one. The sender is slowed
+            down to the pace of the consumer, which is as close to blocking as a single event loop allows.
+    drop_oldest - The oldest queued message is discarded.
+    reject - QueueFullError is raised back to the sender.
+
+    The sender has moved on by the time a queued message is delivered, so an exception from the handler can't reach
+    it. If the message belongs to a request (it has a web_handler_id), an empty message with web_response_status 500
+    is sent on each of the receiving filter's output pins instead, as FilterExecutor does, so the request is answered
+    with an error rather than waiting for its deadline.
+    """
+    CONFIG_KEY_CAPACITY = 'capacity'
+    CONFIG_KEY_OVERFLOW = 'overflow'
+    OVERFLOW_BLOCK = 'block'
+    OVERFLOW_DROP_OLDEST = 'drop_oldest'
+    OVERFLOW_REJECT = 'reject'
+    DEFAULT_CAPACITY = 1000
+
+    def __init__(self, input_pin, capacity=DEFAULT_CAPACITY, overflow=OVERFLOW_BLOCK):
+        """
+        c'tor
+        :param input_pin: The input pin that the queued messages are delivered to
+        :param capacity: The maximum number of queued messages
+        :param overflow: The overflow policy - block, drop_oldest or reject
+        """
+        if overflow not in (PinQueue.OVERFLOW_BLOCK, PinQueue.OVERFLOW_DROP_OLDEST, PinQueue.OVERFLOW_REJECT):
+            raise ValueError('Unknown queue overflow policy: {0}'.format(overflow))
+        if capacity < 1:
+            raise ValueError('Queue capacity must be at least 1')
+        self._input_pin = input_pin
+        self._capacity = capacity
+        self._overflow = overflow
+        self._queue = deque()
+        self._wakeup = None
+        self._consumer_task = None
+        self._dropped_count = 0
+
+    @staticmethod
+    def create_from_config(input_pin, queue_config):
+        """
+        Create a queue from the queue block of a pin connection
+        :param input_pin: The input pin that the queued messages are delivered to
+        :param queue_config: A dictionary with the optional keys capacity and overflow
+        :return: A PinQueue instance
+        """
+        capacity = int(queue_config.get(PinQueue.CONFIG_KEY_CAPACITY, PinQueue.DEFAULT_CAPACITY))
+        overflow = queue_config.get(PinQueue.CONFIG_KEY_OVERFLOW, PinQueue.OVERFLOW_BLOCK)
+        return PinQueue(input_pin, capacity, overflow)
+
+    @property
+    def pin_name(self):
+        return self._input_pin.pin_name
+
+    @property
+    def is_full(self):
+        return len(self._queue) >= self._capacity
+
+    @property
+    def dropped_count(self):
+        return self._dropped_count
+
+    def get_dispatch_map(self):
+        """
+        Output pins that compile their dispatch plan send everything to the queue
+        :return: A dictionary mapping every mime type to the queue
+        """
+        return {'*': self.recv}
+
+    def recv(self, mime_type, payload, metadata_dict):
+        """
+        Queue a payload for delivery to the input pin, applying the overflow policy if the queue is full.
+        The dispatcher is resolved now, so a mime type the input pin can't handle still fails in the sender.
+
+        :param mime_type: The mime_type of the payload being received
+        :param payload: The payload to be received
+        :param metadata_dict: A dictionary of metadata values to be passed down the filter chain
+        :return: None
+        """
+        disp_fun = self._input_pin.get_dispatcher(mime_type)
+        if len(self._queue) >= self._capacity:
+            if self._overflow == PinQueue.OVERFLOW_REJECT:
+                raise QueueFullError('Queue for pin {0} is full'.format(self.pin_name))
+            elif self._overflow == PinQueue.OVERFLOW_DROP_OLDEST:
+                self._queue.popleft()
+                self._dropped_count += 1
+            else:
+                self._deliver(self._queue.popleft())
+        self._queue.append((disp_fun, mime_type, payload, metadata_dict))
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def start(self):
+        """
+        Start the consumer task. Must be called on the event loop thread.
+        :return: None
+        """
+        if self._consumer_task is None:
+            self._consumer_task = asyncio.ensure_future(self._consume())
+
+    def stop(self):
+        """
+        Stop the consumer task, then deliver whatever is still queued so nothing is lost while the graph stops
+        :return: None
+        """
+        if self._consumer_task is not None:
+            self._consumer_task.cancel()
+            self._consumer_task = None
+        self._wakeup = None
+        while len(self._queue) > 0:
+            self._deliver(self._queue.popleft())
+
+    async def _consume(self):
+        """
+        Deliver queued messages one at a time, yielding to the event loop between messages
+        :return: None
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            if len(self._queue) == 0:
+                self._wakeup = loop.create_future()
+                await self._wakeup
+                continue
+            self._deliver(self._queue.popleft())
+            await asyncio.sleep(0)
+
+    def _deliver(self, item):
+        """
+        Deliver a queued message to the input pin's dispatcher
+        :param item: A tuple of (dispatcher, mime_type, payload, metadata_dict)
+        :return: None
+        """
+        disp_fun, mime_type, payload, metadata_dict = item
+        try:
+            disp_fun(mime_type, payload, metadata_dict)
+        except Exception as e:
+            print('Exception delivering queued message to pin {0}: {1}'.format(self.pin_name, e))
+            self._send_error(mime_type, metadata_dict)
+
+    def _send_error(self, mime_type, metadata_dict):
+        """
+        Report a failed delivery downstream, if the message belongs to a request
+        :param mime_type: The mime_type of the message that failed
+        :param metadata_dict: The metadata dictionary of the message that failed
+        :return: None
+        """
+        if metadata_dict is None or metadata_dict.get(FilterExecutor.METADATA_KEY_HANDLER_ID) is None:
+            return
+        error_meta = metadata_dict.copy()
+        error_meta[FilterExecutor.METADATA_KEY_RESPONSE_STATUS] = FilterExecutor.ERROR_RESPONSE_STATUS
+        for pin_name, output_pin in self._input_pin.filter.get_all_output_pins():
+            try:
+                output_pin.send(mime_type, '', error_meta)
+            except Exception as e:
+                print('Exception sending error response from pin {0}: {1}'.format(pin_name, e))
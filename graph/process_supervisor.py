@@ -0,0 +1,114 @@
+import os
+import signal
+import time
+
+
+class ProcessSupervisor:
+    """
+    Pre-fork supervisor. Forks a number of worker processes that each run a full copy of the graph, and restarts any
+    worker that dies until the supervisor itself is told to stop (SIGINT or SIGTERM).
+
+    The graph must be built, but not run, before the workers are forked, so no event loop, thread or socket is shared
+    between the processes. Sources that listen on a port (ex: TornadoSource) bind with SO_REUSEPORT in each worker,
+    and the kernel spreads the incoming connections over them.
+    """
+    # A worker that dies sooner than this after being started is restarted after RESTART_DELAY_SECONDS
+    MIN_UPTIME_SECONDS = 5.0
+    RESTART_DELAY_SECONDS = 1.0
+    # How long to wait for the workers to exit on their own before they are killed
+    STOP_TIMEOUT_SECONDS = 10.0
+    POLL_INTERVAL_SECONDS = 0.2
+
+    def __init__(self, process_count, worker_fn):
+        """
+        c'tor
+        :param process_count: The number of worker processes
+        :param worker_fn: Called with no arguments in each worker process, the worker exits when it returns
+        """
+        if process_count < 1:
+            raise ValueError('Process count must be at least 1')
+        self._process_count = process_count
+        self._worker_fn = worker_fn
+        # Start time of each running worker, keyed by pid
+        self._workers = {}
+        self._stopping = False
+
+    def run(self):
+        """
+        Fork the workers and supervise them. Returns once the supervisor has been stopped and the workers have exited.
+        :return: None
+        """
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+        for i in range(self._process_count):
+            self._start_worker()
+        while not self._stopping:
+            # Polled, since a blocking wait is transparently retried after the stop signal handler runs
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(ProcessSupervisor.POLL_INTERVAL_SECONDS)
+                continue
+            started = self._workers.pop(pid, None)
+            if started is None or self._stopping:
+                continue
+            print('Worker process {0} exited with status {1}, restarting it'.format(pid, status))
+            if time.monotonic() - started < ProcessSupervisor.MIN_UPTIME_SECONDS:
+                time.sleep(ProcessSupervisor.RESTART_DELAY_SECONDS)
+            if not self._stopping:
+                self._start_worker()
+        self._stop_workers()
+
+    def _start_worker(self):
+        """
+        Fork a worker process
+        :return: None
+        """
+        pid = os.fork()
+        if pid == 0:
+            # Worker process: SIGTERM raises KeyboardInterrupt, so the graph stops the same way it does on Ctrl-C
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            exit_code = 0
+            try:
+                self._worker_fn()
+            except BaseException as e:
+                print('Worker process {0} failed: {1}'.format(os.getpid(), e))
+                exit_code = 1
+            os._exit(exit_code)
+        self._workers[pid] = time.monotonic()
+        print('Started worker process {0}'.format(pid))
+
+    def _stop_workers(self):
+        """
+        Ask the workers to stop, and kill any that are still running after STOP_TIMEOUT_SECONDS
+        :return: None
+        """
+        for pid in self._workers.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + ProcessSupervisor.STOP_TIMEOUT_SECONDS
+        while len(self._workers) > 0 and time.monotonic() < deadline:
+            for pid in list(self._workers.keys()):
+                try:
+                    done_pid, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done_pid = pid
+                if done_pid == pid:
+                    del self._workers[pid]
+            time.sleep(ProcessSupervisor.POLL_INTERVAL_SECONDS)
+        for pid in self._workers.keys():
+            print('Worker process {0} did not stop, killing it'.format(pid))
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self._workers = {}
+
+    def _on_stop_signal(self, signum, frame):
+        self._stopping = True
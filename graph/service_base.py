@@ -0,0 +1,36 @@
+class ServiceBase:
+    """
+    Rosetta graph service base object. A service is a named object shared by every filter of the graph, ex: a pooled
+    http client. Services are declared in the services block of the graph config, and filters look them up by name
+    through GraphManager.get_service.
+
+    Life cycle:
+    - The graph manager starts the services before any filter is run
+    - The graph manager stops the services after every filter has been asked to stop
+    """
+    def __init__(self, name, config_dict, graph_manager):
+        self._service_name = name
+        self._config_dict = config_dict
+        self._graph_manager = graph_manager
+
+    @property
+    def service_name(self):
+        return self._service_name
+
+    @property
+    def config_dict(self):
+        return self._config_dict
+
+    def start(self):
+        """
+        Called by the graph manager, on the event loop thread, before the filters are run
+        :return: None
+        """
+        pass
+
+    def stop(self):
+        """
+        Called by the graph manager after the filters have been stopped
+        :return: None
+        """
+        pass
@@ -1,8 +1,9 @@
-from threading import Thread
+from threading import Event, Thread
 import asyncio
 import argparse
 from graph.graph_builder import GraphBuilder
 from graph.graph_manager import GraphManager
+from graph.process_supervisor import ProcessSupervisor
 
 config_filename = 'config.json'
 parser = argparse.ArgumentParser()
@@ -31,23 +32,41 @@ def start_loop(loop):
     loop.close()
     print("After loop close")
 
-def stop_loop():
+# Set by stop_loop once the graph has stopped
+graph_stopped = Event()
+
+def stop_loop(loop):
     print("Before graph mgr stop")
-    graph_manager.stop()
-    print("After graph mgr stop")
-
-new_loop = asyncio.new_event_loop()
-t = Thread(target=start_loop, args=(new_loop,))
-t.start()
-
-# Wait for termination
-try:
-    print("Waiting for termination...")
-    t.join()
-    print("...after join")
-except KeyboardInterrupt:
-    print("...keyboard interrupt")
-    new_loop.call_soon_threadsafe(stop_loop)
-    new_loop.stop()
-    print("all done!")
+    try:
+        graph_manager.stop()
+        print("After graph mgr stop")
+    finally:
+        # Stopped from the loop thread, after the graph, so the loop is still running while the filters stop
+        loop.stop()
+        graph_stopped.set()
+
+def run_graph():
+    new_loop = asyncio.new_event_loop()
+    t = Thread(target=start_loop, args=(new_loop,))
+    t.start()
+
+    # Wait for termination
+    try:
+        print("Waiting for termination...")
+        t.join()
+        print("...after join")
+    except KeyboardInterrupt:
+        print("...keyboard interrupt")
+        new_loop.call_soon_threadsafe(stop_loop, new_loop)
+        # Let the graph finish stopping before returning, a worker process exits as soon as this returns
+        graph_stopped.wait()
+        t.join()
+        print("all done!")
 
+process_count = graph_manager.get_worker_process_count()
+if process_count > 1:
+    # Each worker process runs its own copy of the graph, the supervisor restarts any that die
+    print('Forking {0} worker processes'.format(process_count))
+    ProcessSupervisor(process_count, run_graph).run()
+else:
+    run_graph()
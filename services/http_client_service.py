@@ -0,0 +1,201 @@
+import socket
+import time
+from urllib.parse import urlsplit
+
+from tornado import locks
+from tornado.netutil import Resolver
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from graph.service_base import ServiceBase
+
+try:
+    import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    pycurl = None
+
+
+class HttpClientService(ServiceBase):
+    """
+    A pooled http client shared by the http filters of the graph (HttpClientSource, HttpClientSink), so they stop
+    paying for a new client, connection and DNS lookup on every message.
+
+    The client is libcurl based when pycurl is installed, which keeps connections to a host alive between requests.
+    Otherwise tornado's simple client is used, which opens a connection per request, but still shares the DNS cache
+    and the connection limits. pycurl is an optional dependency, a warning is printed when the service is created
+    without it (unless keep_alive is false), since the connection setup is then paid on every request.
+
+    Config - all keys optional:
+    max_clients - Upper bound on the requests in flight, further requests are queued by the client
+    max_connections_per_host - Upper bound on the requests in flight to a single host, 0 for no limit
+    connect_timeout_seconds - Timeout of the connection setup
+    request_timeout_seconds - Timeout of the whole request
+    dns_cache_ttl_seconds - How long a DNS lookup is reused, 0 to disable the cache
+    keep_alive - false to use the simple client even if pycurl is installed
+    user_agent - The User-Agent header of the requests
+    validate_cert - true to validate the certificate of https servers
+    max_body_size - Upper bound on the size of a response body, raise it for large streamed downloads. Only enforced
+                    by the simple client, which defaults to 100MB.
+
+    Filters find the service by name, see get_shared. A service named http_client is created with the defaults if
+    the graph config doesn't declare one.
+    """
+    CONFIG_KEY_MAX_CLIENTS = 'max_clients'
+    CONFIG_KEY_MAX_CONNECTIONS_PER_HOST = 'max_connections_per_host'
+    CONFIG_KEY_CONNECT_TIMEOUT_SECONDS = 'connect_timeout_seconds'
+    CONFIG_KEY_REQUEST_TIMEOUT_SECONDS = 'request_timeout_seconds'
+    CONFIG_KEY_DNS_CACHE_TTL_SECONDS = 'dns_cache_ttl_seconds'
+    CONFIG_KEY_KEEP_ALIVE = 'keep_alive'
+    CONFIG_KEY_USER_AGENT = 'user_agent'
+    CONFIG_KEY_VALIDATE_CERT = 'validate_cert'
+    CONFIG_KEY_MAX_BODY_SIZE = 'max_body_size'
+    DEFAULT_SERVICE_NAME = 'http_client'
+    DEFAULT_MAX_CLIENTS = 10
+    DEFAULT_MAX_CONNECTIONS_PER_HOST = 4
+    DEFAULT_CONNECT_TIMEOUT_SECONDS = 20.0
+    DEFAULT_REQUEST_TIMEOUT_SECONDS = 20.0
+    DEFAULT_DNS_CACHE_TTL_SECONDS = 300.0
+    DEFAULT_USER_AGENT = 'Rosetta/1.0'
+
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager)
+        self._max_clients = int(config_dict.get(HttpClientService.CONFIG_KEY_MAX_CLIENTS, HttpClientService.DEFAULT_MAX_CLIENTS))
+        self._max_connections_per_host = int(config_dict.get(HttpClientService.CONFIG_KEY_MAX_CONNECTIONS_PER_HOST,
+                                                             HttpClientService.DEFAULT_MAX_CONNECTIONS_PER_HOST))
+        self._dns_cache_ttl_seconds = float(config_dict.get(HttpClientService.CONFIG_KEY_DNS_CACHE_TTL_SECONDS,
+                                                            HttpClientService.DEFAULT_DNS_CACHE_TTL_SECONDS))
+        self._max_body_size = config_dict.get(HttpClientService.CONFIG_KEY_MAX_BODY_SIZE)
+        keep_alive = config_dict.get(HttpClientService.CONFIG_KEY_KEEP_ALIVE, True)
+        if keep_alive and pycurl is None:
+            print('WARNING: {0} can not keep connections alive since pycurl is not installed, every request opens '
+                  'a new connection. Install pycurl to pool connections.'.format(name))
+        self._keep_alive = keep_alive and pycurl is not None
+        self._defaults = dict(
+            user_agent=config_dict.get(HttpClientService.CONFIG_KEY_USER_AGENT, HttpClientService.DEFAULT_USER_AGENT),
+            connect_timeout=float(config_dict.get(HttpClientService.CONFIG_KEY_CONNECT_TIMEOUT_SECONDS,
+                                                  HttpClientService.DEFAULT_CONNECT_TIMEOUT_SECONDS)),
+            request_timeout=float(config_dict.get(HttpClientService.CONFIG_KEY_REQUEST_TIMEOUT_SECONDS,
+                                                  HttpClientService.DEFAULT_REQUEST_TIMEOUT_SECONDS)),
+            validate_cert=config_dict.get(HttpClientService.CONFIG_KEY_VALIDATE_CERT, False))
+        if self._keep_alive and self._dns_cache_ttl_seconds > 0:
+            self._defaults['prepare_curl_callback'] = self._prepare_curl
+        # Created on the event loop on first use, since a tornado client is bound to the loop it was created on
+        self._client = None
+        self._resolver = None
+        # Connection limit of each host: host key -> [semaphore, number of requests holding or waiting for it]
+        self._host_slots = {}
+
+    @staticmethod
+    def get_shared(graph_manager, service_name=None):
+        """
+        Find the http client service of the graph, creating one with the default config if there's none yet
+        :param graph_manager: The graph manager of the filter
+        :param service_name: The name of the service, or None for DEFAULT_SERVICE_NAME
+        :return: An HttpClientService instance
+        """
+        if service_name is None:
+            service_name = HttpClientService.DEFAULT_SERVICE_NAME
+        service = graph_manager.get_service(service_name)
+        if service is None:
+            service = HttpClientService(service_name, {}, graph_manager)
+            graph_manager.register_service(service)
+        elif not isinstance(service, HttpClientService):
+            raise TypeError('Service {0} is not an http client service'.format(service_name))
+        return service
+
+    @property
+    def keep_alive(self):
+        return self._keep_alive
+
+    def stop(self):
+        super().stop()
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        if self._resolver is not None:
+            self._resolver.close()
+            self._resolver = None
+        self._host_slots = {}
+
+    async def fetch(self, request_uri, **kwargs):
+        """
+        Make a request with the shared client, waiting for a free connection slot of the host first
+        :param request_uri: The URI to access on the remote server
+        :param kwargs: Passed to tornado's HTTPRequest, ex: method, headers, body
+        :return: The tornado HTTPResponse
+        """
+        client = self._get_client()
+        if self._max_connections_per_host <= 0:
+            return await client.fetch(request_uri, **kwargs)
+        host_key = self._get_host_key(request_uri)
+        slot = self._host_slots.get(host_key)
+        if slot is None:
+            slot = [locks.Semaphore(self._max_connections_per_host), 0]
+            self._host_slots[host_key] = slot
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                return await client.fetch(request_uri, **kwargs)
+        finally:
+            slot[1] -= 1
+            if slot[1] == 0 and self._host_slots.get(host_key) is slot:
+                # Don't keep a semaphore for every host ever contacted
+                del self._host_slots[host_key]
+
+    def _get_client(self):
+        if self._client is None:
+            if self._keep_alive:
+                self._client = CurlAsyncHTTPClient(force_instance=True, max_clients=self._max_clients,
+                                                   defaults=self._defaults)
+            else:
+                if self._dns_cache_ttl_seconds > 0:
+                    self._resolver = CachingResolver(ttl_seconds=self._dns_cache_ttl_seconds)
+                self._client = SimpleAsyncHTTPClient(force_instance=True, max_clients=self._max_clients,
+                                                     resolver=self._resolver, defaults=self._defaults,
+                                                     max_body_size=self._max_body_size)
+        return self._client
+
+    def _prepare_curl(self, curl):
+        # libcurl keeps its own DNS cache per handle, only its lifetime needs setting
+        curl.setopt(pycurl.DNS_CACHE_TIMEOUT, int(self._dns_cache_ttl_seconds))
+
+    @staticmethod
+    def _get_host_key(request_uri):
+        parts = urlsplit(request_uri)
+        return parts.scheme, parts.netloc.lower()
+
+
+class CachingResolver(Resolver):
+    """
+    A DNS resolver that reuses the result of a lookup for ttl_seconds
+    """
+    def initialize(self, resolver=None, ttl_seconds=HttpClientService.DEFAULT_DNS_CACHE_TTL_SECONDS):
+        """
+        :param resolver: The resolver doing the actual lookups, or None for tornado's default resolver
+        :param ttl_seconds: How long a lookup is reused
+        """
+        if resolver is None:
+            resolver = Resolver()
+            self._own_resolver = True
+        else:
+            self._own_resolver = False
+        self._resolver = resolver
+        self._ttl_seconds = ttl_seconds
+        # (host, port, family) -> (expires_at, list of (family, address))
+        self._entries = {}
+
+    def close(self):
+        if self._own_resolver:
+            self._resolver.close()
+        self._entries = {}
+
+    async def resolve(self, host, port, family=socket.AF_UNSPEC):
+        key = (host, port, family)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        addresses = await self._resolver.resolve(host, port, family)
+        # Drop the expired entries here, rather than on a timer
+        self._entries = {k: v for k, v in self._entries.items() if v[0] > now}
+        self._entries[key] = (now + self._ttl_seconds, addresses)
+        return addresses
@@ -0,0 +1,199 @@
+import os
+import queue
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+
+class SqliteDatabase:
+    """
+    Opens the connections used by the sqlite filters and applies the tuning profile to them.
+
+    There is a single writer connection, plus an optional pool of read-only connections so reads can run while the
+    writer holds its lock (this works best with journal_mode=WAL).
+
+    Tuning profile - the sqlite_tuning config block, all keys optional:
+    journal_mode - ex: WAL, DELETE, TRUNCATE
+    synchronous - ex: OFF, NORMAL, FULL
+    cache_size - Number of pages, or KiB if negative
+    mmap_size - Bytes of the db file to memory map
+    temp_store - ex: DEFAULT, FILE, MEMORY
+    busy_timeout - Milliseconds to wait on a locked db before giving up
+    auto_vacuum - ex: NONE, FULL, INCREMENTAL. Only takes effect on a new db, an existing one needs a one-off VACUUM.
+    """
+    CONFIG_KEY_DB_FILENAME = 'db_filename'
+    CONFIG_KEY_TUNING = 'sqlite_tuning'
+    CONFIG_KEY_READER_POOL_SIZE = 'reader_pool_size'
+    # Pragmas that take a keyword value
+    KEYWORD_PRAGMAS = ('auto_vacuum', 'journal_mode', 'synchronous', 'temp_store')
+    # Pragmas that take an integer value
+    INTEGER_PRAGMAS = ('cache_size', 'mmap_size', 'busy_timeout')
+    # Pragmas that change the db file, which a read-only connection can't do, these are only set by the writer.
+    # The others, synchronous included, are per connection and are set on the readers too.
+    WRITER_ONLY_PRAGMAS = ('auto_vacuum', 'journal_mode')
+    AUTO_VACUUM_INCREMENTAL = 2
+    DEFAULT_READER_POOL_SIZE = 0
+    DEFAULT_ACQUIRE_TIMEOUT_SECONDS = 30.0
+    KEYWORD_RE = re.compile(r'^[A-Za-z]+$')
+
+    def __init__(self, db_filename, tuning_dict=None, reader_pool_size=DEFAULT_READER_POOL_SIZE):
+        """
+        c'tor
+        :param db_filename: The filename of the sqlite db
+        :param tuning_dict: The tuning profile, see the class docstring
+        :param reader_pool_size: The maximum number of read-only connections, 0 disables the pool
+        """
+        self._db_filename = db_filename
+        self._pragmas = SqliteDatabase._validate_tuning(tuning_dict)
+        self._reader_pool_size = int(reader_pool_size)
+        self._idle_readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config_dict):
+        """
+        Create an instance from a filter's config dictionary
+        :param config_dict: The config dictionary of the filter. Must contain db_filename.
+        :return: A SqliteDatabase instance
+        """
+        db_filename = config_dict[SqliteDatabase.CONFIG_KEY_DB_FILENAME]
+        reader_pool_size = config_dict.get(SqliteDatabase.CONFIG_KEY_READER_POOL_SIZE)
+        if reader_pool_size is None:
+            reader_pool_size = SqliteDatabase.DEFAULT_READER_POOL_SIZE
+        return SqliteDatabase(db_filename, config_dict.get(SqliteDatabase.CONFIG_KEY_TUNING), reader_pool_size)
+
+    @property
+    def db_filename(self):
+        return self._db_filename
+
+    @property
+    def is_incremental_vacuum(self):
+        return self._pragmas.get('auto_vacuum') == 'INCREMENTAL'
+
+    @property
+    def has_reader_pool(self):
+        return self._reader_pool_size > 0
+
+    def open_writer(self, **kwargs):
+        """
+        Open the read / write connection and apply the whole tuning profile to it
+        :param kwargs: Passed through to sqlite3.connect
+        :return: A sqlite3 connection
+        """
+        conn = sqlite3.connect(self._db_filename, **kwargs)
+        self._apply_pragmas(conn, True)
+        if self.is_incremental_vacuum:
+            auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            if auto_vacuum != SqliteDatabase.AUTO_VACUUM_INCREMENTAL:
+                print('{0} was created without auto_vacuum=INCREMENTAL, run VACUUM once to convert it'.format(self._db_filename))
+        return conn
+
+    def acquire_reader(self, timeout=DEFAULT_ACQUIRE_TIMEOUT_SECONDS):
+        """
+        Take a read-only connection from the pool, opening a new one if the pool isn't full yet.
+        Blocks for up to timeout seconds if every connection is in use.
+        :param timeout: Seconds to wait for a connection
+        :return: A read-only sqlite3 connection, which must be handed back with release_reader
+        """
+        if not self.has_reader_pool:
+            raise RuntimeError('The reader pool for {0} is disabled'.format(self._db_filename))
+        try:
+            return self._idle_readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._reader_lock:
+            can_open = self._reader_count < self._reader_pool_size
+            if can_open:
+                self._reader_count += 1
+        if can_open:
+            try:
+                return self._open_reader()
+            except Exception:
+                with self._reader_lock:
+                    self._reader_count -= 1
+                raise
+        try:
+            return self._idle_readers.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError('Timed out waiting for a reader connection to {0}'.format(self._db_filename))
+
+    def release_reader(self, conn):
+        """
+        Hand a read-only connection back to the pool
+        :param conn: A connection previously returned by acquire_reader
+        :return: None
+        """
+        self._idle_readers.put(conn)
+
+    @contextmanager
+    def reader(self):
+        """
+        Context manager that acquires and releases a read-only connection
+        """
+        conn = self.acquire_reader()
+        try:
+            yield conn
+        finally:
+            self.release_reader(conn)
+
+    def close_readers(self):
+        """
+        Close all of the idle read-only connections
+        :return: None
+        """
+        while True:
+            try:
+                conn = self._idle_readers.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._reader_lock:
+                self._reader_count -= 1
+
+    def _open_reader(self):
+        """
+        Open a new read-only connection. These may be used from any thread, but only by one thread at a time.
+        :return: A sqlite3 connection
+        """
+        uri = 'file:{0}?mode=ro'.format(pathname2url(os.path.abspath(self._db_filename)))
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self._apply_pragmas(conn, False)
+        conn.execute('PRAGMA query_only = 1')
+        return conn
+
+    def _apply_pragmas(self, conn, is_writer):
+        """
+        Apply the tuning profile to a connection
+        :param conn: The connection to tune
+        :param is_writer: True for the writer connection, False for a read-only connection
+        :return: None
+        """
+        # Sorted so auto_vacuum is set before journal_mode, a new db has to pick it up before its first write
+        for key in sorted(self._pragmas.keys()):
+            value = self._pragmas[key]
+            if is_writer or key not in SqliteDatabase.WRITER_ONLY_PRAGMAS:
+                conn.execute('PRAGMA {0} = {1}'.format(key, value))
+
+    @staticmethod
+    def _validate_tuning(tuning_dict):
+        """
+        Check the tuning profile, since pragma values can't be passed as sql parameters
+        :param tuning_dict: The tuning profile from the config
+        :return: A dictionary of pragma names to validated values
+        """
+        pragmas = {}
+        if tuning_dict is None:
+            return pragmas
+        for key, value in tuning_dict.items():
+            if key in SqliteDatabase.KEYWORD_PRAGMAS:
+                if not SqliteDatabase.KEYWORD_RE.match(str(value)):
+                    raise ValueError('Invalid value for sqlite pragma {0}: {1}'.format(key, value))
+                pragmas[key] = str(value).upper()
+            elif key in SqliteDatabase.INTEGER_PRAGMAS:
+                pragmas[key] = int(value)
+            else:
+                raise ValueError('Unsupported sqlite pragma: {0}'.format(key))
+        return pragmas
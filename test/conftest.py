@@ -0,0 +1,22 @@
+import asyncio
+import collections
+import collections.abc
+
+import pytest
+
+# tornado < 6 imports the abstract base classes from collections, where Python 3.10 no longer provides them
+for _abc_name in ('MutableMapping', 'Mapping', 'Sequence', 'Iterable', 'Callable', 'Hashable'):
+    if not hasattr(collections, _abc_name):
+        setattr(collections, _abc_name, getattr(collections.abc, _abc_name))
+
+
+@pytest.fixture
+def event_loop():
+    """
+    A fresh event loop, set as the current loop for filters that capture it in run()
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
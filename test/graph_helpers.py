@@ -0,0 +1,80 @@
+from graph.filter_base import FilterBase, FilterState, FilterType
+from graph.graph_manager import GraphManager
+from graph.input_pin import InputPin
+from graph.output_pin import OutputPin
+
+
+class CollectorSink(FilterBase):
+    """
+    A sink that records every message it receives, used to check what a filter sends downstream
+    """
+    filter_pad_templates = {}
+    filter_meta = {}
+
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager, FilterType.sink)
+        self.messages = []
+        self._add_input_pin(InputPin('input', {'*': self.recv}, self))
+
+    def run(self):
+        super().run()
+        self._set_filter_state(FilterState.running)
+
+    def stop(self):
+        super().stop()
+        self._set_filter_state(FilterState.stopped)
+
+    def recv(self, mime_type, payload, metadata_dict):
+        self.messages.append((mime_type, payload, metadata_dict))
+
+    @staticmethod
+    def get_filter_metadata():
+        return FilterBase.filter_meta
+
+    @staticmethod
+    def get_filter_pad_templates():
+        return FilterBase.filter_pad_templates
+
+
+class InjectorSource(FilterBase):
+    """
+    A source whose output pin the test drives directly
+    """
+    filter_pad_templates = {}
+    filter_meta = {}
+
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager, FilterType.source)
+        self.output_pin = OutputPin('output', True)
+        self._add_output_pin(self.output_pin)
+
+    def run(self):
+        super().run()
+        self._set_filter_state(FilterState.running)
+
+    def stop(self):
+        super().stop()
+        self._set_filter_state(FilterState.stopped)
+
+    @staticmethod
+    def get_filter_metadata():
+        return FilterBase.filter_meta
+
+    @staticmethod
+    def get_filter_pad_templates():
+        return FilterBase.filter_pad_templates
+
+
+def connect_to_collector(graph_manager, filter_instance, pin_name='output'):
+    """
+    Add a CollectorSink to the graph and connect it to an output pin of a filter
+    :return: The collector
+    """
+    collector = CollectorSink(filter_instance.filter_name + '_collector', {}, graph_manager)
+    graph_manager.add_filter(collector)
+    filter_instance.get_output_pin(pin_name).connect_to_pin(collector.get_input_pin('input'))
+    return collector
+
+
+def new_graph_manager():
+    return GraphManager()
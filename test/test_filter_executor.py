@@ -0,0 +1,188 @@
+import asyncio
+import time
+
+import pytest
+
+from graph.filter_base import FilterBase, FilterState, FilterType
+from graph.filter_executor import FilterExecutor
+from graph.input_pin import InputPin
+from graph.output_pin import OutputPin
+from test.graph_helpers import InjectorSource, connect_to_collector, new_graph_manager
+
+
+class SleepyEcho(FilterBase):
+    """
+    Sleeps for payload seconds then sends the payload on, or raises if the payload is negative.
+    The output's metadata records when the handler started and finished, from a clock shared by every process.
+    """
+    filter_pad_templates = {}
+    filter_meta = {}
+
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager, FilterType.transform)
+        self._add_input_pin(InputPin('input', {'*': self.recv}, self))
+        self._output_pin = OutputPin('output', True)
+        self._add_output_pin(self._output_pin)
+
+    def run(self):
+        super().run()
+        self._set_filter_state(FilterState.running)
+
+    def stop(self):
+        super().stop()
+        self._set_filter_state(FilterState.stopped)
+
+    def recv(self, mime_type, payload, metadata_dict):
+        if payload < 0:
+            raise ValueError('negative payload')
+        started = time.monotonic()
+        time.sleep(payload)
+        meta_dict = dict(metadata_dict)
+        meta_dict['handled'] = (started, time.monotonic())
+        self._output_pin.send(mime_type, payload, meta_dict)
+
+    @staticmethod
+    def get_filter_metadata():
+        return FilterBase.filter_meta
+
+    @staticmethod
+    def get_filter_pad_templates():
+        return FilterBase.filter_pad_templates
+
+
+class BufferedWriter(FilterBase):
+    """
+    Buffers the payloads it receives, and appends them to the file named filename, one per line, when it stops
+    """
+    filter_pad_templates = {}
+    filter_meta = {}
+
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager, FilterType.sink)
+        self._pending = []
+        self._add_input_pin(InputPin('input', {'*': self.recv}, self))
+
+    def run(self):
+        super().run()
+        self._set_filter_state(FilterState.running)
+
+    def stop(self):
+        super().stop()
+        with open(self._config_dict['filename'], 'a') as f:
+            for payload in self._pending:
+                f.write('{0}\n'.format(payload))
+        self._pending = []
+        self._set_filter_state(FilterState.stopped)
+
+    def recv(self, mime_type, payload, metadata_dict):
+        self._pending.append(payload)
+
+    @staticmethod
+    def get_filter_metadata():
+        return FilterBase.filter_meta
+
+    @staticmethod
+    def get_filter_pad_templates():
+        return FilterBase.filter_pad_templates
+
+
+def build_graph(executor_type, workers=4):
+    graph_manager = new_graph_manager()
+    source = InjectorSource('source', {}, graph_manager)
+    echo = SleepyEcho('echo', {}, graph_manager)
+    graph_manager.add_filter(source)
+    graph_manager.add_filter(echo)
+    graph_manager.connect_pins('source', 'output', 'echo', 'input')
+    collector = connect_to_collector(graph_manager, echo)
+    graph_manager.set_filter_executor('echo', executor_type, workers)
+    assert graph_manager.validate_graph()
+    graph_manager.run()
+    return graph_manager, source, collector
+
+
+def wait_for_messages(event_loop, collector, count):
+    async def wait():
+        while len(collector.messages) < count:
+            await asyncio.sleep(0.01)
+    event_loop.run_until_complete(asyncio.wait_for(wait(), 30))
+
+
+@pytest.mark.parametrize('executor_type', [FilterExecutor.EXECUTOR_THREAD, FilterExecutor.EXECUTOR_PROCESS])
+def test_output_is_released_in_input_order(event_loop, executor_type):
+    graph_manager, source, collector = build_graph(executor_type)
+    # The first message takes the longest, so it finishes last
+    delays = [0.2, 0.1, 0.0, 0.05]
+    for delay in delays:
+        source.output_pin.send('text/plain', delay, {})
+    wait_for_messages(event_loop, collector, len(delays))
+    assert [payload for mime_type, payload, metadata in collector.messages] == delays
+    graph_manager.stop()
+
+
+@pytest.mark.parametrize('executor_type', [FilterExecutor.EXECUTOR_THREAD, FilterExecutor.EXECUTOR_PROCESS])
+def test_handlers_run_one_at_a_time_in_input_order_by_default(event_loop, executor_type):
+    graph_manager, source, collector = build_graph(executor_type, None)
+    delays = [0.1, 0.0, 0.05, 0.0]
+    for delay in delays:
+        source.output_pin.send('text/plain', delay, {})
+    wait_for_messages(event_loop, collector, len(delays))
+    handled = [metadata['handled'] for mime_type, payload, metadata in collector.messages]
+    # Each handler starts only once the handler of the message before it has finished
+    for previous, current in zip(handled, handled[1:]):
+        assert current[0] >= previous[1]
+    graph_manager.stop()
+
+
+@pytest.mark.parametrize('executor_type', [FilterExecutor.EXECUTOR_THREAD, FilterExecutor.EXECUTOR_PROCESS])
+def test_handler_failure_is_sent_on_as_an_error_response(event_loop, executor_type):
+    graph_manager, source, collector = build_graph(executor_type)
+    source.output_pin.send('text/plain', -1, {'web_handler_id': 7})
+    source.output_pin.send('text/plain', 0, {'web_handler_id': 8})
+    wait_for_messages(event_loop, collector, 2)
+    mime_type, payload, metadata = collector.messages[0]
+    assert payload == '' and metadata == {'web_handler_id': 7, 'web_response_status': 500}
+    # The failure doesn't hold up the messages behind it
+    assert collector.messages[1][1] == 0
+    graph_manager.stop()
+
+
+def test_failure_outside_of_a_request_is_only_logged(event_loop):
+    graph_manager, source, collector = build_graph(FilterExecutor.EXECUTOR_THREAD)
+    source.output_pin.send('text/plain', -1, {})
+    source.output_pin.send('text/plain', 0, {})
+    wait_for_messages(event_loop, collector, 1)
+    assert [payload for mime_type, payload, metadata in collector.messages] == [0]
+    graph_manager.stop()
+
+
+def test_message_after_stop_is_rejected(event_loop):
+    graph_manager, source, collector = build_graph(FilterExecutor.EXECUTOR_THREAD)
+    graph_manager.stop()
+    with pytest.raises(RuntimeError):
+        source.output_pin.send('text/plain', 0, {})
+
+
+def test_executor_must_implement_submit():
+    with pytest.raises(TypeError):
+        FilterExecutor(None)
+
+
+
+@pytest.mark.parametrize('executor_type', [FilterExecutor.EXECUTOR_THREAD, FilterExecutor.EXECUTOR_PROCESS])
+def test_filter_is_stopped_with_its_executor(tmp_path, event_loop, executor_type):
+    filename = str(tmp_path / 'written.txt')
+    graph_manager = new_graph_manager()
+    source = InjectorSource('source', {}, graph_manager)
+    writer = BufferedWriter('writer', {'filename': filename}, graph_manager)
+    graph_manager.add_filter(source)
+    graph_manager.add_filter(writer)
+    graph_manager.connect_pins('source', 'output', 'writer', 'input')
+    graph_manager.set_filter_executor('writer', executor_type)
+    assert graph_manager.validate_graph()
+    graph_manager.run()
+    for i in range(50):
+        source.output_pin.send('text/plain', i, {})
+    graph_manager.stop()
+    # For the process executor, the payloads were buffered by the replica in the worker process
+    with open(filename) as f:
+        assert f.read().split() == [str(i) for i in range(50)]
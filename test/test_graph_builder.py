@@ -1,35 +1,69 @@
-from filters.dummy_sink import DummySink
-from filters.dummy_source import DummySource
-from filters.logger_sink import LoggerSink
+import asyncio
+import json
 
+from graph.graph_builder import GraphBuilder
+from services.http_client_service import HttpClientService
+from test.graph_helpers import new_graph_manager
 
-class TestGraphBuilder:
+
+def graph_config(**tee_config):
     """
-    A fake graph builder used only for testing
+    A source, a tee and a collector on each tee output, with a queue on the first output
     """
-    def __init__(self):
-        self._filters = {}
-        source_filter = DummySource('dummy_source')
-        logging_filter = LoggerSink('print_logger')
-        sink_filter = DummySink('dummy_sink')
-        self._filters[source_filter.filter_name] = source_filter
-        self._filters[logging_filter.filter_name] = logging_filter
-        self._filters[sink_filter.filter_name] = sink_filter
-        self._wire_up_pins()
-        self._run_graph()
-
-    def _wire_up_pins(self):
-        src_filter = self._filters.get('dummy_source')
-        src_output = src_filter.get_output_pin('output')
-        logging_filter = self._filters.get('print_logger')
-        logger_input = logging_filter.get_input_pin('input')
-        logger_output = logging_filter.get_output_pin('output')
-        sink_filter = self._filters.get('dummy_sink')
-        sink_input = sink_filter.get_input_pin('input')
-        # Connect pins
-        src_output.connect_to_pin(logger_input)
-        logger_output.connect_to_pin(sink_input)
-
-    def _run_graph(self):
-        for key, val in self._filters.items():
-            val.run()
+    tee = {'module_path': 'filters.tee_filter', 'class_name': 'TeeFilter', 'instance_name': 'tee',
+           'config': {'output_pin_count': 2}}
+    tee.update(tee_config)
+    return {
+        'rosetta_config': '1.0.0',
+        'services': [
+            {'module_path': 'services.http_client_service', 'class_name': 'HttpClientService',
+             'instance_name': 'http_client', 'config': {'max_clients': 3}}
+        ],
+        'filters': [
+            {'module_path': 'test.graph_helpers', 'class_name': 'InjectorSource', 'instance_name': 'source',
+             'config': {}},
+            tee,
+            {'module_path': 'test.graph_helpers', 'class_name': 'CollectorSink', 'instance_name': 'sink_1',
+             'config': {}},
+            {'module_path': 'test.graph_helpers', 'class_name': 'CollectorSink', 'instance_name': 'sink_2',
+             'config': {}}
+        ],
+        'pin_connections': [
+            {'source_filter': 'source', 'source_pin': 'output', 'target_filter': 'tee', 'target_pin': 'input'},
+            {'source_filter': 'tee', 'source_pin': 'output1', 'target_filter': 'sink_1', 'target_pin': 'input',
+             'queue': {'capacity': 4, 'overflow': 'drop_oldest'}},
+            {'source_filter': 'tee', 'source_pin': 'output2', 'target_filter': 'sink_2', 'target_pin': 'input'}
+        ]
+    }
+
+
+def build(config):
+    graph_manager = new_graph_manager()
+    GraphBuilder(graph_manager, json.dumps(config)).build_graph()
+    return graph_manager
+
+
+def test_builds_and_wires_the_filters(event_loop):
+    graph_manager = build(graph_config())
+    assert graph_manager.validate_graph()
+    graph_manager.run()
+    graph_manager._filters['source'].output_pin.send('text/plain', 'hello', {})
+    assert graph_manager._filters['sink_2'].messages == [('text/plain', 'hello', {})]
+    # The first output goes through the queue, which hands the message over on the event loop
+    assert len(graph_manager._pin_queues) == 1
+    assert graph_manager._filters['sink_1'].messages == []
+    event_loop.run_until_complete(asyncio.sleep(0.05))
+    assert graph_manager._filters['sink_1'].messages == [('text/plain', 'hello', {})]
+    graph_manager.stop()
+
+
+def test_services_are_registered_before_the_filters():
+    graph_manager = build(graph_config())
+    service = graph_manager.get_service(HttpClientService.DEFAULT_SERVICE_NAME)
+    assert isinstance(service, HttpClientService)
+    assert service.config_dict['max_clients'] == 3
+
+
+def test_executor_is_set_from_the_filter_block():
+    graph_manager = build(graph_config(executor='thread', executor_workers=2))
+    assert 'tee' in graph_manager._filter_executors
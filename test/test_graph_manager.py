@@ -0,0 +1,60 @@
+import pytest
+
+from graph.filter_base import FilterBase, FilterState, FilterType
+from graph.input_pin import InputPin
+from test.graph_helpers import CollectorSink, InjectorSource, new_graph_manager
+
+
+class JsonOnlySink(CollectorSink):
+    """
+    A collector that only accepts application/json
+    """
+    def __init__(self, name, config_dict, graph_manager):
+        FilterBase.__init__(self, name, config_dict, graph_manager, FilterType.sink)
+        self.messages = []
+        self._add_input_pin(InputPin('input', {'application/json': self.recv}, self))
+
+
+def build_graph(sink_class=CollectorSink):
+    graph_manager = new_graph_manager()
+    source = InjectorSource('source', {}, graph_manager)
+    sink = sink_class('sink', {}, graph_manager)
+    graph_manager.add_filter(source)
+    graph_manager.add_filter(sink)
+    graph_manager.connect_pins('source', 'output', 'sink', 'input')
+    return graph_manager, source, sink
+
+
+def test_compiled_plan_dispatches_to_the_handler():
+    graph_manager, source, sink = build_graph()
+    assert graph_manager.validate_graph()
+    source.output_pin.send('text/plain', 'hello', {'k': 1})
+    assert sink.messages == [('text/plain', 'hello', {'k': 1})]
+
+
+def test_compiled_plan_rejects_unknown_mime_types():
+    graph_manager, source, sink = build_graph(JsonOnlySink)
+    assert graph_manager.validate_graph()
+    with pytest.raises(ValueError):
+        source.output_pin.send('text/plain', 'hello', {})
+    assert sink.messages == []
+
+
+def test_connecting_a_pin_discards_the_stale_plan():
+    graph_manager, source, sink = build_graph()
+    assert graph_manager.validate_graph()
+    other_sink = CollectorSink('other_sink', {}, graph_manager)
+    graph_manager.add_filter(other_sink)
+    graph_manager.connect_pins('source', 'output', 'other_sink', 'input')
+    source.output_pin.send('text/plain', 'hello', {})
+    assert sink.messages == []
+    assert len(other_sink.messages) == 1
+
+
+def test_run_and_stop_reach_every_filter():
+    graph_manager, source, sink = build_graph()
+    assert graph_manager.validate_graph()
+    graph_manager.run()
+    assert source.filter_state == FilterState.running and sink.filter_state == FilterState.running
+    graph_manager.stop()
+    assert source.filter_state == FilterState.stopped and sink.filter_state == FilterState.stopped
@@ -0,0 +1,75 @@
+import asyncio
+import socket
+
+import pytest
+from tornado.netutil import Resolver
+
+from graph.service_base import ServiceBase
+from services.http_client_service import CachingResolver, HttpClientService
+from test.graph_helpers import new_graph_manager
+from test.test_http_client_source import DocumentServer, settle
+
+
+class CountingResolver(Resolver):
+    """
+    Answers every lookup with 127.0.0.1 and counts them
+    """
+    def initialize(self):
+        self.lookups = 0
+
+    async def resolve(self, host, port, family=socket.AF_UNSPEC):
+        self.lookups += 1
+        return [(socket.AF_INET, ('127.0.0.1', port))]
+
+
+def test_filters_share_one_service():
+    graph_manager = new_graph_manager()
+    service = HttpClientService.get_shared(graph_manager)
+    assert HttpClientService.get_shared(graph_manager) is service
+    assert graph_manager.get_service(HttpClientService.DEFAULT_SERVICE_NAME) is service
+
+
+def test_service_of_another_type_is_rejected():
+    graph_manager = new_graph_manager()
+    graph_manager.register_service(ServiceBase('other', {}, graph_manager))
+    with pytest.raises(TypeError):
+        HttpClientService.get_shared(graph_manager, 'other')
+
+
+def test_lookups_are_reused_until_they_expire(event_loop, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('time.monotonic', lambda: now[0])
+    counting = CountingResolver()
+    resolver = CachingResolver(resolver=counting, ttl_seconds=10)
+    event_loop.run_until_complete(resolver.resolve('example.com', 80))
+    event_loop.run_until_complete(resolver.resolve('example.com', 80))
+    assert counting.lookups == 1
+    event_loop.run_until_complete(resolver.resolve('example.com', 443))
+    assert counting.lookups == 2
+    now[0] += 10
+    event_loop.run_until_complete(resolver.resolve('example.com', 80))
+    assert counting.lookups == 3
+
+
+def test_requests_to_one_host_wait_for_a_free_connection(event_loop):
+    server = DocumentServer(delay=0.2)
+    service = HttpClientService('http_client', {'keep_alive': False, 'max_connections_per_host': 1},
+                                new_graph_manager())
+    fetches = [asyncio.ensure_future(service.fetch(server.uri(name))) for name in ('a', 'b')]
+    settle(event_loop, 0.1)
+    assert len(server.hits) == 1
+    responses = event_loop.run_until_complete(asyncio.gather(*fetches))
+    assert [response.code for response in responses] == [200, 200]
+    # The slot of a host is dropped once nothing is waiting on it
+    assert service._host_slots == {}
+    service.stop()
+    server.stop()
+
+
+def test_missing_pycurl_is_warned_about(monkeypatch, capsys):
+    monkeypatch.setattr('services.http_client_service.pycurl', None)
+    service = HttpClientService('http_client', {}, new_graph_manager())
+    assert not service.keep_alive
+    assert 'pycurl' in capsys.readouterr().out
+    HttpClientService('http_client', {'keep_alive': False}, new_graph_manager())
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,198 @@
+import asyncio
+import json
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from filters.http_client_source import HttpClientSource
+from filters.tornado_source import TornadoSource
+from test.graph_helpers import connect_to_collector, new_graph_manager
+
+
+class DocumentHandler(tornado.web.RequestHandler):
+    """
+    Serves /doc/<name> as text after delay seconds, with an ETag so a conditional GET is answered 304
+    """
+    def initialize(self, hits, delay):
+        self._hits = hits
+        self._delay = delay
+
+    async def get(self, name):
+        self._hits.append(name)
+        if self._delay > 0:
+            await asyncio.sleep(self._delay)
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write('document {0}'.format(name))
+
+
+class ChunkedHandler(tornado.web.RequestHandler):
+    """
+    Serves /chunked as two flushed blocks, splitting the utf-8 encoding of an e acute between them
+    """
+    async def get(self):
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.write(b'caf\xc3')
+        await self.flush()
+        await asyncio.sleep(0.05)
+        self.write(b'\xa9')
+
+
+class DocumentServer:
+    """
+    A local http server for HttpClientSource to fetch from
+    """
+    def __init__(self, delay=0.0):
+        self.hits = []
+        sock, self.port = bind_unused_port()
+        application = tornado.web.Application([(r'/doc/(.*)', DocumentHandler, dict(hits=self.hits, delay=delay)),
+                                               (r'/chunked', ChunkedHandler)])
+        self._server = HTTPServer(application)
+        self._server.add_sockets([sock])
+
+    def uri(self, name, host='127.0.0.1'):
+        return 'http://{0}:{1}/doc/{2}'.format(host, self.port, name)
+
+    def stop(self):
+        self._server.stop()
+
+
+def make_source(**config):
+    graph_manager = new_graph_manager()
+    source = HttpClientSource('http_source', config, graph_manager)
+    graph_manager.add_filter(source)
+    collector = connect_to_collector(graph_manager, source)
+    graph_manager.compile_dispatch_plan()
+    graph_manager.run()
+    return graph_manager, source, collector
+
+
+def wait_for_messages(event_loop, collector, count):
+    async def wait():
+        while len(collector.messages) < count:
+            await asyncio.sleep(0.01)
+    event_loop.run_until_complete(asyncio.wait_for(wait(), 5))
+
+
+def settle(event_loop, seconds=0.1):
+    event_loop.run_until_complete(asyncio.sleep(seconds))
+
+
+def test_conditional_get_sends_a_not_modified_event(event_loop):
+    server = DocumentServer()
+    graph_manager, source, collector = make_source(conditional_get={'emit_not_modified': True})
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: server.uri('a')})
+    wait_for_messages(event_loop, collector, 1)
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: server.uri('a')})
+    wait_for_messages(event_loop, collector, 2)
+    assert collector.messages[0][1] == 'document a'
+    mime_type, payload, metadata = collector.messages[1]
+    assert payload == ''
+    assert metadata[HttpClientSource.METADATA_KEY_RESPONSE_NOT_MODIFIED] is True
+    assert metadata[TornadoSource.METADATA_KEY_MIME_TYPE] == 'text/plain'
+    assert TornadoSource.METADATA_KEY_RESPONSE_STATUS not in metadata
+    graph_manager.stop()
+    server.stop()
+
+
+def test_validators_survive_a_restart(tmp_path, event_loop):
+    server = DocumentServer()
+    cache_config = {'cache_filename': str(tmp_path / 'validators.json')}
+    graph_manager, source, collector = make_source(conditional_get=cache_config)
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: server.uri('a')})
+    wait_for_messages(event_loop, collector, 1)
+    graph_manager.stop()
+    graph_manager, source, collector = make_source(conditional_get=cache_config)
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: server.uri('a')})
+    settle(event_loop)
+    # Answered 304, and nothing is sent downstream without emit_not_modified
+    assert len(server.hits) == 2
+    assert collector.messages == []
+    graph_manager.stop()
+    server.stop()
+
+
+def test_identical_fetches_in_flight_share_one_request(event_loop):
+    server = DocumentServer(delay=0.1)
+    graph_manager, source, collector = make_source()
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: server.uri('a'), 'asked_by': 1})
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: server.uri('a'), 'asked_by': 2})
+    wait_for_messages(event_loop, collector, 2)
+    assert server.hits == ['a']
+    # Each waiter gets its own copy of the metadata it asked with
+    assert sorted(metadata['asked_by'] for mime_type, payload, metadata in collector.messages) == [1, 2]
+    assert all(payload == 'document a' for mime_type, payload, metadata in collector.messages)
+    graph_manager.stop()
+    server.stop()
+
+
+def test_stop_cancels_the_fetches_in_flight(event_loop):
+    server = DocumentServer(delay=0.2)
+    graph_manager, source, collector = make_source(coalesce_ttl_seconds=60)
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: server.uri('a')})
+    settle(event_loop, 0.05)
+    pending = list(source._pending_fetches.values())
+    assert len(pending) == 1
+    graph_manager.stop()
+    settle(event_loop, 0.3)
+    assert pending[0].cancelled()
+    assert source._pending_fetches == {} and source._recent_results == {}
+    assert collector.messages == []
+    server.stop()
+
+
+def test_fetch_waiting_on_a_busy_host_does_not_hold_a_batch_slot(event_loop):
+    server = DocumentServer(delay=0.3)
+    graph_manager, source, collector = make_source(request_uris_from_payload=True, max_concurrent_fetches=2,
+                                                   max_fetches_per_host=1)
+    uris = [server.uri('a'), server.uri('b'), server.uri('c', host='localhost')]
+    source.recv('application/json', json.dumps(uris), {})
+    settle(event_loop, 0.15)
+    # b waits for the 127.0.0.1 slot, leaving the second batch slot to the fetch from localhost
+    assert sorted(server.hits) == ['a', 'c']
+    wait_for_messages(event_loop, collector, 4)
+    assert json.loads(collector.messages[-1][1])['failed_uris'] == []
+    graph_manager.stop()
+    server.stop()
+
+
+def stream_events(collector):
+    return [metadata[TornadoSource.METADATA_KEY_STREAM_EVENT] for mime_type, payload, metadata in collector.messages]
+
+
+def test_streamed_body_is_sent_between_start_and_end(event_loop):
+    server = DocumentServer()
+    graph_manager, source, collector = make_source(stream_response_body=True)
+    uri = 'http://127.0.0.1:{0}/chunked'.format(server.port)
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: uri})
+    wait_for_messages(event_loop, collector, 4)
+    assert stream_events(collector) == ['start', 'chunk', 'chunk', 'end']
+    # The character split between the blocks is decoded whole
+    assert [payload for mime_type, payload, metadata in collector.messages] == ['', 'caf', '\u00e9', '']
+    assert [metadata[TornadoSource.METADATA_KEY_STREAM_SEQUENCE] for mime_type, payload, metadata in
+            collector.messages] == [0, 1, 2, 3]
+    assert all(mime_type == 'text/plain' for mime_type, payload, metadata in collector.messages)
+    graph_manager.stop()
+    server.stop()
+
+
+def test_streamed_body_as_bytes(event_loop):
+    server = DocumentServer()
+    graph_manager, source, collector = make_source(stream_response_body=True, stream_as_bytes=True)
+    uri = 'http://127.0.0.1:{0}/chunked'.format(server.port)
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: uri})
+    wait_for_messages(event_loop, collector, 4)
+    assert b''.join(payload for mime_type, payload, metadata in collector.messages) == 'caf\u00e9'.encode('utf-8')
+    graph_manager.stop()
+    server.stop()
+
+
+def test_error_response_is_not_streamed(event_loop):
+    server = DocumentServer()
+    graph_manager, source, collector = make_source(stream_response_body=True)
+    uri = 'http://127.0.0.1:{0}/missing'.format(server.port)
+    source.recv('text/plain', '', {TornadoSource.METADATA_KEY_REQUEST_URI: uri})
+    settle(event_loop)
+    assert collector.messages == []
+    graph_manager.stop()
+    server.stop()
@@ -0,0 +1,36 @@
+import json
+import pickle
+
+from graph.json_payload import JsonPayload
+
+
+def test_payload_from_a_value_is_its_json_text():
+    payload = JsonPayload.from_value({'a': '1'})
+    assert isinstance(payload, str)
+    assert json.loads(payload) == {'a': '1'}
+    assert payload.encode('utf-8') == b'{"a": "1"}'
+
+
+def test_value_is_kept_rather_than_parsed_again(monkeypatch):
+    value = {'a': '1'}
+    payload = JsonPayload.from_value(value)
+    monkeypatch.setattr(json, 'loads', None)
+    assert payload.value is value
+    assert JsonPayload.decode(payload) is value
+
+
+def test_payload_from_text_is_parsed_once():
+    payload = JsonPayload('[1, 2]')
+    assert payload.value == [1, 2]
+    assert payload.value is payload.value
+
+
+def test_decode_accepts_str_and_bytes():
+    assert JsonPayload.decode('{"a": 1}') == {'a': 1}
+    assert JsonPayload.decode(b'{"a": 1}') == {'a': 1}
+
+
+def test_payload_pickles_with_its_value():
+    payload = pickle.loads(pickle.dumps(JsonPayload.from_value({'a': '1'})))
+    assert payload == '{"a": "1"}'
+    assert payload.value == {'a': '1'}
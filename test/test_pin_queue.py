@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+from graph.filter_base import FilterBase, FilterState, FilterType
+from graph.input_pin import InputPin
+from graph.output_pin import OutputPin
+from graph.pin_queue import PinQueue, QueueFullError
+from test.graph_helpers import CollectorSink, connect_to_collector, new_graph_manager
+
+
+class FailingFilter(FilterBase):
+    """
+    Raises on every message it receives
+    """
+    filter_pad_templates = {}
+    filter_meta = {}
+
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager, FilterType.transform)
+        self._add_input_pin(InputPin('input', {'*': self.recv}, self))
+        self._add_output_pin(OutputPin('output', True))
+
+    def run(self):
+        super().run()
+        self._set_filter_state(FilterState.running)
+
+    def stop(self):
+        super().stop()
+        self._set_filter_state(FilterState.stopped)
+
+    def recv(self, mime_type, payload, metadata_dict):
+        raise ValueError('bad message')
+
+    @staticmethod
+    def get_filter_metadata():
+        return FilterBase.filter_meta
+
+    @staticmethod
+    def get_filter_pad_templates():
+        return FilterBase.filter_pad_templates
+
+
+def make_queue(capacity, overflow):
+    sink = CollectorSink('sink', {}, new_graph_manager())
+    return PinQueue(sink.get_input_pin('input'), capacity, overflow), sink
+
+
+def payloads(sink):
+    return [payload for mime_type, payload, metadata in sink.messages]
+
+
+def test_block_delivers_the_oldest_message_in_the_sender():
+    pin_queue, sink = make_queue(2, PinQueue.OVERFLOW_BLOCK)
+    for i in range(4):
+        pin_queue.recv('text/plain', i, {})
+    assert payloads(sink) == [0, 1]
+    pin_queue.stop()
+    assert payloads(sink) == [0, 1, 2, 3]
+
+
+def test_drop_oldest_discards_and_counts():
+    pin_queue, sink = make_queue(2, PinQueue.OVERFLOW_DROP_OLDEST)
+    for i in range(5):
+        pin_queue.recv('text/plain', i, {})
+    pin_queue.stop()
+    assert payloads(sink) == [3, 4]
+    assert pin_queue.dropped_count == 3
+
+
+def test_reject_raises_when_full():
+    pin_queue, sink = make_queue(1, PinQueue.OVERFLOW_REJECT)
+    pin_queue.recv('text/plain', 0, {})
+    assert pin_queue.is_full
+    with pytest.raises(QueueFullError):
+        pin_queue.recv('text/plain', 1, {})
+    pin_queue.stop()
+    assert payloads(sink) == [0]
+
+
+def test_consumer_delivers_in_order(event_loop):
+    pin_queue, sink = make_queue(10, PinQueue.OVERFLOW_BLOCK)
+    pin_queue.start()
+    for i in range(5):
+        pin_queue.recv('text/plain', i, {})
+    assert payloads(sink) == []
+    event_loop.run_until_complete(asyncio.sleep(0.01))
+    assert payloads(sink) == [0, 1, 2, 3, 4]
+    pin_queue.stop()
+
+
+def test_failed_request_is_answered_with_an_error(event_loop):
+    graph_manager = new_graph_manager()
+    failing = FailingFilter('failing', {}, graph_manager)
+    graph_manager.add_filter(failing)
+    collector = connect_to_collector(graph_manager, failing)
+    pin_queue = PinQueue(failing.get_input_pin('input'), 10, PinQueue.OVERFLOW_BLOCK)
+    pin_queue.start()
+    pin_queue.recv('text/plain', 'a', {'web_handler_id': 7})
+    # Outside of a request, the failure is only logged
+    pin_queue.recv('text/plain', 'b', {})
+    event_loop.run_until_complete(asyncio.sleep(0.01))
+    assert collector.messages == [('text/plain', '', {'web_handler_id': 7, 'web_response_status': 500})]
+    pin_queue.stop()
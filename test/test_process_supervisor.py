@@ -0,0 +1,77 @@
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+from graph.process_supervisor import ProcessSupervisor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each worker records its pid in the directory given on the command line, then waits to be stopped
+SUPERVISOR_SCRIPT = textwrap.dedent('''
+    import os
+    import sys
+    import time
+    from graph.process_supervisor import ProcessSupervisor
+
+    def worker():
+        open(os.path.join(sys.argv[1], str(os.getpid())), 'w').close()
+        while True:
+            time.sleep(0.1)
+
+    ProcessSupervisor(2, worker).run()
+''')
+
+
+def wait_for_workers(pid_dir, count):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        pids = [int(name) for name in os.listdir(pid_dir)]
+        if len(pids) >= count:
+            return pids
+        time.sleep(0.05)
+    raise AssertionError('{0} workers were not started'.format(count))
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+@pytest.fixture
+def supervisor(tmp_path):
+    process = subprocess.Popen([sys.executable, '-c', SUPERVISOR_SCRIPT, str(tmp_path)], cwd=REPO_DIR)
+    yield process, tmp_path
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+def test_workers_are_stopped_with_the_supervisor(supervisor):
+    process, pid_dir = supervisor
+    pids = wait_for_workers(pid_dir, 2)
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(15) == 0
+    assert not any(is_running(pid) for pid in pids)
+
+
+def test_dead_worker_is_restarted(supervisor):
+    process, pid_dir = supervisor
+    pids = wait_for_workers(pid_dir, 2)
+    os.kill(pids[0], signal.SIGKILL)
+    pids = wait_for_workers(pid_dir, 3)
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(15) == 0
+    assert not any(is_running(pid) for pid in pids)
+
+
+def test_process_count_must_be_positive():
+    with pytest.raises(ValueError):
+        ProcessSupervisor(0, None)
@@ -0,0 +1,55 @@
+import time
+
+from filters.response_cache import ResponseCache
+
+
+def test_key_ignores_argument_order_and_includes_vary_headers():
+    cache = ResponseCache(vary_headers=['Accept'])
+    key = cache.make_key('/a', {'x': [b'1'], 'y': [b'2']}, {'Accept': 'text/plain'})
+    assert key == cache.make_key('/a', {'y': [b'2'], 'x': [b'1']}, {'Accept': 'text/plain'})
+    assert key != cache.make_key('/a', {'y': [b'2'], 'x': [b'1']}, {'Accept': 'application/json'})
+
+
+def test_response_expires_after_its_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = ResponseCache(ttl_seconds=1.0)
+    assert cache.put('k', 200, 'text/plain', 'body')
+    assert cache.get('k') == (200, 'text/plain', b'body', None)
+    now[0] += 1.0
+    assert cache.get('k') is None
+    assert cache.total_bytes == 0
+
+
+def test_cache_control_opts_out_and_in():
+    cache = ResponseCache(cache_by_default=False)
+    assert not cache.put('a', 200, 'text/plain', 'body')
+    assert cache.put('b', 200, 'text/plain', 'body', 'public, max-age=60')
+    assert not cache.put('c', 200, 'text/plain', 'body', 'no-store, max-age=60')
+    assert cache.get('b') is not None
+
+
+def test_least_recently_used_is_evicted_first():
+    cache = ResponseCache(max_bytes=8)
+    cache.put('a', 200, 'text/plain', b'1234')
+    cache.put('b', 200, 'text/plain', b'1234')
+    cache.get('a')
+    cache.put('c', 200, 'text/plain', b'1234')
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.total_bytes == 8
+    # A body larger than the whole cache is never stored
+    assert not cache.put('d', 200, 'text/plain', b'123456789')
+
+
+def test_only_str_and_bytes_bodies_are_cached():
+    cache = ResponseCache(ttl_seconds=60)
+    assert not cache.put('a', 200, 'application/json', {'a': 1})
+    assert not cache.put('b', 200, 'text/plain', 5)
+    assert cache.put('c', 200, 'text/plain', bytearray(b'body'))
+    assert cache.total_bytes == 4
+
+
+def test_malformed_max_age_is_not_cached():
+    cache = ResponseCache(cache_by_default=False)
+    assert not cache.put('a', 200, 'text/plain', 'body', 'max-age=soon')
@@ -0,0 +1,39 @@
+import pytest
+
+from storage.sqlite_database import SqliteDatabase
+
+
+def test_tuning_is_applied_to_writer_and_readers(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'test.db'), {'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': -4000},
+                              reader_pool_size=2)
+    writer = database.open_writer()
+    writer.execute('CREATE TABLE t (v INTEGER)')
+    writer.commit()
+    assert writer.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert writer.execute('PRAGMA synchronous').fetchone()[0] == 1
+    with database.reader() as reader:
+        # synchronous is per connection, so the readers get it too
+        assert reader.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert reader.execute('PRAGMA cache_size').fetchone()[0] == -4000
+        assert reader.execute('PRAGMA query_only').fetchone()[0] == 1
+    database.close_readers()
+    writer.close()
+
+
+def test_reader_pool_reuses_connections_and_times_out(tmp_path):
+    database = SqliteDatabase(str(tmp_path / 'test.db'), reader_pool_size=1)
+    database.open_writer().close()
+    first = database.acquire_reader()
+    with pytest.raises(RuntimeError):
+        database.acquire_reader(timeout=0.01)
+    database.release_reader(first)
+    assert database.acquire_reader() is first
+    database.release_reader(first)
+    database.close_readers()
+
+
+def test_invalid_pragma_values_are_rejected():
+    with pytest.raises(ValueError):
+        SqliteDatabase('unused.db', {'journal_mode': 'wal; DROP TABLE t'})
+    with pytest.raises(ValueError):
+        SqliteDatabase('unused.db', {'page_size': 4096})
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import sqlite3
+
+import pytest
+
+from filters.sqlite_passthru import SqlitePassthru
+from graph.filter_executor import FilterExecutor
+from test.graph_helpers import InjectorSource, connect_to_collector, new_graph_manager
+
+
+def make_passthru(db_filename, **config):
+    config_dict = {'db_filename': db_filename, 'table_name_literal': 'items', 'insert_timestamp': False}
+    config_dict.update(config)
+    return SqlitePassthru('passthru', config_dict, new_graph_manager())
+
+
+def read_rows(db_filename, sql_stmt='SELECT v FROM items ORDER BY _id'):
+    conn = sqlite3.connect(db_filename)
+    try:
+        return conn.execute(sql_stmt).fetchall()
+    finally:
+        conn.close()
+
+
+def test_batch_is_written_on_stop(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, batch_max_rows=100, batch_max_latency_ms=60000)
+    passthru.run()
+    for i in range(5):
+        passthru.recv('application/json', json.dumps({'v': i}), {})
+    passthru.stop()
+    assert read_rows(db_filename) == [(i,) for i in range(5)]
+
+
+def test_batch_is_written_after_the_max_latency(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, batch_max_rows=100, batch_max_latency_ms=50)
+    passthru.run()
+    passthru.recv('application/json', json.dumps({'v': 1}), {})
+    passthru.recv('application/json', json.dumps({'v': 2}), {})
+    assert read_rows(db_filename) == []
+    event_loop.run_until_complete(asyncio.sleep(0.2))
+    assert read_rows(db_filename) == [(1,), (2,)]
+    passthru.stop()
+
+
+def test_batch_is_written_when_full(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, batch_max_rows=3, batch_max_latency_ms=60000)
+    passthru.run()
+    for i in range(4):
+        passthru.recv('application/json', json.dumps({'v': i}), {})
+    assert read_rows(db_filename) == [(0,), (1,), (2,)]
+    passthru.stop()
+
+
+def test_bad_row_does_not_lose_the_rest_of_the_batch(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(db_filename)
+    conn.execute('CREATE TABLE items (_id INTEGER PRIMARY KEY, v INTEGER CHECK (v >= 0))')
+    conn.commit()
+    conn.close()
+    passthru = make_passthru(db_filename, batch_max_rows=4, batch_max_latency_ms=60000)
+    passthru.run()
+    passthru.recv('application/json', json.dumps([{'v': 1}, {'v': -1}, {'v': 2}]), {})
+    # The fourth row fills the batch, and the flush fails on the CHECK constraint
+    passthru.recv('application/json', json.dumps({'v': 3}), {})
+    assert read_rows(db_filename) == [(1,), (2,), (3,)]
+    passthru.stop()
+
+
+def test_schema_cache_picks_up_new_columns(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename)
+    passthru.run()
+    passthru.recv('application/json', json.dumps({'v': 1}), {})
+    passthru.recv('application/json', json.dumps({'v': 2, 'name': 'two'}), {})
+    passthru.recv('application/json', json.dumps({'v': 3}), {})
+    passthru.stop()
+    assert read_rows(db_filename, 'SELECT v, name FROM items ORDER BY _id') == [(1, None), (2, 'two'), (3, None)]
+    # One statement per column signature
+    assert sorted(passthru._insert_stmts.keys()) == [('items', ('v',)), ('items', ('v', 'name'))]
+
+
+def test_upsert_updates_in_place(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, upsert=True, unique_columns=['k'])
+    passthru.run()
+    passthru.recv('application/json', json.dumps({'k': 'a', 'v': 1}), {})
+    passthru.recv('application/json', json.dumps({'k': 'b', 'v': 2}), {})
+    passthru.recv('application/json', json.dumps({'k': 'a', 'v': 3}), {})
+    passthru.stop()
+    # The row keeps its _id
+    assert read_rows(db_filename, 'SELECT _id, k, v FROM items ORDER BY _id') == [(1, 'a', 3), (2, 'b', 2)]
+
+
+def test_upsert_with_several_unique_columns_resolves_every_conflict(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, upsert=True, unique_columns=['k', 'serial'])
+    passthru.run()
+    passthru.recv('application/json', json.dumps({'k': 'a', 'serial': 'x', 'v': 1}), {})
+    # Collides on serial only
+    passthru.recv('application/json', json.dumps({'k': 'b', 'serial': 'x', 'v': 2}), {})
+    passthru.stop()
+    assert read_rows(db_filename, 'SELECT k, serial, v FROM items') == [('b', 'x', 2)]
+
+
+def test_secondary_index_is_created_once_its_columns_exist(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, secondary_indexes={'*': [['k', 'v']]})
+    passthru.run()
+    passthru.recv('application/json', json.dumps({'v': 1}), {})
+    index_sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'items'"
+    assert read_rows(db_filename, index_sql) == []
+    passthru.recv('application/json', json.dumps({'k': 'a', 'v': 2}), {})
+    passthru.stop()
+    assert len(read_rows(db_filename, index_sql)) == 1
+    plan = read_rows(db_filename, "EXPLAIN QUERY PLAN SELECT v FROM items WHERE k = 'a'")
+    assert 'INDEX' in plan[0][-1]
+
+
+def test_json_array_and_ndjson_bodies_are_saved(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename)
+    passthru.run()
+    passthru.recv('application/json', json.dumps([{'v': 1}, {'v': 2}]), {})
+    passthru.recv('application/x-ndjson', b'{"v": 3}\n\n{"v": 4}\n', {})
+    passthru.stop()
+    assert read_rows(db_filename) == [(1,), (2,), (3,), (4,)]
+
+
+def test_json_array_of_non_objects_is_rejected(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename)
+    passthru.run()
+    with pytest.raises(ValueError):
+        passthru.recv('application/json', json.dumps([{'v': 1}, 2]), {})
+    passthru.stop()
+
+
+def test_retention_keeps_the_newest_rows(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, retention={'items': {'max_rows': 3}}, retention_batch_size=2)
+    passthru.run()
+    passthru.recv('application/json', json.dumps([{'v': i} for i in range(10)]), {})
+    event_loop.run_until_complete(passthru._apply_retention())
+    passthru.stop()
+    assert read_rows(db_filename) == [(7,), (8,), (9,)]
+
+
+def test_retention_deletes_expired_rows(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, insert_timestamp=True, retention={'*': {'max_age_seconds': 3600}},
+                             sqlite_tuning={'auto_vacuum': 'INCREMENTAL'})
+    passthru.run()
+    passthru.recv('application/json', json.dumps([{'v': 1}, {'v': 2}]), {})
+    passthru._db_conn.execute("UPDATE items SET rosetta_timestamp = '2000-01-01T00:00:00' WHERE v = 1")
+    passthru._db_conn.commit()
+    event_loop.run_until_complete(passthru._apply_retention())
+    event_loop.run_until_complete(passthru._incremental_vacuum())
+    assert passthru._db_conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+    passthru.stop()
+    assert read_rows(db_filename) == [(2,)]
+
+
+def test_document_mode_indexes_json_paths(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, json_document_column='doc', json_paths={'patient': '$.subject.reference'})
+    passthru.run()
+    passthru.recv('application/json', json.dumps({'id': 1, 'subject': {'reference': 'Patient/1'}}), {})
+    passthru.recv('application/json', json.dumps({'id': 2, 'subject': {'reference': 'Patient/2'}}), {})
+    passthru.stop()
+    rows = read_rows(db_filename, "SELECT doc FROM items WHERE patient = 'Patient/2'")
+    assert [json.loads(row[0])['id'] for row in rows] == [2]
+    plan = read_rows(db_filename, "EXPLAIN QUERY PLAN SELECT doc FROM items WHERE patient = 'Patient/2'")
+    assert 'items_patient_idx' in plan[0][3]
+
+
+def test_document_mode_upserts_on_a_json_path(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename, json_document_column='doc', json_paths={'rid': '$.id'},
+                             unique_columns=['rid'], upsert=True)
+    passthru.run()
+    passthru.recv('application/json', json.dumps({'id': 'a', 'v': 1}), {})
+    passthru.recv('application/json', json.dumps({'id': 'a', 'v': 2}), {})
+    passthru.stop()
+    assert [json.loads(row[0])['v'] for row in read_rows(db_filename, 'SELECT doc FROM items')] == [2]
+
+
+def stream_message(stream_event, stream_id='s1'):
+    return {'stream_id': stream_id, 'stream_event': stream_event}
+
+
+def test_streamed_ndjson_is_written_as_lines_complete(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename)
+    passthru.run()
+    passthru.recv('application/x-ndjson', b'', stream_message('start'))
+    passthru.recv('application/x-ndjson', b'{"v": 1}\n{"v"', stream_message('chunk'))
+    assert read_rows(db_filename) == [(1,)]
+    passthru.recv('application/x-ndjson', b': 2}', stream_message('chunk'))
+    passthru.recv('application/x-ndjson', b'', stream_message('end'))
+    assert read_rows(db_filename) == [(1,), (2,)]
+    passthru.stop()
+
+
+def test_aborted_stream_is_discarded(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    passthru = make_passthru(db_filename)
+    passthru.run()
+    passthru.recv('application/json', b'', stream_message('start'))
+    passthru.recv('application/json', b'[{"v": 1}, ', stream_message('chunk'))
+    passthru.recv('application/json', b'', stream_message('abort'))
+    passthru.recv('application/json', json.dumps({'v': 2}), {})
+    passthru.stop()
+    assert read_rows(db_filename) == [(2,)]
+    assert passthru._streams == {}
+
+
+def test_thread_executor_writes_in_arrival_order(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    graph_manager = new_graph_manager()
+    source = InjectorSource('source', {}, graph_manager)
+    passthru = SqlitePassthru('passthru', {'db_filename': db_filename, 'table_name_literal': 'items',
+                                           'insert_timestamp': False}, graph_manager)
+    graph_manager.add_filter(source)
+    graph_manager.add_filter(passthru)
+    graph_manager.connect_pins('source', 'output', 'passthru', 'input')
+    collector = connect_to_collector(graph_manager, passthru)
+    graph_manager.set_filter_executor('passthru', FilterExecutor.EXECUTOR_THREAD)
+    assert graph_manager.validate_graph()
+    graph_manager.run()
+    for i in range(500):
+        source.output_pin.send('application/json', json.dumps({'v': i}), {})
+
+    async def wait():
+        while len(collector.messages) < 500:
+            await asyncio.sleep(0.01)
+    event_loop.run_until_complete(asyncio.wait_for(wait(), 10))
+    graph_manager.stop()
+    assert read_rows(db_filename) == [(i,) for i in range(500)]
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import sqlite3
+
+import pytest
+
+from filters.sqlite_query import SqliteQuery
+from filters.tornado_source import TornadoSource
+from test.graph_helpers import CollectorSink, connect_to_collector, new_graph_manager
+
+
+def make_query(db_filename, **config):
+    config_dict = {'db_filename': db_filename, 'table_name_re': 'items'}
+    config_dict.update(config)
+    graph_manager = new_graph_manager()
+    query = SqliteQuery('query', config_dict, graph_manager)
+    graph_manager.add_filter(query)
+    collector = connect_to_collector(graph_manager, query)
+    query.run()
+    collector.run()
+    return query, collector
+
+
+def create_items(db_filename, count):
+    conn = sqlite3.connect(db_filename)
+    conn.execute('CREATE TABLE items (_id INTEGER PRIMARY KEY, v INTEGER)')
+    conn.executemany('INSERT INTO items (v) VALUES (?)', [(i,) for i in range(count)])
+    conn.commit()
+    conn.close()
+
+
+def run_query(event_loop, query, collector, query_args, path='/db/items'):
+    """
+    Send a query and wait for the final, non partial response
+    :return: The list of (payload, metadata) messages sent for the query
+    """
+    query.recv('application/json', json.dumps(query_args), {TornadoSource.METADATA_KEY_REQUEST_PATH: path})
+
+    async def wait_for_response():
+        while len(collector.messages) == 0 or collector.messages[-1][2].get(TornadoSource.METADATA_KEY_RESPONSE_PARTIAL):
+            await asyncio.sleep(0.01)
+    event_loop.run_until_complete(asyncio.wait_for(wait_for_response(), 5))
+    return [(payload, metadata) for mime_type, payload, metadata in collector.messages]
+
+
+def test_response_is_sent_in_chunks(tmp_path, event_loop, monkeypatch):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, 5)
+    monkeypatch.setattr(SqliteQuery, 'FETCH_CHUNK_SIZE', 2)
+    query, collector = make_query(db_filename)
+    messages = run_query(event_loop, query, collector, {'limit': '5'})
+    # Three chunks of rows, then the message that closes the object
+    assert len(messages) == 4
+    assert all(metadata.get(TornadoSource.METADATA_KEY_RESPONSE_PARTIAL) for payload, metadata in messages[:-1])
+    resp = json.loads(''.join(payload for payload, metadata in messages))
+    assert [row['v'] for row in resp['rows']] == [0, 1, 2, 3, 4]
+    assert resp['next_after'] == 5
+    query.stop()
+
+
+def test_last_page_has_no_cursor(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, 3)
+    query, collector = make_query(db_filename)
+    messages = run_query(event_loop, query, collector, {'after': '2'})
+    resp = json.loads(''.join(payload for payload, metadata in messages))
+    assert resp == {'rows': [{'_id': 3, 'v': 2}], 'next_after': None}
+    query.stop()
+
+
+def test_unknown_column_is_rejected(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, 1)
+    query, collector = make_query(db_filename)
+    messages = run_query(event_loop, query, collector, {'nope': '1'})
+    assert messages[-1][1][TornadoSource.METADATA_KEY_RESPONSE_STATUS] == 400
+    query.stop()
+
+
+def test_missing_db_file_is_not_found(tmp_path, event_loop):
+    query, collector = make_query(str(tmp_path / 'missing.db'))
+    messages = run_query(event_loop, query, collector, {})
+    assert messages[-1][1][TornadoSource.METADATA_KEY_RESPONSE_STATUS] == 404
+    query.stop()
+
+
+def test_table_name_must_match_as_a_whole(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, 1)
+    query, collector = make_query(db_filename, table_name_re='it')
+    messages = run_query(event_loop, query, collector, {})
+    assert messages[-1][1][TornadoSource.METADATA_KEY_RESPONSE_STATUS] == 404
+    query.stop()
+
+
+def test_table_name_must_be_an_identifier(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, 1)
+    query, collector = make_query(db_filename, table_name_re='items.*')
+    messages = run_query(event_loop, query, collector, {}, path='/db/items,sqlite_master')
+    assert messages[-1][1][TornadoSource.METADATA_KEY_RESPONSE_STATUS] == 404
+    query.stop()
+    with pytest.raises(ValueError):
+        SqliteQuery('query', {'db_filename': db_filename, 'table_name_literal': 'items; drop'}, new_graph_manager())
+
+
+def test_table_without_an_id_column_is_rejected(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(db_filename)
+    conn.execute('CREATE TABLE items (v INTEGER)')
+    conn.commit()
+    conn.close()
+    query, collector = make_query(db_filename)
+    messages = run_query(event_loop, query, collector, {})
+    assert messages[-1][1][TornadoSource.METADATA_KEY_RESPONSE_STATUS] == 400
+    query.stop()
+
+
+class StoppingCollector(CollectorSink):
+    """
+    A collector that stops the query filter once the first chunk of rows has arrived
+    """
+    query = None
+
+    def recv(self, mime_type, payload, metadata_dict):
+        super().recv(mime_type, payload, metadata_dict)
+        if len(self.messages) == 1:
+            self.query.stop()
+
+
+def test_stop_part_way_through_closes_the_response(tmp_path, event_loop, monkeypatch):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, 10)
+    monkeypatch.setattr(SqliteQuery, 'FETCH_CHUNK_SIZE', 3)
+    graph_manager = new_graph_manager()
+    query = SqliteQuery('query', {'db_filename': db_filename, 'table_name_re': 'items'}, graph_manager)
+    collector = StoppingCollector('collector', {}, graph_manager)
+    collector.query = query
+    query.get_output_pin('output').connect_to_pin(collector.get_input_pin('input'))
+    query.run()
+    collector.run()
+    messages = run_query(event_loop, query, collector, {})
+    resp = json.loads(''.join(payload for payload, metadata in messages))
+    assert [row['v'] for row in resp['rows']] == [0, 1, 2]
+    # The client can carry on after the last row it got
+    assert resp['next_after'] == 3
+
+
+def test_stop_before_any_row_is_unavailable(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, 10)
+    query, collector = make_query(db_filename)
+    query.recv('application/json', '{}', {TornadoSource.METADATA_KEY_REQUEST_PATH: '/db/items'})
+    query.stop()
+    event_loop.run_until_complete(asyncio.sleep(0.1))
+    assert collector.messages[-1][2][TornadoSource.METADATA_KEY_RESPONSE_STATUS] == 503
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import sqlite3
+import threading
+
+from filters.sqlite_source import SqliteSource
+from test.graph_helpers import CollectorSink, new_graph_manager
+
+
+class FlakySink(CollectorSink):
+    """
+    A collector that fails the first fail_count messages it receives
+    """
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager)
+        self.fail_count = 0
+
+    def recv(self, mime_type, payload, metadata_dict):
+        if self.fail_count > 0:
+            self.fail_count -= 1
+            raise RuntimeError('downstream failure')
+        super().recv(mime_type, payload, metadata_dict)
+
+
+def make_source(db_filename, **config):
+    config_dict = {'db_filename': db_filename, 'table_name_literal': 'items'}
+    config_dict.update(config)
+    graph_manager = new_graph_manager()
+    source = SqliteSource('source', config_dict, graph_manager)
+    sink = FlakySink('sink', {}, graph_manager)
+    source.get_output_pin('output').connect_to_pin(sink.get_input_pin('input'))
+    source.run()
+    sink.run()
+    return source, sink
+
+
+def create_items(db_filename, values):
+    conn = sqlite3.connect(db_filename)
+    conn.execute('CREATE TABLE IF NOT EXISTS items (_id INTEGER PRIMARY KEY, v INTEGER)')
+    conn.executemany('INSERT INTO items (v) VALUES (?)', [(v,) for v in values])
+    conn.commit()
+    conn.close()
+
+
+def poll(event_loop, source):
+    source.recv('application/json', '', {})
+    event_loop.run_until_complete(asyncio.wait_for(source._poll_task, 5))
+
+
+def sent_values(sink):
+    return [json.loads(payload)['v'] for mime_type, payload, metadata in sink.messages]
+
+
+def test_polls_only_send_new_rows(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, [1, 2])
+    source, sink = make_source(db_filename, fetch_chunk_size=1)
+    poll(event_loop, source)
+    create_items(db_filename, [3])
+    poll(event_loop, source)
+    assert sent_values(sink) == [1, 2, 3]
+    assert sink.messages[-1][2][SqliteSource.METADATA_KEY_WATERMARK] == [3, 3]
+    source.stop()
+
+
+def test_watermark_does_not_pass_a_failed_send(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, [1, 2, 3])
+    watermark_filename = str(tmp_path / 'watermark.json')
+    source, sink = make_source(db_filename, watermark_filename=watermark_filename)
+    sink.fail_count = 1
+    poll(event_loop, source)
+    assert sink.messages == []
+    assert source._watermark is None
+    # Nothing is lost, the next poll sends every row
+    poll(event_loop, source)
+    assert sent_values(sink) == [1, 2, 3]
+    source.stop()
+    with open(watermark_filename, 'r') as wm_file:
+        assert json.load(wm_file)['watermark'] == [3, 3]
+
+
+def test_batch_is_resent_after_a_failed_send(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, [1, 2, 3])
+    source, sink = make_source(db_filename, emit_mode='batch', fetch_chunk_size=2)
+    sink.fail_count = 2
+    poll(event_loop, source)
+    poll(event_loop, source)
+    poll(event_loop, source)
+    assert [[record['v'] for record in json.loads(payload)] for mime_type, payload, metadata in sink.messages] == [[1, 2], [3]]
+    source.stop()
+
+
+def test_missing_table_does_not_kill_the_poll(tmp_path, event_loop):
+    db_filename = str(tmp_path / 'test.db')
+    sqlite3.connect(db_filename).close()
+    source, sink = make_source(db_filename)
+    poll(event_loop, source)
+    assert sink.messages == []
+    assert source._poll_task.exception() is None
+    source.stop()
+
+
+class RecordingConnection:
+    """
+    Wraps a reader connection, recording the threads that run the query and fetch the rows
+    """
+    def __init__(self, conn, threads):
+        self.conn = conn
+        self._threads = threads
+
+    def execute(self, sql_stmt, params):
+        self._threads.append(threading.current_thread())
+        return RecordingCursor(self.conn.execute(sql_stmt, params), self._threads)
+
+
+class RecordingCursor:
+    def __init__(self, cur, threads):
+        self._cur = cur
+        self._threads = threads
+        self.description = cur.description
+
+    def fetchmany(self, size):
+        self._threads.append(threading.current_thread())
+        return self._cur.fetchmany(size)
+
+    def close(self):
+        self._cur.close()
+
+
+def test_query_and_fetches_run_off_the_event_loop(tmp_path, event_loop, monkeypatch):
+    db_filename = str(tmp_path / 'test.db')
+    create_items(db_filename, [1, 2, 3])
+    source, sink = make_source(db_filename, fetch_chunk_size=1)
+    database = source._database
+    acquire_reader, release_reader = database.acquire_reader, database.release_reader
+    threads = []
+    monkeypatch.setattr(database, 'acquire_reader', lambda: RecordingConnection(acquire_reader(), threads))
+    monkeypatch.setattr(database, 'release_reader', lambda conn: release_reader(conn.conn))
+    poll(event_loop, source)
+    assert sent_values(sink) == [1, 2, 3]
+    # The query, and a fetch per row plus the empty fetch that ends the poll
+    assert len(threads) == 5
+    assert threading.main_thread() not in threads
@@ -0,0 +1,374 @@
+import asyncio
+import json
+import os
+import pickle
+import socket
+
+import pytest
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import HTTPHeaders, HTTPServerRequest
+
+from filters.tornado_source import RequestMetadata, TornadoSource
+from graph.filter_base import FilterBase, FilterState, FilterType
+from graph.input_pin import InputPin
+from graph.json_payload import JsonPayload
+from graph.output_pin import OutputPin
+from test.graph_helpers import new_graph_manager
+
+
+class EchoFilter(FilterBase):
+    """
+    Answers every request with its payload. A streamed request is answered once it ends, with the chunks joined.
+    Requests are left unanswered while hold is set, and answered with reply_payload instead when it is set.
+    With reply_to_start set, a streamed request is also answered
+    when it starts, and with reject_start set its start is refused.
+    """
+    filter_pad_templates = {}
+    filter_meta = {}
+
+    def __init__(self, name, config_dict, graph_manager):
+        super().__init__(name, config_dict, graph_manager, FilterType.sink)
+        self.messages = []
+        self.hold = False
+        self.reply_to_start = False
+        self.reject_start = False
+        self.reply_payload = None
+        self._streams = {}
+        self._add_input_pin(InputPin('input', {'*': self.recv}, self))
+        self._output_pin = OutputPin('output', True)
+        self._add_output_pin(self._output_pin)
+
+    def run(self):
+        super().run()
+        self._set_filter_state(FilterState.running)
+
+    def stop(self):
+        super().stop()
+        self._set_filter_state(FilterState.stopped)
+
+    def recv(self, mime_type, payload, metadata_dict):
+        self.messages.append((mime_type, payload, metadata_dict))
+        if self.hold:
+            return
+        stream_event = metadata_dict.get(TornadoSource.METADATA_KEY_STREAM_EVENT)
+        stream_id = metadata_dict.get(TornadoSource.METADATA_KEY_STREAM_ID)
+        if stream_event == TornadoSource.STREAM_EVENT_START:
+            if self.reject_start:
+                raise ValueError('start refused')
+            self._streams[stream_id] = b''
+            if self.reply_to_start:
+                self._output_pin.send('text/plain', b'early', metadata_dict)
+        elif stream_event == TornadoSource.STREAM_EVENT_CHUNK:
+            self._streams[stream_id] += payload
+        elif stream_event == TornadoSource.STREAM_EVENT_END:
+            self._output_pin.send('text/plain', self._streams.pop(stream_id), metadata_dict)
+        elif stream_event is None:
+            self._output_pin.send('text/plain', payload if self.reply_payload is None else self.reply_payload,
+                                  metadata_dict)
+
+    @staticmethod
+    def get_filter_metadata():
+        return FilterBase.filter_meta
+
+    @staticmethod
+    def get_filter_pad_templates():
+        return FilterBase.filter_pad_templates
+
+
+class EchoServer:
+    """
+    A TornadoSource listening on a free local port, wired to an EchoFilter
+    """
+    def __init__(self, **config):
+        self.port = EchoServer._free_port()
+        config_dict = {'uri_paths': ['/echo'], 'address': '127.0.0.1', 'port': self.port}
+        config_dict.update(config)
+        self.port = config_dict['port']
+        self.graph_manager = new_graph_manager()
+        self.source = TornadoSource('web', config_dict, self.graph_manager)
+        self.echo = EchoFilter('echo', {}, self.graph_manager)
+        self.graph_manager.add_filter(self.source)
+        self.graph_manager.add_filter(self.echo)
+        for verb in ('get', 'post', 'put', 'delete'):
+            self.graph_manager.connect_pins('web', 'output1_{0}'.format(verb), 'echo', 'input')
+        self.graph_manager.connect_pins('echo', 'output', 'web', 'input1')
+        self.graph_manager.compile_dispatch_plan()
+        self.graph_manager.run()
+        self.client = AsyncHTTPClient(force_instance=True)
+
+    def fetch(self, event_loop, path='/echo', **kwargs):
+        url = 'http://127.0.0.1:{0}{1}'.format(self.port, path)
+        return event_loop.run_until_complete(self.client.fetch(url, raise_error=False, **kwargs))
+
+    def stop(self):
+        self.client.close()
+        self.graph_manager.stop()
+
+    @staticmethod
+    def _free_port():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+
+def test_post_is_answered_by_the_graph(event_loop):
+    server = EchoServer()
+    response = server.fetch(event_loop, method='POST', body='hello')
+    assert response.code == 200
+    assert response.body == b'hello'
+    server.stop()
+
+
+def test_responses_are_not_compressed_by_default(event_loop):
+    server = EchoServer()
+    response = server.fetch(event_loop, method='POST', body='x' * 4096, headers={'Accept-Encoding': 'gzip'},
+                            decompress_response=False)
+    assert response.headers.get('Content-Encoding') is None
+    server.stop()
+
+
+def test_responses_are_compressed_when_configured(event_loop):
+    server = EchoServer(compress_response=True)
+    response = server.fetch(event_loop, method='POST', body='x' * 4096, headers={'Accept-Encoding': 'gzip'},
+                            decompress_response=False)
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    server.stop()
+
+
+def stream_events(echo):
+    return [metadata.get(TornadoSource.METADATA_KEY_STREAM_EVENT) for mime_type, payload, metadata in echo.messages]
+
+
+def test_streamed_body_is_sent_in_chunks(event_loop):
+    server = EchoServer(stream_request_body=True)
+
+    async def body_producer(write):
+        await write(b'abc')
+        await asyncio.sleep(0.05)
+        await write(b'def')
+    response = server.fetch(event_loop, method='POST', body_producer=body_producer)
+    assert response.body == b'abcdef'
+    events = stream_events(server.echo)
+    assert events[0] == TornadoSource.STREAM_EVENT_START and events[-1] == TornadoSource.STREAM_EVENT_END
+    assert TornadoSource.STREAM_EVENT_CHUNK in events
+    server.stop()
+
+
+def test_response_before_the_end_of_the_stream_is_dropped(event_loop):
+    server = EchoServer(stream_request_body=True)
+    server.echo.reply_to_start = True
+    response = server.fetch(event_loop, method='POST', body='hello')
+    assert response.body == b'hello'
+    server.stop()
+
+
+def test_stream_that_failed_to_start_is_not_aborted(event_loop):
+    server = EchoServer(stream_request_body=True)
+    server.echo.reject_start = True
+    response = server.fetch(event_loop, method='POST', body='hello')
+    assert response.code == 405
+    event_loop.run_until_complete(asyncio.sleep(0.05))
+    assert TornadoSource.STREAM_EVENT_ABORT not in stream_events(server.echo)
+    server.stop()
+
+
+def test_response_timeout_covers_the_upload(event_loop):
+    server = EchoServer(stream_request_body=True, response_timeout_seconds=0.2)
+
+    async def body_producer(write):
+        await write(b'abc')
+        await asyncio.sleep(0.4)
+        await write(b'def')
+    response = server.fetch(event_loop, method='POST', body_producer=body_producer)
+    assert response.code == 504
+    server.stop()
+
+
+def test_cached_get_is_served_without_the_graph(event_loop):
+    server = EchoServer(response_cache={'ttl_seconds': 60})
+    first = server.fetch(event_loop, path='/echo?a=1')
+    second = server.fetch(event_loop, path='/echo?a=1')
+    assert first.code == 200 and second.body == first.body
+    assert len(server.echo.messages) == 1
+    # A matching If-None-Match is answered 304
+    etag = first.headers['Etag']
+    assert server.fetch(event_loop, path='/echo?a=1', headers={'If-None-Match': etag}).code == 304
+    server.stop()
+
+
+def test_uncacheable_body_still_completes_the_request(event_loop):
+    server = EchoServer(response_cache={'ttl_seconds': 60})
+    # Tornado writes a dict as json, the cache skips it
+    server.echo.reply_payload = {'a': 1}
+    first = server.fetch(event_loop, path='/echo?a=1')
+    assert first.code == 200 and json.loads(first.body) == {'a': 1}
+    server.fetch(event_loop, path='/echo?a=1')
+    assert len(server.echo.messages) == 2
+    server.stop()
+
+
+def make_request_metadata():
+    request = HTTPServerRequest(method='GET', uri='/echo?a=1', headers=HTTPHeaders({'Accept': 'text/plain'}))
+    return RequestMetadata(request, 7)
+
+
+def test_request_metadata_reads_fields_on_demand():
+    metadata = make_request_metadata()
+    assert metadata[TornadoSource.METADATA_KEY_REQUEST_PATH] == '/echo'
+    assert metadata[TornadoSource.METADATA_KEY_REQUEST_HEADERS] == {'Accept': 'text/plain'}
+    del metadata[TornadoSource.METADATA_KEY_REQUEST_URI]
+    assert TornadoSource.METADATA_KEY_REQUEST_URI not in metadata
+    copied = metadata.copy()
+    assert copied[TornadoSource.METADATA_KEY_REQUEST_METHOD] == 'GET'
+    assert TornadoSource.METADATA_KEY_REQUEST_URI not in copied
+
+
+def test_request_metadata_pickles_every_field():
+    unpickled = pickle.loads(pickle.dumps(make_request_metadata()))
+    assert type(unpickled) is dict
+    assert unpickled[TornadoSource.METADATA_KEY_HANDLER_ID] == 7
+    assert unpickled[TornadoSource.METADATA_KEY_REQUEST_PATH] == '/echo'
+    assert unpickled[TornadoSource.METADATA_KEY_REQUEST_METHOD] == 'GET'
+    assert unpickled[TornadoSource.METADATA_KEY_REQUEST_HEADERS] == {'Accept': 'text/plain'}
+
+
+def test_request_metadata_pickles_without_the_deleted_fields():
+    metadata = make_request_metadata()
+    metadata['table_name_literal'] = 'items'
+    del metadata[TornadoSource.METADATA_KEY_REQUEST_URI]
+    unpickled = pickle.loads(pickle.dumps(metadata))
+    assert unpickled == dict(metadata)
+    assert TornadoSource.METADATA_KEY_REQUEST_URI not in unpickled
+    assert unpickled['table_name_literal'] == 'items'
+
+
+def test_get_arguments_arrive_as_json_text_with_the_value(event_loop):
+    server = EchoServer()
+    response = server.fetch(event_loop, path='/echo?a=1&b=2')
+    payload = server.echo.messages[0][1]
+    assert isinstance(payload, JsonPayload)
+    assert payload.value == {'a': '1', 'b': '2'}
+    assert json.loads(response.body) == {'a': '1', 'b': '2'}
+    server.stop()
+
+
+def test_workers_share_the_port_with_reuse_port(event_loop):
+    first = EchoServer(reuse_port=True)
+    second = EchoServer(reuse_port=True, port=first.port)
+    assert second.fetch(event_loop, method='POST', body='hello').body == b'hello'
+    second.stop()
+    first.stop()
+
+
+def test_unix_socket_listener_is_refused_with_several_processes():
+    with pytest.raises(ValueError):
+        TornadoSource('web', {'uri_paths': ['/echo'], 'processes': 2, 'listeners': [{'unix_socket': '/tmp/web.sock'}]},
+                      new_graph_manager())
+
+
+def test_requests_beyond_max_in_flight_are_turned_away(event_loop):
+    server = EchoServer(max_in_flight=1, response_timeout_seconds=0.3)
+    server.echo.hold = True
+    url = 'http://127.0.0.1:{0}/echo'.format(server.port)
+
+    async def fetch_two():
+        first = asyncio.ensure_future(server.client.fetch(url, method='POST', body='a', raise_error=False))
+        await asyncio.sleep(0.1)
+        second = await server.client.fetch(url, method='POST', body='b', raise_error=False)
+        return await first, second
+    first, second = event_loop.run_until_complete(fetch_two())
+    assert second.code == 503
+    # Nothing answered the first one before its deadline
+    assert first.code == 504
+    assert len(server.echo.messages) == 1
+    server.stop()
+
+
+def test_response_timeout_can_be_set_per_uri_path(event_loop):
+    server = EchoServer(response_timeout_seconds={'/echo': 0.1, '/other': 60})
+    server.echo.hold = True
+    assert server.fetch(event_loop, method='POST', body='hello').code == 504
+    server.stop()
+
+
+def test_late_response_is_dropped(event_loop):
+    server = EchoServer(response_timeout_seconds=0.1)
+    server.echo.hold = True
+    assert server.fetch(event_loop, method='POST', body='hello').code == 504
+    mime_type, payload, metadata = server.echo.messages[0]
+    assert server.source._get_active_handler(metadata[TornadoSource.METADATA_KEY_HANDLER_ID]) is None
+    # Nothing is left to answer, and the response doesn't raise
+    server.source.recv('text/plain', b'late', metadata)
+    server.stop()
+
+
+def post_held_requests(event_loop, server, bodies):
+    """
+    Post each body while the EchoFilter holds them, and wait until all of them are waiting on the graph
+    :return: The futures of the responses
+    """
+    server.echo.hold = True
+    url = 'http://127.0.0.1:{0}/echo'.format(server.port)
+    futures = [server.client.fetch(url, method='POST', body=body, raise_error=False) for body in bodies]
+
+    async def wait():
+        while len(server.echo.messages) < len(bodies):
+            await asyncio.sleep(0.01)
+    event_loop.run_until_complete(asyncio.wait_for(wait(), 5))
+    return futures
+
+
+def test_responses_find_their_request_in_any_order(event_loop):
+    server = EchoServer()
+    futures = post_held_requests(event_loop, server, ['a', 'b'])
+    for mime_type, payload, metadata in reversed(server.echo.messages):
+        server.source.recv('text/plain', payload.upper(), metadata)
+    responses = event_loop.run_until_complete(asyncio.gather(*futures))
+    assert sorted(response.body for response in responses) == [b'A', b'B']
+    for response in responses:
+        assert response.body == response.request.body.upper()
+    server.stop()
+
+
+def test_partial_responses_are_written_until_the_last_one(event_loop):
+    server = EchoServer()
+    futures = post_held_requests(event_loop, server, ['a'])
+    metadata = server.echo.messages[0][2]
+    partial = metadata.copy()
+    partial[TornadoSource.METADATA_KEY_RESPONSE_PARTIAL] = True
+    server.source.recv('text/plain', b'first ', partial)
+    server.source.recv('text/plain', b'second', metadata)
+    response = event_loop.run_until_complete(futures[0])
+    assert response.body == b'first second'
+    server.stop()
+
+
+def test_error_status_from_the_graph_is_answered(event_loop):
+    server = EchoServer()
+    futures = post_held_requests(event_loop, server, ['a'])
+    metadata = server.echo.messages[0][2].copy()
+    metadata[TornadoSource.METADATA_KEY_RESPONSE_STATUS] = 404
+    server.source.recv('text/plain', b'', metadata)
+    assert event_loop.run_until_complete(futures[0]).code == 404
+    server.stop()
+
+
+def test_unix_socket_listener(tmp_path, event_loop):
+    socket_path = str(tmp_path / 'web.sock')
+    server = EchoServer(listeners=[{'unix_socket': socket_path}])
+    assert os.stat(socket_path).st_mode & 0o777 == 0o600
+
+    async def post():
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(b'POST /echo HTTP/1.1\r\nHost: local\r\nContent-Length: 5\r\nConnection: close\r\n\r\nhello')
+        response = await reader.read()
+        writer.close()
+        return response
+    response = event_loop.run_until_complete(post())
+    assert response.startswith(b'HTTP/1.1 200') and response.endswith(b'hello')
+    server.stop()
+    # The socket file is removed when the filter stops
+    assert not os.path.exists(socket_path)